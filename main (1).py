@@ -3,9 +3,25 @@ import random
 import datetime
 import os
 import asyncio
+import bisect
 import json
+import sqlite3
+import concurrent.futures
 import math
 import time
+import functools
+import heapq
+import collections
+import itertools
+import contextlib
+import struct
+import sys
+from typing import Optional, TypedDict
+
+try:
+    import numpy as np # 大量ロールのまとめ抽選に使用 (任意)
+except ImportError:
+    np = None # NumPyが無い環境では標準ライブラリで代替する
 
 # @@@ 初期化デバッグ: このスクリプトが読み込まれ、実行を開始しました！ @@@
 
@@ -18,6 +34,8 @@ bot = discord.Client(intents=intents)
 USER_DATA_FILE = 'user_data.json'
 BOT_SETTINGS_FILE = 'bot_settings.json'
 AUTO_RNG_SESSIONS_FILE = 'auto_rng_sessions.json' # 新しいファイルパスを追加
+DATABASE_FILE = 'bot_data.db' # データの保存先 (上の3つのJSONファイルは初回起動時に取り込む)
+JOURNAL_FILE = 'bot_data.journal' # ユーザーデータの変更差分を追記するジャーナル
 ADMIN_IDS = [929555026612715530, 974264083853492234, 997803924281118801, 950387247985864725] # 950387247985864725 を追加
 
 # 各アイテムの基本確率 (分母)
@@ -96,179 +114,1482 @@ LUCK_POTION_EFFECTS = {
     "ten_thousand_luck_potion": 10000
 }
 
+# ポーションを使う順 (倍率の高い順) と、内部名・入力名からの逆引き (ロールのたびに並べ替えたり探したりしない)
+LUCK_POTION_PRIORITY = tuple(sorted(LUCK_POTION_EFFECTS.items(), key=lambda item: item[1], reverse=True))
+LUCK_POTION_DISPLAY_NAMES = {next(iter(recipe_data["output"])): recipe_name for recipe_name, recipe_data in LUCK_POTION_RECIPES.items()} # 内部名 -> レシピ名
+LUCK_POTION_RECIPE_NAMES_BY_LOWER = {recipe_name.lower(): recipe_name for recipe_name in LUCK_POTION_RECIPES} # 小文字のレシピ名 -> レシピ名
+
 
 auto_rng_sessions = {} # グローバル変数として定義
 bot_settings = {}
 user_data = {} # グローバル変数として定義
 
 # user_dataへのアクセスを同期するためのロック
-# on_message以外の場所（例: ステータス更新タスク）からuser_dataにアクセスする際に使用
-user_data_lock = asyncio.Lock()
+# 1人のユーザーだけを読み書きする処理は user_lock(user_id) (ユーザーIDで選ぶストライプロック) を取得する。
+# 全ユーザーを書き換える処理 (!resetall, !delete) は all_user_locks() で全ストライプを取得する。
+# 全ユーザーを読むだけの処理 (ランキング、総所持数など) は await を挟まずに読み切るため、ロックを取らない。
+# ロックを保持している間はDiscordへの送信などのネットワークI/Oを行わないこと。
+USER_LOCK_STRIPES = 64
+user_lock_stripes = [asyncio.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+def user_lock(user_id):
+    """ユーザーIDに対応するストライプロックを返す"""
+    return user_lock_stripes[hash(user_id) % USER_LOCK_STRIPES]
+
+@contextlib.asynccontextmanager
+async def all_user_locks():
+    """全ストライプのロックを常に同じ順番で取得する (全ユーザーを書き換える処理用)"""
+    acquired_locks = []
+    try:
+        for lock in user_lock_stripes:
+            await lock.acquire()
+            acquired_locks.append(lock)
+        yield
+    finally:
+        for lock in reversed(acquired_locks):
+            lock.release()
+
+# --- ユーザーデータのスキーマ ---
+# 1ユーザー分のデータの形。新しいユーザーは new_user_record() で作成する。
+# 古い形のデータは load_user_data で一度だけ USER_DATA_MIGRATIONS を適用して最新の形にそろえるため、
+# on_message などではフィールドの有無を確認する必要はない。
+class BoostRecord(TypedDict):
+    multiplier: float
+    end_time: Optional[float] # UNIXタイムスタンプ (ブーストなしはNone)
+
+class DailyLoginRecord(TypedDict):
+    last_login_date: Optional[str] # "%Y-%m-%d"
+    consecutive_days: int
+    active_boost: BoostRecord
+
+class UserRecord(TypedDict):
+    rolls: int
+    luck: float
+    inventory: dict # アイテム名 -> 個数
+    luck_potions: dict # 内部的なポーション名 -> 所持数
+    active_luck_potion_uses: dict # 内部的なポーション名 -> 残り使用回数
+    daily_login: DailyLoginRecord
+    admin_boost: BoostRecord
+
+def new_boost_record() -> BoostRecord:
+    return {"multiplier": 1.0, "end_time": None}
+
+def new_daily_login_record() -> DailyLoginRecord:
+    return {"last_login_date": None, "consecutive_days": 0, "active_boost": new_boost_record()}
+
+def new_user_record() -> UserRecord:
+    """新しいユーザーの初期データを作成する"""
+    return {
+        "rolls": 0,
+        "luck": 1.0,
+        "inventory": {},
+        "luck_potions": {},
+        "active_luck_potion_uses": {},
+        "daily_login": new_daily_login_record(),
+        "admin_boost": new_boost_record()
+    }
+
+def migrate_user_record_v1(data):
+    """
+    v0 -> v1: 後から追加されたフィールド (daily_login, luck_potions, active_luck_potion_uses, admin_boost) と
+    初期化前のフィールドを初期値で補う。変更があればTrueを返す
+    """
+    missing_fields = {field: value for field, value in new_user_record().items() if field not in data}
+    data.update(missing_fields)
+    return bool(missing_fields)
+
+USER_DATA_MIGRATIONS = [migrate_user_record_v1] # i番目はバージョン i -> i+1 の移行 (変更があればTrueを返す)
+USER_DATA_SCHEMA_VERSION = len(USER_DATA_MIGRATIONS)
+
+def migrate_user_record(data, from_version):
+    """1ユーザー分のデータに from_version 以降の移行を適用する。変更があればTrueを返す"""
+    changed = False
+    for migration in USER_DATA_MIGRATIONS[from_version:]:
+        changed = migration(data) or changed
+    return changed
 
 # --- データ保存・ロード関数 ---
+# データはSQLite (WALモード) にユーザーごとの行として保存する。
+# 起動時に全データをメモリに読み込み、保存時は変更されたユーザーの行だけを1回のトランザクションで書き込む。
+# 保存はイベントループ上で変更分のコピーを取るだけにし、シリアライズと書き込みはワーカースレッドで行う。
+db_connection = None # 読み込み用 (イベントループのスレッドでのみ使用)
+storage_writer_connection = None # 書き込み用 (ワーカースレッドでのみ使用)
+storage_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage") # 書き込み順を保つため1スレッド
+dirty_user_ids = set() # 保存待ちのユーザーID
+deleted_user_ids = set() # 削除待ちのユーザーID
+user_data_cleared = False # !resetall による全ユーザー削除待ち
+saved_auto_rng_session_ids = set() # データベースに保存済みのオートRNGセッション (起動時の読み込み以外はワーカースレッドで更新)
+unwritten_user_rows = None # 書き込みに失敗したユーザーの行 (変更, 削除, 全削除) (ワーカースレッドでのみ使用。次の書き込みに含める)
+
+# 保存時にイベントループが止まった時間 (スナップショットのコピーにかかった時間) の集計
+# 種類 -> {"saves": 保存回数, "total_ms": 合計, "max_ms": 最大}
+storage_stall_stats = {}
+
+def open_database_connection():
+    """SQLiteデータベースに接続し、必要なテーブルを作成する"""
+    connection = sqlite3.connect(DATABASE_FILE)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS bot_settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS auto_rng_sessions (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS item_names (item_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    return connection
+
+def get_db_connection():
+    """読み込み用の接続を返す (初回は旧JSONファイルの取り込みも行う)"""
+    global db_connection
+    if db_connection is None:
+        db_connection = open_database_connection()
+        import_legacy_json_files()
+    return db_connection
+
+def get_storage_writer_connection():
+    """書き込み用の接続を返す (ワーカースレッドからのみ呼ぶこと)"""
+    global storage_writer_connection
+    if storage_writer_connection is None:
+        storage_writer_connection = open_database_connection()
+    return storage_writer_connection
+
+def copy_json_value(value):
+    """JSON互換のデータ (dict / list / 値) を複製する (copy.deepcopy より高速)"""
+    if isinstance(value, dict):
+        return {key: copy_json_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_json_value(item) for item in value]
+    return value
+
+def record_storage_stall(kind, stall_seconds, row_count):
+    """保存時のイベントループ停止時間を記録して表示する"""
+    stall_ms = stall_seconds * 1000
+    stats = storage_stall_stats.setdefault(kind, {"saves": 0, "total_ms": 0.0, "max_ms": 0.0})
+    stats["saves"] += 1
+    stats["total_ms"] += stall_ms
+    stats["max_ms"] = max(stats["max_ms"], stall_ms)
+    print(f"DEBUG: Saving {kind} ({row_count} rows). Event loop stall: {stall_ms:.2f}ms (max {stats['max_ms']:.2f}ms)")
+
+def submit_storage_write(kind, write_function, *args):
+    """書き込みをワーカースレッドに送る。完了を待つ場合は返り値のFutureを使う"""
+    def report_error(future):
+        if future.exception() is not None:
+            print(f"ERROR: {kind} の保存中にエラーが発生しました: {future.exception()}")
+    future = storage_executor.submit(write_function, *args)
+    future.add_done_callback(report_error)
+    return future
+
+# --- ユーザーデータのバイナリ形式 ---
+# users テーブルの行は、アイテム名をIDに置き換えた固定長ヘッダ + 整数配列のバイナリで保存する。
+# (JSONでは全ユーザーの所持品に同じアイテム名が繰り返し現れ、サイズと読み込み時間の大半を占める)
+#   ヘッダ: 形式バージョン, rolls, luck, 最終ログイン日 (序数, 0はなし), 連続ログイン日数,
+#           デイリーブースト倍率・終了時刻, 管理者ブースト倍率・終了時刻 (終了時刻なしはNaN),
+#           inventory / luck_potions / active_luck_potion_uses の件数
+#   続いて3つのフィールドのアイテムIDの配列 (uint32) と個数の配列 (int64) をまとめて並べる
+# アイテムIDは item_names テーブルで管理し、新しい名前は書き込み時にワーカースレッドで割り当てる。
+# この形に収まらないデータ (想定外のフィールドがあるなど) はJSONのテキストのまま保存する。
+USER_RECORD_FORMAT_VERSION = 1
+USER_RECORD_HEADER = struct.Struct("<BqdiIddddIII")
+USER_RECORD_FIELDS = {"rolls", "luck", "inventory", "luck_potions", "active_luck_potion_uses", "daily_login", "admin_boost"}
+snapshot_item_ids = None # アイテム名 -> ID (ワーカースレッドでのみ使用)
+
+@functools.lru_cache(maxsize=256)
+def user_record_arrays_struct(item_count):
+    """アイテム item_count 件分の ID配列 + 個数配列 の Struct"""
+    return struct.Struct(f"<{item_count}I{item_count}q")
+
+@functools.lru_cache(maxsize=4096)
+def ordinal_to_date_string(ordinal):
+    return datetime.date.fromordinal(ordinal).strftime("%Y-%m-%d")
+
+def encode_user_record(data, item_ids, new_item_names):
+    """
+    ユーザーデータをバイナリ形式に変換する。バイナリ形式に収まらなければJSONのテキストを返す。
+    未登録のアイテム名には item_ids にIDを割り当て、new_item_names に (ID, 名前) を追加する。
+    """
+    try:
+        if data.keys() != USER_RECORD_FIELDS:
+            raise ValueError("unexpected fields")
+        daily_login = data["daily_login"]
+        daily_boost = daily_login["active_boost"]
+        admin_boost = data["admin_boost"]
+        last_login_date = daily_login["last_login_date"]
+        last_login_ordinal = 0
+        if last_login_date is not None:
+            last_login_ordinal = datetime.date.fromisoformat(last_login_date).toordinal()
+            if ordinal_to_date_string(last_login_ordinal) != last_login_date:
+                raise ValueError("non-canonical date")
+
+        ids = []
+        counts = []
+        for field in JOURNAL_COUNTER_FIELDS:
+            for name, count in data[field].items():
+                item_id = item_ids.get(name)
+                if item_id is None:
+                    item_id = item_ids[name] = len(item_ids) + 1
+                    new_item_names.append((item_id, name))
+                ids.append(item_id)
+                counts.append(count)
+
+        header = USER_RECORD_HEADER.pack(
+            USER_RECORD_FORMAT_VERSION,
+            data["rolls"],
+            data["luck"],
+            last_login_ordinal,
+            daily_login["consecutive_days"],
+            daily_boost["multiplier"],
+            math.nan if daily_boost["end_time"] is None else daily_boost["end_time"],
+            admin_boost["multiplier"],
+            math.nan if admin_boost["end_time"] is None else admin_boost["end_time"],
+            *(len(data[field]) for field in JOURNAL_COUNTER_FIELDS),
+        )
+        return header + user_record_arrays_struct(len(ids)).pack(*ids, *counts)
+    except (KeyError, TypeError, ValueError, AttributeError, struct.error):
+        return json.dumps(data, ensure_ascii=False)
+
+def decode_user_record(blob, item_names):
+    """users テーブルの行 (バイナリ形式またはJSONのテキスト) をユーザーデータに戻す。item_names は ID -> 名前"""
+    if isinstance(blob, str):
+        return json.loads(blob)
+    (version, rolls, luck, last_login_ordinal, consecutive_days,
+     daily_multiplier, daily_end_time, admin_multiplier, admin_end_time,
+     inventory_count, luck_potions_count, active_uses_count) = USER_RECORD_HEADER.unpack_from(blob)
+    if version != USER_RECORD_FORMAT_VERSION:
+        raise ValueError(f"unknown user record format version {version}")
+    item_count = inventory_count + luck_potions_count + active_uses_count
+    values = user_record_arrays_struct(item_count).unpack_from(blob, USER_RECORD_HEADER.size)
+    names = [item_names[item_id] for item_id in values[:item_count]]
+    counts = values[item_count:]
+    potions_end = inventory_count + luck_potions_count
+    return {
+        "rolls": rolls,
+        "luck": luck,
+        "inventory": dict(zip(names[:inventory_count], counts[:inventory_count])),
+        "luck_potions": dict(zip(names[inventory_count:potions_end], counts[inventory_count:potions_end])),
+        "active_luck_potion_uses": dict(zip(names[potions_end:], counts[potions_end:])),
+        "daily_login": {
+            "last_login_date": ordinal_to_date_string(last_login_ordinal) if last_login_ordinal else None,
+            "consecutive_days": consecutive_days,
+            "active_boost": {"multiplier": daily_multiplier, "end_time": None if math.isnan(daily_end_time) else daily_end_time}
+        },
+        "admin_boost": {"multiplier": admin_multiplier, "end_time": None if math.isnan(admin_end_time) else admin_end_time}
+    }
+
+def load_item_names(connection):
+    """item_names テーブルから {ID: アイテム名} を読み込む"""
+    return dict(connection.execute("SELECT item_id, name FROM item_names"))
+
+def encode_user_rows(connection, changed_rows):
+    """
+    変更されたユーザーの行をエンコードする (ワーカースレッドで実行)。
+    [(ユーザーID, 行のデータ), ...] と、新しく割り当てた [(アイテムID, 名前), ...] を返す。
+    """
+    global snapshot_item_ids
+    if snapshot_item_ids is None:
+        snapshot_item_ids = {name: item_id for item_id, name in load_item_names(connection).items()}
+    new_item_names = []
+    encoded_rows = [(uid, encode_user_record(data, snapshot_item_ids, new_item_names)) for uid, data in changed_rows.items()]
+    return encoded_rows, new_item_names
+
+def read_legacy_json_file(path):
+    """旧形式のJSONファイルを読み込む。壊れている場合はバックアップしてNoneを返す"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError as e:
+            print(f"ERROR: {path}の読み込み中にエラーが発生しました: {e}")
+            print(f"既存の{path}をバックアップし、取り込みをスキップします。")
+    os.rename(path, path + ".bak." + datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+    return None
+
+def import_legacy_json_files():
+    """初回起動時に user_data.json / bot_settings.json / auto_rng_sessions.json をデータベースに取り込む"""
+    if db_connection.execute("SELECT 1 FROM meta WHERE key = 'legacy_json_imported'").fetchone():
+        return
+
+    legacy_user_data = read_legacy_json_file(USER_DATA_FILE) or {}
+    legacy_bot_settings = read_legacy_json_file(BOT_SETTINGS_FILE) or {}
+    legacy_auto_rng_sessions = read_legacy_json_file(AUTO_RNG_SESSIONS_FILE) or {}
+
+    with db_connection: # 1回のトランザクションで取り込む
+        db_connection.executemany(
+            "INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)",
+            [(uid, json.dumps(data, ensure_ascii=False)) for uid, data in legacy_user_data.items()]
+        )
+        db_connection.executemany(
+            "INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value, ensure_ascii=False)) for key, value in legacy_bot_settings.items()]
+        )
+        # auto_rng_sessions.json はデータベースと同じシリアライズ形式なのでそのまま取り込む
+        db_connection.executemany(
+            "INSERT OR REPLACE INTO auto_rng_sessions (user_id, data) VALUES (?, ?)",
+            [(uid, json.dumps(session_data, ensure_ascii=False)) for uid, session_data in legacy_auto_rng_sessions.items()]
+        )
+        db_connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_json_imported', ?)",
+            (datetime.datetime.now(datetime.timezone.utc).isoformat(),)
+        )
+    print(f"旧JSONファイルをデータベースに取り込みました。(ユーザー: {len(legacy_user_data)}件, オートRNGセッション: {len(legacy_auto_rng_sessions)}件)")
+
+# --- 書き込み遅延 (write-behind) ---
+# 変更されたユーザーは保存待ちとして記録するだけにし、バックグラウンドの保存タスクがまとめて保存する。
+# 変更の差分はその場でジャーナルに追記されるため、データベースへの保存はジャーナルのコンパクションを兼ねる。
+USER_DATA_FLUSH_INTERVAL_SECONDS = 60 # 保存待ちの変更をデータベースに保存する間隔 (秒)
+USER_DATA_FLUSH_DIRTY_THRESHOLD = 1000 # 保存待ちのユーザー数がこれに達したら間隔を待たずに保存する
+user_data_flush_requested = asyncio.Event()
+user_data_flusher_task = None
+
+def mark_user_dirty(user_id):
+    """ユーザーデータが変更されたことを記録する (保存タスクが後でまとめて保存する)"""
+    dirty_user_ids.add(user_id)
+    deleted_user_ids.discard(user_id)
+    if len(dirty_user_ids) >= USER_DATA_FLUSH_DIRTY_THRESHOLD:
+        user_data_flush_requested.set()
+
+def mark_user_deleted(user_id):
+    """ユーザーデータが削除されたことを記録する"""
+    deleted_user_ids.add(user_id)
+    dirty_user_ids.discard(user_id)
+
+def mark_all_users_deleted():
+    """全ユーザーのデータが削除されたことを記録する (!resetall)"""
+    global user_data_cleared
+    user_data_cleared = True
+    dirty_user_ids.clear()
+    deleted_user_ids.clear()
+
+# --- 追記型ジャーナル ---
+# ユーザーデータへの変更は差分としてジャーナルファイルに1行ずつ追記する。
+#   add: ロール数・所持数の増減 (ロール結果、合成・ポーション作成の素材消費、ポーションの使用キューなど)
+#   set: フィールドの上書き (ブーストの変更など)
+#   put / delete / reset: ユーザーの作成・削除・全削除
+# データベースの行はジャーナルを折りたたんだスナップショットで、save_user_data のたびにジャーナルを
+# 切り替えてスナップショットに取り込む (コンパクション)。起動時はスナップショットを読み込んだ後、
+# スナップショットより新しい差分を再生する。
+JOURNAL_COMPACTION_ENTRIES = 20000 # ジャーナルの差分がこれだけたまったら間隔を待たずにコンパクションする
+JOURNAL_COUNTER_FIELDS = ("inventory", "luck_potions", "active_luck_potion_uses") # add で増減できるフィールド
+journal_file = None
+journal_seq = 0 # 最後に追記した差分の通し番号
+journal_entries_since_rotation = 0 # 現在のジャーナルファイルにある差分の数
+
+def append_journal_entry(entry):
+    """差分に通し番号を付けてジャーナルに追記する"""
+    global journal_file, journal_seq, journal_entries_since_rotation
+    if journal_file is None:
+        journal_file = open(JOURNAL_FILE, 'a', encoding='utf-8')
+    journal_seq += 1
+    entry["seq"] = journal_seq
+    journal_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    journal_file.flush() # プロセスが落ちても失われないようにOSに渡しておく
+    journal_entries_since_rotation += 1
+    if journal_entries_since_rotation >= JOURNAL_COMPACTION_ENTRIES:
+        user_data_flush_requested.set()
+
+def rotate_journal():
+    """
+    現在のジャーナルを閉じて「ファイル名.最後の通し番号」に名前を変え、そのパスを返す。
+    以降の差分は新しいジャーナルに追記される。差分がなければNoneを返す。
+    """
+    global journal_file, journal_entries_since_rotation
+    if journal_entries_since_rotation == 0:
+        return None
+    if journal_file is not None:
+        journal_file.close()
+        journal_file = None
+    rotated_path = f"{JOURNAL_FILE}.{journal_seq}"
+    os.replace(JOURNAL_FILE, rotated_path)
+    journal_entries_since_rotation = 0
+    return rotated_path
+
+def list_rotated_journals():
+    """切り替え済みのジャーナルを [(パス, 最後の通し番号), ...] で古い順に返す"""
+    directory = os.path.dirname(os.path.abspath(JOURNAL_FILE))
+    prefix = os.path.basename(JOURNAL_FILE) + "."
+    rotated_journals = []
+    for file_name in os.listdir(directory):
+        suffix = file_name[len(prefix):]
+        if file_name.startswith(prefix) and suffix.isdigit():
+            rotated_journals.append((os.path.join(directory, file_name), int(suffix)))
+    rotated_journals.sort(key=lambda item: item[1])
+    return rotated_journals
+
+def apply_counter_delta(data, delta):
+    """add 差分 (ロール数と所持数の増減) をユーザーデータに反映する。0以下になった項目は削除する"""
+    if delta.get("rolls"):
+        data["rolls"] += delta["rolls"]
+    for field in JOURNAL_COUNTER_FIELDS:
+        counts = data[field]
+        for name, change in delta.get(field, {}).items():
+            new_count = counts.get(name, 0) + change
+            if new_count > 0:
+                counts[name] = new_count
+            else:
+                counts.pop(name, None)
+
+# --- サーバー全体の集計 (アイテム総所持数・総ロール数) ---
+# 全ユーザーの合計を、ロール数・所持数を変更する処理 (apply_user_delta、ユーザーの削除・全削除) が
+# 差分で更新する。読み取りは O(1) で、全ユーザーの走査は起動時の再構築の1回だけ。
+server_item_totals = {} # アイテム名 -> 全ユーザーの所持数の合計
+server_total_rolls = 0 # 全ユーザーのロール数の合計
+
+# --- ランキングの索引 ---
+# 指標ごとに (-スコア, ユーザーID) の昇順リスト (スコアの高い順) を bisect で維持する。
+# 上位k件はリストの先頭k件を読むだけで、自分の順位は二分探索で O(log n)。スコアが0のユーザーは載せない。
+#   "rolls": ロール数
+#   "rarity": レア度スコア (所持しているレアアイテムの 1/確率 の合計)
+#   "item:アイテム名": アイテムごとの所持数
+LEADERBOARD_ROLLS = "rolls"
+LEADERBOARD_RARITY = "rarity"
+leaderboard_scores = {} # 指標 -> {ユーザーID: スコア}
+leaderboard_entries = {} # 指標 -> [(-スコア, ユーザーID), ...]
+
+def item_leaderboard(item):
+    """アイテムごとの所持数ランキングの指標名"""
+    return f"item:{item}"
+
+def item_rarity_score(item, count):
+    """レア度スコアへの寄与 (レアアイテム以外は0)"""
+    return rare_item_chances_denominator.get(item, 0) * count
+
+def set_leaderboard_score(metric, user_id, score):
+    """ユーザーのスコアを更新し、ランキングの並び順を保つ"""
+    scores = leaderboard_scores.setdefault(metric, {})
+    entries = leaderboard_entries.setdefault(metric, [])
+    old_score = scores.get(user_id, 0)
+    if old_score == score:
+        return
+    if old_score > 0:
+        del entries[bisect.bisect_left(entries, (-old_score, user_id))]
+    if score > 0:
+        scores[user_id] = score
+        bisect.insort(entries, (-score, user_id))
+    else:
+        scores.pop(user_id, None)
+
+def leaderboard_top(metric, limit):
+    """上位 limit 件を [(ユーザーID, スコア), ...] で返す"""
+    return [(user_id, -negative_score) for negative_score, user_id in leaderboard_entries.get(metric, [])[:limit]]
+
+def leaderboard_rank(metric, user_id):
+    """(順位, スコア) を返す。ランキングに載っていなければ (None, 0)"""
+    score = leaderboard_scores.get(metric, {}).get(user_id, 0)
+    if score <= 0:
+        return None, 0
+    return bisect.bisect_left(leaderboard_entries[metric], (-score, user_id)) + 1, score
+
+def leaderboard_size(metric):
+    """ランキングに載っているユーザー数"""
+    return len(leaderboard_entries.get(metric, []))
+
+def rebuild_server_totals():
+    """全ユーザーのデータからサーバー全体の集計とランキングを作り直す (起動時に1回だけ)"""
+    global server_total_rolls
+    server_item_totals.clear()
+    server_total_rolls = 0
+    leaderboard_scores.clear()
+    leaderboard_entries.clear()
+    for user_id, data in user_data.items():
+        server_total_rolls += data["rolls"]
+        if data["rolls"] > 0:
+            leaderboard_scores.setdefault(LEADERBOARD_ROLLS, {})[user_id] = data["rolls"]
+        rarity_score = 0
+        for item, count in data["inventory"].items():
+            server_item_totals[item] = server_item_totals.get(item, 0) + count
+            leaderboard_scores.setdefault(item_leaderboard(item), {})[user_id] = count
+            rarity_score += item_rarity_score(item, count)
+        if rarity_score > 0:
+            leaderboard_scores.setdefault(LEADERBOARD_RARITY, {})[user_id] = rarity_score
+    for metric, scores in leaderboard_scores.items():
+        leaderboard_entries[metric] = sorted((-score, user_id) for user_id, score in scores.items())
+
+def adjust_server_item_totals(item, change):
+    """アイテム1種類の総所持数を増減する。0になった項目は削除する"""
+    new_total = server_item_totals.get(item, 0) + change
+    if new_total > 0:
+        server_item_totals[item] = new_total
+    else:
+        server_item_totals.pop(item, None)
+
+def remove_user_from_server_totals(user_id):
+    """削除するユーザーのロール数・所持数をサーバー全体の集計から差し引く。user_data から消す前に呼ぶこと"""
+    global server_total_rolls
+    server_total_rolls -= user_data[user_id]["rolls"]
+    set_leaderboard_score(LEADERBOARD_ROLLS, user_id, 0)
+    set_leaderboard_score(LEADERBOARD_RARITY, user_id, 0)
+    for item, count in user_data[user_id]["inventory"].items():
+        adjust_server_item_totals(item, -count)
+        set_leaderboard_score(item_leaderboard(item), user_id, 0)
+
+def apply_user_delta(user_id, rolls=0, inventory=None, luck_potions=None, active_luck_potion_uses=None, auto_rng_until=None):
+    """
+    ロール数・所持数の差分をユーザーデータに反映し、ジャーナルに追記する。
+    auto_rng_until はオートRNGのまとめ抽選で、どの時刻までのロールかを再生時に判断するために記録する。
+    ロール数・所持数の変化はサーバー全体の集計とランキングにも反映する。
+    """
+    global server_total_rolls
+    delta = {"op": "add", "uid": user_id}
+    if rolls:
+        delta["rolls"] = rolls
+    for field, changes in zip(JOURNAL_COUNTER_FIELDS, (inventory, luck_potions, active_luck_potion_uses)):
+        if changes:
+            delta[field] = changes
+    if auto_rng_until is not None:
+        delta["auto_rng_until"] = auto_rng_until
+
+    user_inventory = user_data[user_id]["inventory"]
+    counts_before = {item: user_inventory.get(item, 0) for item in inventory} if inventory else {}
+    apply_counter_delta(user_data[user_id], delta)
+    server_total_rolls += rolls
+    if rolls:
+        set_leaderboard_score(LEADERBOARD_ROLLS, user_id, user_data[user_id]["rolls"])
+    rarity_change = 0
+    for item, count_before in counts_before.items():
+        count_after = user_inventory.get(item, 0)
+        adjust_server_item_totals(item, count_after - count_before) # 0未満に切り捨てた分も正しく反映する
+        set_leaderboard_score(item_leaderboard(item), user_id, count_after)
+        rarity_change += item_rarity_score(item, count_after - count_before)
+    if rarity_change:
+        set_leaderboard_score(LEADERBOARD_RARITY, user_id, leaderboard_scores.get(LEADERBOARD_RARITY, {}).get(user_id, 0) + rarity_change)
+    if active_luck_potion_uses:
+        invalidate_effective_luck(user_id)
+    append_journal_entry(delta)
+    mark_user_dirty(user_id)
+
+def journal_user_fields(user_id, *fields):
+    """上書きしたフィールドの現在の値をジャーナルに追記する (ブーストの変更など)"""
+    data = user_data[user_id]
+    append_journal_entry({"op": "set", "uid": user_id, "fields": {field: copy_json_value(data[field]) for field in fields}})
+    invalidate_effective_luck(user_id)
+    mark_user_dirty(user_id)
+
+def journal_user_created(user_id):
+    """新しく作成したユーザーのデータをジャーナルに追記する"""
+    append_journal_entry({"op": "put", "uid": user_id, "data": copy_json_value(user_data[user_id])})
+    invalidate_effective_luck(user_id)
+    mark_user_dirty(user_id)
+
+def journal_user_deleted(user_id):
+    """ユーザーの削除をジャーナルに追記する"""
+    append_journal_entry({"op": "delete", "uid": user_id})
+    effective_luck_cache.pop(user_id, None)
+    mark_user_deleted(user_id)
+
+def journal_all_users_deleted():
+    """全ユーザーの削除 (!resetall) をジャーナルに追記する"""
+    global server_total_rolls
+    server_item_totals.clear()
+    server_total_rolls = 0
+    leaderboard_scores.clear()
+    leaderboard_entries.clear()
+    effective_luck_cache.clear()
+    append_journal_entry({"op": "reset"})
+    mark_all_users_deleted()
+
+def apply_journal_entry(entry):
+    """ジャーナルの差分を1件再生する"""
+    op = entry["op"]
+    user_id = entry.get("uid")
+    if op == "reset":
+        user_data.clear()
+        mark_all_users_deleted()
+    elif op == "delete":
+        user_data.pop(user_id, None)
+        mark_user_deleted(user_id)
+    elif op == "put":
+        user_data[user_id] = entry["data"]
+        mark_user_dirty(user_id)
+    elif user_id in user_data:
+        if op == "set":
+            user_data[user_id].update(entry["fields"])
+        elif op == "add":
+            apply_counter_delta(user_data[user_id], entry)
+            # オートRNGのまとめ抽選なら、保存済みのセッションより新しい分だけセッションの進捗にも反映する
+            session_data = auto_rng_sessions.get(user_id)
+            if "auto_rng_until" in entry and session_data is not None and session_data["materialized_until"] < entry["auto_rng_until"]:
+                session_data["materialized_until"] = entry["auto_rng_until"]
+                session_data["rolls_credited"] += entry.get("rolls", 0)
+                for item, count in entry.get("inventory", {}).items():
+                    session_data["found_items_log"][item] = session_data["found_items_log"].get(item, 0) + count
+        mark_user_dirty(user_id)
+
+def replay_journal(snapshot_seq):
+    """
+    スナップショットより新しいジャーナルの差分を通し番号順に再生する。
+    (再生した件数, 見つかった最大の通し番号, 現在のジャーナルファイルの差分の数) を返す。
+    """
+    entries = []
+    last_seq = snapshot_seq
+    current_journal_entries = 0
+    journal_paths = [path for path, _ in list_rotated_journals()]
+    if os.path.exists(JOURNAL_FILE):
+        journal_paths.append(JOURNAL_FILE)
+
+    for path in journal_paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で停止した最後の行は無視する
+                    print(f"WARNING: ジャーナル {path} の壊れた行を無視しました。")
+                    continue
+                if path == JOURNAL_FILE:
+                    current_journal_entries += 1
+                last_seq = max(last_seq, entry["seq"])
+                if entry["seq"] > snapshot_seq:
+                    entries.append(entry)
+
+    entries.sort(key=lambda entry: entry["seq"])
+    for entry in entries:
+        apply_journal_entry(entry)
+    return len(entries), last_seq, current_journal_entries
+
+def merge_unwritten_user_rows(changed_rows, deleted_ids, cleared):
+    """前回書き込みに失敗した行に今回の変更を重ねる (ワーカースレッドで実行)。今回の変更・削除を優先する"""
+    if unwritten_user_rows is None or cleared:
+        return changed_rows, deleted_ids, cleared
+    previous_rows, previous_deleted_ids, previous_cleared = unwritten_user_rows
+    merged_rows = {uid: data for uid, data in previous_rows.items() if uid not in deleted_ids}
+    merged_rows.update(changed_rows)
+    merged_deleted_ids = tuple(set(previous_deleted_ids).union(deleted_ids)) # 削除は書き込みより先に行うので、あとで作り直した行は残る
+    return merged_rows, merged_deleted_ids, previous_cleared
+
+def write_user_rows(changed_rows, deleted_ids, cleared, snapshot_seq, serializable_sessions):
+    """
+    ユーザーの行をシリアライズしてデータベースに書き込む (ワーカースレッドで実行)。
+    オートRNGセッションの進捗も同じトランザクションで書き込み、ユーザーの行と食い違わないようにする
+    (スナップショットに取り込まれたジャーナルのまとめ抽選の記録は、この後削除されて再生できなくなるため)。
+    書き込み後、スナップショットに取り込まれたジャーナルを削除する。
+    失敗した場合は行を覚えておき、次の書き込みに含める (それまでジャーナルは削除しない)。
+    """
+    global snapshot_item_ids, unwritten_user_rows
+    changed_rows, deleted_ids, cleared = merge_unwritten_user_rows(changed_rows, deleted_ids, cleared)
+    connection = get_storage_writer_connection()
+    try:
+        serialized_rows, new_item_names = encode_user_rows(connection, changed_rows)
+        with connection: # 変更分を1回のトランザクションでまとめて書き込む
+            if cleared:
+                connection.execute("DELETE FROM users")
+            connection.executemany("INSERT INTO item_names (item_id, name) VALUES (?, ?)", new_item_names)
+            connection.executemany("DELETE FROM users WHERE user_id = ?", [(uid,) for uid in deleted_ids])
+            connection.executemany("INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)", serialized_rows)
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('journal_seq', ?)", (str(snapshot_seq),))
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('user_data_schema_version', ?)", (str(USER_DATA_SCHEMA_VERSION),))
+            write_auto_rng_session_rows(connection, serializable_sessions)
+    except Exception:
+        snapshot_item_ids = None # 割り当てたIDは保存されていないので、次回はテーブルから読み直す
+        unwritten_user_rows = (changed_rows, deleted_ids, cleared)
+        raise
+    unwritten_user_rows = None
+    saved_auto_rng_session_ids.clear()
+    saved_auto_rng_session_ids.update(serializable_sessions.keys())
+
+    for path, last_seq in list_rotated_journals():
+        if last_seq <= snapshot_seq:
+            os.remove(path)
+
 def save_user_data():
-    """ユーザーデータをJSONファイルに保存する"""
-    # on_message内でロックを取得していないため、ここではロック不要
-    # ただし、user_data_lockは他の非同期タスク（例: ステータス更新）で使用される
-    with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(user_data, f, ensure_ascii=False, indent=4)
+    """
+    変更・削除されたユーザーのスナップショットを取り、ワーカースレッドで保存する。
+    保存するものがなければNone、あれば書き込み完了を待つためのFutureを返す。
+    """
+    # await を挟まずにコピーを取るため、ロックは不要
+    global user_data_cleared
+    if not (dirty_user_ids or deleted_user_ids or user_data_cleared or unwritten_user_rows is not None):
+        return None
+
+    stall_start = time.perf_counter()
+    changed_rows = {uid: copy_json_value(user_data[uid]) for uid in dirty_user_ids if uid in user_data}
+    deleted_ids = tuple(deleted_user_ids)
+    cleared = user_data_cleared
+    dirty_user_ids.clear()
+    deleted_user_ids.clear()
+    user_data_cleared = False
+    serializable_sessions = snapshot_auto_rng_sessions() # ユーザーの行と同じ時点の進捗
+    # ここまでの差分はスナップショットに含まれるので、ジャーナルを切り替えて書き込み後に削除する
+    rotate_journal()
+    record_storage_stall("user_data", time.perf_counter() - stall_start, len(changed_rows) + len(deleted_ids) + len(serializable_sessions))
+
+    return submit_storage_write("user_data", write_user_rows, changed_rows, deleted_ids, cleared, journal_seq, serializable_sessions)
+
+async def user_data_flusher():
+    """保存待ちのユーザーデータを一定間隔ごと、または一定数たまった時点でまとめて保存するタスク"""
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        try:
+            await asyncio.wait_for(user_data_flush_requested.wait(), timeout=USER_DATA_FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        user_data_flush_requested.clear()
+        try:
+            future = save_user_data()
+            if future is not None:
+                await asyncio.wrap_future(future)
+        except Exception as e:
+            print(f"ERROR: ユーザーデータの保存中にエラーが発生しました: {e}")
+            import traceback
+            traceback.print_exc()
+
+def ensure_user_data_flusher():
+    """ユーザーデータの保存タスクが動いていなければ開始する"""
+    global user_data_flusher_task
+    if user_data_flusher_task is None or user_data_flusher_task.done():
+        user_data_flusher_task = bot.loop.create_task(user_data_flusher())
+
+def flush_all_data():
+    """保存待ちのデータをすべて保存する (切断時・終了時の強制保存)。書き込みのFutureのリストを返す"""
+    if not bot_initialized:
+        return [] # 読み込みが済んでいない (失敗した) データで保存済みのデータを上書きしない
+    futures = [save_user_data(), save_bot_settings(), save_auto_rng_sessions()]
+    return [future for future in futures if future is not None]
 
 def load_user_data():
-    """JSONファイルからユーザーデータを読み込む"""
-    global user_data
-    if os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
-            try:
-                user_data = json.load(f)
-            except json.JSONDecodeError as e:
-                print(f"ERROR: user_data.jsonの読み込み中にエラーが発生しました: {e}")
-                print("既存のuser_data.jsonをバックアップし、新しく空のデータを作成します。")
-                if os.path.exists(USER_DATA_FILE):
-                    os.rename(USER_DATA_FILE, USER_DATA_FILE + ".bak." + datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
-                user_data = {} # エラー時は空のデータで初期化
-                save_user_data() # 空のデータを保存
-    else:
-        user_data = {}
+    """
+    データベースのスナップショットからユーザーデータを読み込み、ジャーナルの差分を再生する。
+    オートRNGセッションの進捗も再生するため、load_auto_rng_sessions の後に呼ぶこと。
+    """
+    global user_data, journal_seq, journal_entries_since_rotation
+    connection = get_db_connection()
+    item_names = load_item_names(connection)
+    user_data = {}
+    for user_id, data in connection.execute("SELECT user_id, data FROM users"):
+        try:
+            user_data[user_id] = decode_user_record(data, item_names)
+        except (ValueError, KeyError, struct.error) as e:
+            print(f"ERROR: ユーザーID {user_id} のデータの読み込み中にエラーが発生しました: {e}")
+            continue
+        if isinstance(data, str):
+            mark_user_dirty(user_id) # JSONのテキストで保存されている行は次回の保存でバイナリ形式に書き直す
+
+    # ジャーナルの差分は常に最新のスキーマで書かれているので、再生の前にスナップショットを移行しておく
+    row = connection.execute("SELECT value FROM meta WHERE key = 'user_data_schema_version'").fetchone()
+    schema_version = int(row[0]) if row else 0
+    if schema_version < USER_DATA_SCHEMA_VERSION:
+        migrate_user_data(schema_version)
+
+    row = connection.execute("SELECT value FROM meta WHERE key = 'journal_seq'").fetchone()
+    snapshot_seq = int(row[0]) if row else 0
+    replayed_count, journal_seq, journal_entries_since_rotation = replay_journal(snapshot_seq)
+    if replayed_count:
+        print(f"ジャーナルから{replayed_count}件の変更を再生しました。")
+    rebuild_server_totals()
+
+def migrate_user_data(from_version):
+    """全ユーザーのデータを最新のスキーマに移行する。変更されたユーザーは次回の保存で書き直す"""
+    migrated_count = 0
+    for user_id, data in user_data.items():
+        if migrate_user_record(data, from_version):
+            mark_user_dirty(user_id)
+            migrated_count += 1
+    print(f"ユーザーデータをスキーマ v{from_version} から v{USER_DATA_SCHEMA_VERSION} に移行しました。({migrated_count}件を更新)")
+
+def write_bot_settings(settings):
+    """ボット設定をデータベースに書き込む (ワーカースレッドで実行)"""
+    connection = get_storage_writer_connection()
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value, ensure_ascii=False)) for key, value in settings.items()]
+        )
 
 def save_bot_settings():
-    """ボット設定をJSONファイルに保存する"""
-    with open(BOT_SETTINGS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(bot_settings, f, ensure_ascii=False, indent=4)
+    """ボット設定のスナップショットを取り、ワーカースレッドで保存する"""
+    stall_start = time.perf_counter()
+    settings = copy_json_value(bot_settings)
+    record_storage_stall("bot_settings", time.perf_counter() - stall_start, len(settings))
+    return submit_storage_write("bot_settings", write_bot_settings, settings)
 
 def load_bot_settings():
-    """JSONファイルからボット設定を読み込む"""
+    """データベースからボット設定を読み込む"""
     global bot_settings
-    if os.path.exists(BOT_SETTINGS_FILE):
-        with open(BOT_SETTINGS_FILE, 'r', encoding='utf-8') as f:
-            try:
-                bot_settings = json.load(f)
-            except json.JSONDecodeError as e:
-                print(f"ERROR: bot_settings.jsonの読み込み中にエラーが発生しました: {e}")
-                print("既存のbot_settings.jsonをバックアップし、新しく空のデータを作成します。")
-                if os.path.exists(BOT_SETTINGS_FILE):
-                    os.rename(BOT_SETTINGS_FILE, BOT_SETTINGS_FILE + ".bak." + datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
-                bot_settings = {"notification_channel_id": None} # エラー時は空のデータで初期化
-                save_bot_settings() # 空のデータを保存
-    else:
-        bot_settings = {"notification_channel_id": None} # 初期設定
+    bot_settings = {"notification_channel_id": None, "global_luck_boosts": []} # 初期設定
+    for key, value in get_db_connection().execute("SELECT key, value FROM bot_settings"):
+        bot_settings[key] = json.loads(value)
+    invalidate_global_luck()
+
+def write_auto_rng_session_rows(connection, serializable_sessions):
+    """トランザクションの中で、終了したセッションの行を削除し、実行中のセッションを書き込む (ワーカースレッドで実行)"""
+    connection.executemany("DELETE FROM auto_rng_sessions WHERE user_id = ?", [(uid,) for uid in saved_auto_rng_session_ids - serializable_sessions.keys()])
+    connection.executemany(
+        "INSERT OR REPLACE INTO auto_rng_sessions (user_id, data) VALUES (?, ?)",
+        [(uid, json.dumps(session_data, ensure_ascii=False)) for uid, session_data in serializable_sessions.items()]
+    )
 
-def save_auto_rng_sessions():
-    """オートRNGセッションデータをJSONファイルに保存する"""
+def write_auto_rng_sessions(serializable_sessions):
+    """オートRNGセッションをデータベースに書き込む (ワーカースレッドで実行)"""
+    connection = get_storage_writer_connection()
+    with connection:
+        write_auto_rng_session_rows(connection, serializable_sessions)
+    saved_auto_rng_session_ids.clear()
+    saved_auto_rng_session_ids.update(serializable_sessions.keys())
+    print("オートRNGセッションデータを保存しました。")
+
+def snapshot_auto_rng_sessions():
+    """オートRNGセッションデータの保存用のコピーを取る"""
     serializable_sessions = {}
     for user_id, session_data in auto_rng_sessions.items():
         serializable_sessions[user_id] = {
-            "found_items_log": session_data["found_items_log"], # ここは辞書型で保存
+            "found_items_log": dict(session_data["found_items_log"]), # ここは辞書型で保存
             "start_time": session_data["start_time"].timestamp(), # datetimeをtimestampに変換
-            "max_duration_seconds": session_data["max_duration_seconds"] # durationも保存
+            "max_duration_seconds": session_data["max_duration_seconds"], # durationも保存
+            "materialized_until": session_data["materialized_until"], # 抽選済みの時刻
+            "rolls_credited": session_data["rolls_credited"] # 抽選済みのロール数
         }
-    with open(AUTO_RNG_SESSIONS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(serializable_sessions, f, ensure_ascii=False, indent=4)
-    print("オートRNGセッションデータを保存しました。")
+    return serializable_sessions
+
+def save_auto_rng_sessions():
+    """オートRNGセッションデータのスナップショットを取り、ワーカースレッドで保存する"""
+    stall_start = time.perf_counter()
+    serializable_sessions = snapshot_auto_rng_sessions()
+    record_storage_stall("auto_rng_sessions", time.perf_counter() - stall_start, len(serializable_sessions))
+    return submit_storage_write("auto_rng_sessions", write_auto_rng_sessions, serializable_sessions)
 
 def load_auto_rng_sessions():
-    """JSONファイルからオートRNGセッションデータを読み込む"""
+    """データベースからオートRNGセッションデータを読み込む"""
     global auto_rng_sessions
-    if os.path.exists(AUTO_RNG_SESSIONS_FILE):
-        with open(AUTO_RNG_SESSIONS_FILE, 'r', encoding='utf-8') as f:
+    auto_rng_sessions = {}
+    for user_id, data in get_db_connection().execute("SELECT user_id, data FROM auto_rng_sessions"):
+        try:
+            session_data = json.loads(data)
+        except json.JSONDecodeError as e:
+            print(f"ERROR: ユーザーID {user_id} のオートRNGセッションの読み込み中にエラーが発生しました: {e}")
+            continue
+        # タイムゾーン情報を持つdatetimeオブジェクトとしてロード
+        auto_rng_sessions[user_id] = {
+            "user": None, # ユーザーはon_readyでの再開時に設定されるのでNone
+            "found_items_log": session_data["found_items_log"], # 辞書型としてロード
+            "start_time": datetime.datetime.fromtimestamp(session_data["start_time"], tz=datetime.timezone.utc), # 修正: UTCタイムゾーンを明示的に設定
+            "max_duration_seconds": session_data["max_duration_seconds"],
+            # 古いファイルには抽選済み情報がないため、停止中の分は加算せずに読み込み時刻から数え直す
+            "materialized_until": session_data.get("materialized_until", min(time.time(), session_data["start_time"] + session_data["max_duration_seconds"])),
+            "rolls_credited": session_data.get("rolls_credited", 0),
+            "next_materialize": 0, # 再開時に設定される
+            "awaiting_resume": True # on_readyでの再開待ち (スケジューラは処理しない)
+        }
+    saved_auto_rng_session_ids.clear()
+    saved_auto_rng_session_ids.update(auto_rng_sessions.keys())
+    print("オートRNGセッションデータをロードしました。")
+
+def export_user_data_json(path):
+    """ユーザーデータ (ジャーナル再生後) を旧形式と同じJSONファイルに書き出す"""
+    load_auto_rng_sessions()
+    load_user_data()
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(user_data, f, indent=4, ensure_ascii=False)
+    print(f"{len(user_data)}人分のユーザーデータを {path} に書き出しました。")
+
+def import_user_data_json(path):
+    """JSONファイルのユーザーデータでデータベースのユーザーデータを置き換える"""
+    global user_data
+    load_auto_rng_sessions()
+    load_user_data()
+    with open(path, 'r', encoding='utf-8') as f:
+        imported_user_data = json.load(f)
+    user_data = imported_user_data
+    for data in user_data.values():
+        migrate_user_record(data, 0) # 古い形式のファイルも最新のスキーマにそろえる
+    mark_all_users_deleted()
+    for user_id in user_data:
+        mark_user_dirty(user_id)
+    save_user_data().result()
+    print(f"{path} から{len(user_data)}人分のユーザーデータを読み込みました。")
+
+def benchmark_snapshot_formats(user_counts=(10000, 100000)):
+    """旧形式のJSONファイル、行ごとのJSON、行ごとのバイナリ形式で、保存・読み込み時間とサイズを比較する"""
+    import tempfile
+    potion_names = list(LUCK_POTION_EFFECTS)
+    item_names_pool = list(rare_item_chances_denominator)
+    for user_count in user_counts:
+        sample_user_data = {}
+        for index in range(user_count):
+            sample_user_data[str(100000000000000000 + index)] = {
+                "rolls": random.randint(0, 1000000),
+                "luck": 1.0,
+                "inventory": {item: random.randint(1, 5000) for item in random.sample(item_names_pool, random.randint(5, 25))},
+                "luck_potions": {potion: random.randint(1, 3) for potion in random.sample(potion_names, random.randint(0, 2))},
+                "active_luck_potion_uses": {},
+                "daily_login": {
+                    "last_login_date": "2025-07-01",
+                    "consecutive_days": random.randint(0, 30),
+                    "active_boost": {"multiplier": 1.0, "end_time": None}
+                },
+                "admin_boost": {"multiplier": 1.0, "end_time": None}
+            }
+
+        with tempfile.TemporaryDirectory() as directory:
+            results = []
+
+            json_path = os.path.join(directory, "user_data.json")
+            start = time.perf_counter()
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(sample_user_data, f, indent=4, ensure_ascii=False)
+            save_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            with open(json_path, 'r', encoding='utf-8') as f:
+                json.load(f)
+            results.append(("JSON file (indent=4)", save_seconds, time.perf_counter() - start, os.path.getsize(json_path)))
+
+            for label, binary in (("SQLite rows (JSON)", False), ("SQLite rows (binary)", True)):
+                db_path = os.path.join(directory, f"{binary}.db")
+                connection = sqlite3.connect(db_path)
+                connection.execute("CREATE TABLE users (user_id TEXT PRIMARY KEY, data NOT NULL)")
+                connection.execute("CREATE TABLE item_names (item_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+                start = time.perf_counter()
+                with connection:
+                    if binary:
+                        item_ids, new_item_names = {}, []
+                        rows = [(uid, encode_user_record(data, item_ids, new_item_names)) for uid, data in sample_user_data.items()]
+                        connection.executemany("INSERT INTO item_names (item_id, name) VALUES (?, ?)", new_item_names)
+                    else:
+                        rows = [(uid, json.dumps(data, ensure_ascii=False)) for uid, data in sample_user_data.items()]
+                    connection.executemany("INSERT INTO users (user_id, data) VALUES (?, ?)", rows)
+                save_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                item_names = load_item_names(connection)
+                loaded = {uid: decode_user_record(data, item_names) for uid, data in connection.execute("SELECT user_id, data FROM users")}
+                load_seconds = time.perf_counter() - start
+                assert loaded == sample_user_data
+                connection.close()
+                results.append((label, save_seconds, load_seconds, os.path.getsize(db_path)))
+
+        print(f"--- {user_count:,} users ---")
+        for label, save_seconds, load_seconds, size in results:
+            print(f"{label:<22} save {save_seconds * 1000:8.1f}ms  load {load_seconds * 1000:8.1f}ms  size {size / 1024 / 1024:7.2f}MB")
+
+
+# --- 全体ラックブースト (!boostluck) ---
+# 全員に効くブーストはユーザーごとのデータに書き込まず、ボット設定に1つのリストとして保存する。
+# ラックの計算はこのリストを参照するので、開始・終了の手間はユーザー数によらず、再起動後も続く。
+# ブーストは重ねがけでき (倍率を掛け合わせる)、開始時刻を未来にして予約もできる。
+#   bot_settings["global_luck_boosts"]: [{"multiplier": 倍率, "start_time": 開始 (UNIX時刻), "end_time": 終了 (UNIX時刻),
+#                                         "channel_id": 開始・終了を知らせるチャンネル}, ...]
+global_luck_boost_cache = None # (区間の開始, 区間の終了, 倍率): 次にブーストが切り替わるまで倍率を使い回す
+global_luck_version = 0 # 全体ラックブーストを変更するたびに増やす (実効ラックのキャッシュの無効化に使う)
+
+def prune_global_luck_boosts(boosts, now_timestamp):
+    """
+    終了済みのブーストを取り除いたリストを返す。
+    オートRNGの未抽選のロールにかかるブーストは、終了していても抽選が済むまで残す (まとめ抽選がこの記録から区間を計算するため)。
+    """
+    keep_after = min([now_timestamp, *(session_data["materialized_until"] for session_data in auto_rng_sessions.values())])
+    return [boost for boost in boosts if boost["end_time"] > keep_after]
+
+def add_global_luck_boost(multiplier, start_time, end_time, channel_id):
+    """全体ラックブーストを追加して保存し、開始・終了を予定表に登録する。終了済みのブーストはここで取り除く"""
+    boosts = prune_global_luck_boosts(bot_settings["global_luck_boosts"], time.time())
+    boost = {"multiplier": multiplier, "start_time": start_time, "end_time": end_time, "channel_id": channel_id}
+    boosts.append(boost)
+    bot_settings["global_luck_boosts"] = boosts
+    invalidate_global_luck()
+    save_bot_settings()
+    schedule_global_luck_boost_events(boost)
+    return boost
+
+def remove_global_luck_boost(boost):
+    """終了した全体ラックブーストを (オートRNGの抽選が済んでいれば) 取り除いて保存する"""
+    bot_settings["global_luck_boosts"] = prune_global_luck_boosts(bot_settings["global_luck_boosts"], time.time())
+    invalidate_global_luck()
+    save_bot_settings()
+
+def clear_global_luck_boosts():
+    """
+    実行中・予約中の全体ラックブーストをすべて取り消して保存する。取り消した件数を返す。
+    実行中のブーストは記録を消さずに終了時刻を今に縮め、それまでの未抽選のロールにはブーストがかかるようにする。
+    """
+    now_timestamp = time.time()
+    cancelled_count = 0
+    boosts = []
+    for boost in bot_settings["global_luck_boosts"]:
+        if boost["end_time"] <= now_timestamp:
+            boosts.append(boost) # 終了済み
+            continue
+        cancelled_count += 1
+        if boost["start_time"] < now_timestamp:
+            boost["end_time"] = now_timestamp # 実行中 (予定表の終了の予定は読み飛ばされる)
+            boosts.append(boost)
+    bot_settings["global_luck_boosts"] = prune_global_luck_boosts(boosts, now_timestamp)
+    invalidate_global_luck()
+    save_bot_settings()
+    return cancelled_count
+
+def global_luck_multiplier(timestamp):
+    """その時刻に有効な全体ラックブーストの倍率 (重なっている分は掛け合わせる)"""
+    global global_luck_boost_cache
+    if global_luck_boost_cache is not None and global_luck_boost_cache[0] <= timestamp < global_luck_boost_cache[1]:
+        return global_luck_boost_cache[2]
+    multiplier = 1.0
+    window_start, window_end = -math.inf, math.inf
+    for boost in bot_settings["global_luck_boosts"]:
+        if boost["start_time"] <= timestamp < boost["end_time"]:
+            multiplier *= boost["multiplier"]
+        # 倍率が変わらない区間を、timestamp を挟む最も近い開始・終了時刻までに絞る
+        for edge in (boost["start_time"], boost["end_time"]):
+            if edge <= timestamp:
+                window_start = max(window_start, edge)
+            else:
+                window_end = min(window_end, edge)
+    global_luck_boost_cache = (window_start, window_end, multiplier)
+    return multiplier
+
+def invalidate_global_luck():
+    """全体ラックブーストが変わったら、全体の倍率と全ユーザーの実効ラックのキャッシュを無効にする (O(1))"""
+    global global_luck_boost_cache, global_luck_version
+    global_luck_boost_cache = None
+    global_luck_version += 1
+
+def active_global_luck_boosts(timestamp):
+    """その時刻に有効な全体ラックブーストの一覧"""
+    return [boost for boost in bot_settings["global_luck_boosts"] if boost["start_time"] <= timestamp < boost["end_time"]]
+
+# --- 実効ラックの計算 ---
+# ユーザーごとに「基本ラック x デイリーログインブースト x 管理者ブースト x 全体ブースト」と、
+# 次に使うポーションをキャッシュする。キャッシュは次の場合に作り直す。
+#   - ユーザーのブースト・ポーションのキューが変わった (journal_user_fields / apply_user_delta がユーザーの版を上げる)
+#   - 全体ラックブーストが変わった (global_luck_version)
+#   - キャッシュした値が有効な時刻を過ぎた (ブーストの終了・全体ブーストの切り替わり)
+effective_luck_versions = {} # ユーザーID -> 版
+effective_luck_cache = {} # ユーザーID -> (ユーザーの版, 全体の版, 有効期限, ブースト込みのラック, ポーションの内部名, ポーションの倍率)
+
+def invalidate_effective_luck(user_id):
+    """ユーザーのブースト・ポーションのキューが変わったら版を上げる"""
+    effective_luck_versions[user_id] = effective_luck_versions.get(user_id, 0) + 1
+
+def resolve_effective_luck(user_id, now_timestamp):
+    """
+    (ブースト込みのラック, 次に使うポーションの内部名 (なければNone), ポーションの倍率) を返す。
+    ロールのラックは ブースト込みのラック x ポーションの倍率。
+    """
+    user_version = effective_luck_versions.get(user_id, 0)
+    cached = effective_luck_cache.get(user_id)
+    if cached is not None and cached[0] == user_version and cached[1] == global_luck_version and now_timestamp < cached[2]:
+        return cached[3], cached[4], cached[5]
+
+    data = user_data[user_id]
+    boosted_luck = data["luck"] # ユーザーの基本ラック (通常は1.0)
+    valid_until = math.inf
+    for boost in (data["daily_login"]["active_boost"], data["admin_boost"]):
+        if boost["end_time"] and now_timestamp < boost["end_time"]:
+            boosted_luck *= boost["multiplier"]
+            valid_until = min(valid_until, boost["end_time"])
+    boosted_luck *= global_luck_multiplier(now_timestamp) # 全体ラックブースト
+    valid_until = min(valid_until, global_luck_boost_cache[1])
+
+    # 使用待ちのポーションのうち、最も倍率の高いもの
+    potion_name, potion_multiplier = None, 1.0
+    active_uses = data["active_luck_potion_uses"]
+    for internal_name, multiplier_value in LUCK_POTION_PRIORITY:
+        if active_uses.get(internal_name, 0) > 0:
+            potion_name, potion_multiplier = internal_name, multiplier_value
+            break
+
+    effective_luck_cache[user_id] = (user_version, global_luck_version, valid_until, boosted_luck, potion_name, potion_multiplier)
+    return boosted_luck, potion_name, potion_multiplier
+
+
+# --- 送信キュー ---
+# チャンネルへの送信はチャンネルごとのキューに入れ、トークンバケットで間隔を空けて送る
+# (Discordの429で送信側が止まらないように、バケットが空なら送る前にこちらで待つ)。
+# コマンドへの返信は優先レーンに入れ、通知より先に送る。
+OUTBOUND_BURST = 5 # 続けて送れる数 (バケットの容量)
+OUTBOUND_RATE_PER_SECOND = 1.0 # バケットに1秒あたり補充される数
+outbound_queues = {} # チャンネルID -> {"priority": deque, "normal": deque, "tokens": float, "refilled_at": float, "task": Task}
+
+def enqueue_outbound(channel, content=None, embed=None, priority=False):
+    """送信をキューに入れ、送信したメッセージ (または例外) が入るFutureを返す"""
+    queue = outbound_queues.get(channel.id)
+    if queue is None:
+        queue = outbound_queues[channel.id] = {
+            "priority": collections.deque(), "normal": collections.deque(),
+            "tokens": float(OUTBOUND_BURST), "refilled_at": time.monotonic(), "task": None,
+        }
+    future = asyncio.get_running_loop().create_future()
+    queue["priority" if priority else "normal"].append((channel, content, embed, future))
+    if queue["task"] is None or queue["task"].done():
+        queue["task"] = bot.loop.create_task(drain_outbound_queue(queue))
+    return future
+
+async def send_reply(channel, content=None, embed=None):
+    """コマンドへの返信を優先レーンで送り、送信したメッセージを返す (送信に失敗したら例外)"""
+    return await enqueue_outbound(channel, content, embed, priority=True)
+
+def send_in_background(channel, content=None, embed=None):
+    """通知を通常レーンに入れる。結果は待たず、失敗したらログに出す"""
+    def log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"WARNING: Could not send queued message to channel {channel.id}: {future.exception()}")
+    enqueue_outbound(channel, content, embed).add_done_callback(log_failure)
+
+async def drain_outbound_queue(queue):
+    """キューが空になるまで、バケットのトークンを1つずつ使って送信する (優先レーンから)"""
+    while queue["priority"] or queue["normal"]:
+        now = time.monotonic()
+        queue["tokens"] = min(OUTBOUND_BURST, queue["tokens"] + (now - queue["refilled_at"]) * OUTBOUND_RATE_PER_SECOND)
+        queue["refilled_at"] = now
+        if queue["tokens"] < 1:
+            await asyncio.sleep((1 - queue["tokens"]) / OUTBOUND_RATE_PER_SECOND)
+            continue
+
+        channel, content, embed, future = (queue["priority"] or queue["normal"]).popleft()
+        if future.cancelled():
+            continue # 待っていた側が取り消された
+        queue["tokens"] -= 1
+        try:
+            future.set_result(await channel.send(content, embed=embed))
+        except Exception as e:
+            if not future.cancelled():
+                future.set_exception(e)
+
+
+# --- ユーザー情報のキャッシュ ---
+# bot.fetch_user はHTTPリクエストなので、まずゲートウェイのキャッシュ (bot.get_user) を見て、
+# それでも見つからないユーザーだけを取得する。取得結果は有効期限付きで覚えておき、
+# 見つからなかったユーザー (NotFound) も短めの期限で覚えておく (ネガティブキャッシュ)。
+# 複数ユーザーの取得はセマフォで同時実行数を抑えつつ並行に行い、同じユーザーの取得が重なったら1回にまとめる。
+USER_CACHE_TTL_SECONDS = 600 # 取得したユーザーを覚えておく時間
+USER_CACHE_NOT_FOUND_TTL_SECONDS = 300 # 見つからなかったユーザーを覚えておく時間
+USER_FETCH_CONCURRENCY = 5 # bot.fetch_user の同時実行数
+user_cache = {} # ユーザーID(int) -> (ユーザー または None (見つからない), 有効期限)
+user_cache_stats = {"gateway_hits": 0, "cache_hits": 0, "fetches": 0, "not_found": 0, "errors": 0}
+user_fetch_semaphore = asyncio.Semaphore(USER_FETCH_CONCURRENCY)
+user_fetches_in_flight = {} # ユーザーID(int) -> 取得中のタスク
+USER_FETCH_FAILED = object() # 一時的なエラーで取得できなかった (見つからない None とは区別する)
+
+def user_cache_summary():
+    """キャッシュのヒット率を表示用の文字列で返す"""
+    hits = user_cache_stats["gateway_hits"] + user_cache_stats["cache_hits"]
+    lookups = hits + user_cache_stats["fetches"]
+    hit_rate = hits / lookups * 100 if lookups else 0.0
+    return (f"User cache: hit rate {hit_rate:.1f}% ({hits}/{lookups}, gateway {user_cache_stats['gateway_hits']}, "
+            f"cached {user_cache_stats['cache_hits']}), fetched {user_cache_stats['fetches']}, "
+            f"not found {user_cache_stats['not_found']}, errors {user_cache_stats['errors']}")
+
+async def resolve_user(user_id, report_failures=False):
+    """
+    ユーザーIDからユーザーを取得する。見つからない・取得に失敗した場合はNone。
+    report_failures=True なら、一時的なエラーで取得できなかった場合は None ではなく USER_FETCH_FAILED を返す。
+    """
+    user = await resolve_user_or_failure(int(user_id))
+    if user is USER_FETCH_FAILED and not report_failures:
+        return None
+    return user
+
+async def resolve_user_or_failure(user_id):
+    """resolve_user の本体。一時的なエラーは USER_FETCH_FAILED で返す"""
+    user = bot.get_user(user_id)
+    if user is not None:
+        user_cache_stats["gateway_hits"] += 1
+        return user
+    cached = user_cache.get(user_id)
+    if cached is not None and cached[1] > time.monotonic():
+        user_cache_stats["cache_hits"] += 1
+        return cached[0]
+
+    fetch_task = user_fetches_in_flight.get(user_id)
+    if fetch_task is not None:
+        user_cache_stats["cache_hits"] += 1 # 取得中のものを待つだけなのでヒット扱い
+        return await asyncio.shield(fetch_task)
+    user_cache_stats["fetches"] += 1
+    fetch_task = asyncio.ensure_future(fetch_user_into_cache(user_id))
+    user_fetches_in_flight[user_id] = fetch_task
+    fetch_task.add_done_callback(lambda _: user_fetches_in_flight.pop(user_id, None))
+    return await asyncio.shield(fetch_task) # 待っている側が取り消されても、他の待ち手のために取得は続ける
+
+async def fetch_user_into_cache(user_id):
+    """bot.fetch_user でユーザーを取得し、結果をキャッシュに入れる (resolve_user_or_failure から呼ぶ)"""
+    async with user_fetch_semaphore:
+        try:
+            user = await bot.fetch_user(user_id)
+        except discord.NotFound:
+            user_cache_stats["not_found"] += 1
+            user_cache[user_id] = (None, time.monotonic() + USER_CACHE_NOT_FOUND_TTL_SECONDS)
+            return None
+        except Exception as e: # HTTPエラーのほか、再試行し尽くした接続エラー・タイムアウトもそのまま届く (取り消しは捕まえない)
+            user_cache_stats["errors"] += 1 # 一時的なエラーは覚えておかない
+            print(f"ERROR: Failed to fetch user {user_id}: {e}")
+            return USER_FETCH_FAILED
+    user_cache[user_id] = (user, time.monotonic() + USER_CACHE_TTL_SECONDS)
+    return user
+
+async def resolve_users(user_ids, report_failures=False):
+    """複数のユーザーをまとめて取得し、user_ids と同じ順のリストで返す (見つからないユーザーはNone)"""
+    users = await asyncio.gather(*(resolve_user(user_id, report_failures) for user_id in user_ids))
+    print(f"DEBUG: {user_cache_summary()}")
+    return users
+
+
+# --- 期限切れの予定表 ---
+# ブーストの終了 (デイリーログイン・管理者・全体) と予約した全体ブーストの開始を、期限の早い順に
+# 最小ヒープに並べ、1つのタスクが期限ちょうどに処理してお知らせを送る。
+# メッセージやロールのたびに期限を調べる必要はない。ヒープはメモリ上だけにあり、
+# 起動時に保存済みのユーザーデータとボット設定から作り直す。
+# 予定を取り消す代わりに、処理するときに対象の期限が変わっていないかを確かめる (古い予定は読み飛ばす)。
+EXPIRY_DAILY_BOOST = "daily_boost" # 対象: ユーザーID
+EXPIRY_ADMIN_BOOST = "admin_boost" # 対象: ユーザーID (以前のバージョンで書き込まれたユーザーごとの管理者ブースト)
+EXPIRY_GLOBAL_BOOST_START = "global_boost_start" # 対象: 全体ラックブーストの記録
+EXPIRY_GLOBAL_BOOST_END = "global_boost_end" # 対象: 全体ラックブーストの記録
+EXPIRY_NOTICE_GRACE_SECONDS = 300 # これより前に期限が来ていた予定は、お知らせを送らずに処理だけする (停止中に切れたブーストなど)
+expiry_heap = [] # (期限 (UNIX時刻), 通し番号, 種類, 対象)
+expiry_sequence = itertools.count() # 期限が同じ予定の順序づけ (対象同士を比較しないため)
+expiry_wakeup = asyncio.Event() # より早い予定が追加されたときにタスクを起こす
+expiry_scheduler_task = None
+
+def schedule_expiry(due_timestamp, kind, target):
+    """予定を追加する。いちばん早い予定になったらタスクを起こす"""
+    heapq.heappush(expiry_heap, (due_timestamp, next(expiry_sequence), kind, target))
+    if expiry_heap[0][0] == due_timestamp:
+        expiry_wakeup.set()
+
+def schedule_global_luck_boost_events(boost):
+    """全体ラックブーストの開始 (予約の場合) と終了を予定表に登録する"""
+    if boost["start_time"] > time.time():
+        schedule_expiry(boost["start_time"], EXPIRY_GLOBAL_BOOST_START, boost)
+    schedule_expiry(boost["end_time"], EXPIRY_GLOBAL_BOOST_END, boost)
+
+def rebuild_expiry_heap():
+    """保存済みのユーザーデータとボット設定から予定表を作り直す (起動時に1回だけ)"""
+    expiry_heap.clear()
+    for user_id, data in user_data.items():
+        daily_end_time = data["daily_login"]["active_boost"]["end_time"]
+        if daily_end_time:
+            expiry_heap.append((daily_end_time, next(expiry_sequence), EXPIRY_DAILY_BOOST, user_id))
+        admin_end_time = data["admin_boost"]["end_time"]
+        if admin_end_time:
+            expiry_heap.append((admin_end_time, next(expiry_sequence), EXPIRY_ADMIN_BOOST, user_id))
+    heapq.heapify(expiry_heap)
+    for boost in bot_settings["global_luck_boosts"]:
+        schedule_global_luck_boost_events(boost)
+    expiry_wakeup.set()
+
+async def fire_expiry(due_timestamp, kind, target):
+    """
+    期限が来た予定を1件処理する。お知らせがあれば (送り先, 本文) を返す。
+    送り先は ("user", ユーザーID) または ("channel", チャンネルID)。
+    """
+    if kind == EXPIRY_DAILY_BOOST or kind == EXPIRY_ADMIN_BOOST:
+        async with user_lock(target):
+            data = user_data.get(target)
+            if data is None:
+                return None # 削除済みのユーザー
+            if kind == EXPIRY_DAILY_BOOST:
+                user_boost = data["daily_login"]["active_boost"]
+                if user_boost["end_time"] != due_timestamp:
+                    return None # 再ログインで延長された
+                materialize_auto_rng_rolls_before_luck_change(target)
+                # Luckはここで元に戻さない。perform_rollで都度計算される
+                user_boost["multiplier"] = 1.0
+                user_boost["end_time"] = None
+                journal_user_fields(target, "daily_login")
+                return ("user", target), "一時的なラックブーストが終了しました。"
+            admin_boost_info = data["admin_boost"]
+            if admin_boost_info["end_time"] != due_timestamp:
+                return None
+            materialize_auto_rng_rolls_before_luck_change(target)
+            data["luck"] = 1.0 # 基本ラックを1.0に戻す
+            admin_boost_info["multiplier"] = 1.0
+            admin_boost_info["end_time"] = None
+            journal_user_fields(target, "luck", "admin_boost")
+            return ("user", target), "管理者ラックブーストが終了し、元のラックに戻りました。"
+
+    if not any(boost is target for boost in bot_settings["global_luck_boosts"]):
+        return None # 取り消された
+    if kind == EXPIRY_GLOBAL_BOOST_START:
+        return ("channel", target.get("channel_id")), f"予約されていた全体ラックブースト (**{target['multiplier']:.1f}倍**) が始まりました！"
+    if target["end_time"] != due_timestamp:
+        return None # 取り消しで終了時刻が縮められた
+    remove_global_luck_boost(target)
+    return ("channel", target.get("channel_id")), f"全体ラックブースト (**{target['multiplier']:.1f}倍**) が終了しました。"
+
+async def send_expiry_notice(destination, text):
+    """予定表のお知らせを送る (ユーザーにはDM、全体ブーストは !boostluck を実行したチャンネル)"""
+    destination_kind, destination_id = destination
+    try:
+        if destination_kind == "user":
+            user = await resolve_user(destination_id)
+            if user is not None:
+                await user.send(text)
+        else:
+            channel = bot.get_channel(destination_id)
+            if channel is not None:
+                send_in_background(channel, text)
+    except Exception as e:
+        print(f"WARNING: Could not send expiry notice to {destination_kind} {destination_id}: {e}")
+
+async def expiry_scheduler():
+    """期限の来た予定を順に処理し、お知らせはロックの外で送る"""
+    while not bot.is_closed():
+        expiry_wakeup.clear()
+        timeout = max(0.0, expiry_heap[0][0] - time.time()) if expiry_heap else None
+        try:
+            await asyncio.wait_for(expiry_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        now_timestamp = time.time()
+        notices = []
+        while expiry_heap and expiry_heap[0][0] <= now_timestamp:
+            due_timestamp, _, kind, target = heapq.heappop(expiry_heap)
             try:
-                loaded_sessions = json.load(f)
-                auto_rng_sessions = {}
-                for user_id, session_data in loaded_sessions.items():
-                    # タイムゾーン情報を持つdatetimeオブジェクトとしてロード
-                    auto_rng_sessions[user_id] = {
-                        "task": None, # taskは再起動時に再作成されるのでNone
-                        "found_items_log": session_data["found_items_log"], # 辞書型としてロード
-                        "start_time": datetime.datetime.fromtimestamp(session_data["start_time"], tz=datetime.timezone.utc), # 修正: UTCタイムゾーンを明示的に設定
-                        "max_duration_seconds": session_data["max_duration_seconds"]
-                    }
-                print("オートRNGセッションデータをロードしました。")
-            except json.JSONDecodeError as e:
-                print(f"ERROR: auto_rng_sessions.jsonの読み込み中にエラーが発生しました: {e}")
-                print("既存のauto_rng_sessions.jsonをバックアップし、新しく空のデータを作成します。")
-                if os.path.exists(AUTO_RNG_SESSIONS_FILE):
-                    os.rename(AUTO_RNG_SESSIONS_FILE, AUTO_RNG_SESSIONS_FILE + ".bak." + datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
-                auto_rng_sessions = {} # エラー時は空のデータで初期化
-                save_auto_rng_sessions() # 空のデータを保存
-    else:
-        auto_rng_sessions = {}
-        print("オートRNGセッションデータファイルが見つかりませんでした。")
+                notice = await fire_expiry(due_timestamp, kind, target)
+            except Exception as e:
+                print(f"ERROR: Failed to process expiry {kind} for {target}: {e}")
+                continue
+            if notice is not None and now_timestamp - due_timestamp <= EXPIRY_NOTICE_GRACE_SECONDS:
+                notices.append(notice)
+        for destination, text in notices:
+            await send_expiry_notice(destination, text)
+
+def ensure_expiry_scheduler():
+    """期限切れの予定表のタスクが動いていなければ開始する"""
+    global expiry_scheduler_task
+    if expiry_scheduler_task is None or expiry_scheduler_task.done():
+        expiry_scheduler_task = bot.loop.create_task(expiry_scheduler())
 
 
 # --- Botのステータスを更新する非同期タスク ---
+PRESENCE_UPDATE_INTERVAL_SECONDS = 20 # ステータス更新の最短間隔 (Discordのレート制限対策)
+
 async def update_total_rolls_status():
     await bot.wait_until_ready() # Botが完全に準備できるまで待機
 
+    displayed_activity_name = None # 最後に表示したステータス
     while not bot.is_closed(): # Botが閉じられていない間はループを続ける
-        total_rolls = 0
-        async with user_data_lock: # user_dataにアクセスする際はロックを取得
-            for user_id in user_data:
-                # user_data[user_id]が辞書であることを確認し、'rolls'キーが存在するかチェック
-                # .get() を使用して、キーが存在しない場合はデフォルト値 0 を返すようにする
-                total_rolls += user_data[user_id].get("rolls", 0)
-
-
-        # Botのステータスを更新
-        activity_name = f"{total_rolls:,} 回のロール！" # カンマ区切りで表示
-        await bot.change_presence(activity=discord.Game(name=activity_name))
-        print(f"Updated bot status to: {activity_name}")
-
-        await asyncio.sleep(20) # 20秒待機
+        # 総ロール数は差分で更新されている集計を参照する (ユーザー数によらず O(1))
+        activity_name = f"{server_total_rolls:,} 回のロール！" # カンマ区切りで表示
+        if activity_name != displayed_activity_name: # 表示が変わるときだけBotのステータスを更新
+            await bot.change_presence(activity=discord.Game(name=activity_name))
+            displayed_activity_name = activity_name
+            print(f"Updated bot status to: {activity_name}")
+
+        await asyncio.sleep(PRESENCE_UPDATE_INTERVAL_SECONDS)
+
+status_updater_task = None
+
+def ensure_status_updater():
+    """ステータス更新タスクが動いていなければ開始する"""
+    global status_updater_task
+    if status_updater_task is None or status_updater_task.done():
+        status_updater_task = bot.loop.create_task(update_total_rolls_status())
+
+def ensure_background_tasks():
+    """常駐タスク (期限切れの予定表・書き込み遅延・ステータス更新・オートRNG) が動いていなければ開始する"""
+    ensure_expiry_scheduler()
+    ensure_user_data_flusher()
+    ensure_status_updater()
+    if auto_rng_sessions:
+        ensure_auto_rng_scheduler()
 
 # --- イベントハンドラ ---
+RESUME_NOTICE_CONCURRENCY = 5 # 再開のお知らせDMの同時送信数
+AUTO_RNG_RESUME_RETRY_SECONDS = 60 # ユーザーの取得に一時的に失敗したセッションの再開を試し直す間隔
+bot_initialized = False # on_ready はゲートウェイに再接続するたびに呼ばれるので、初期化は1回だけ行う
+
 @bot.event
 async def on_ready():
+    global bot_initialized
+    if bot_initialized:
+        # メモリ上のデータのほうが新しいので読み込み直さず、止まっているタスクがあれば動かし直すだけ
+        print(f'再接続しました: {bot.user}')
+        ensure_background_tasks()
+        return
+
     print(f'ログイン完了: {bot.user}')
-    load_user_data()
-    load_bot_settings()
-    load_auto_rng_sessions() # オートRNGセッションデータをロード
-
-    print("ユーザーデータをロードしました。")
-    print("ボット設定をロードしました。")
-
-    # ロードしたオートRNGセッションのうち、まだ時間が残っているものを再開
-    current_time_utc = datetime.datetime.now(datetime.timezone.utc) # UTC時刻を使用
-    sessions_to_restart = []
-    for user_id in list(auto_rng_sessions.keys()): # ループ中に辞書を変更するため、keys()をリストに変換
-        session_data = auto_rng_sessions[user_id]
-        # start_timeはload_auto_rng_sessions()でdatetimeオブジェクトに戻されているので、そのまま比較
-        elapsed_time = (current_time_utc - session_data["start_time"]).total_seconds()
-        remaining_time = session_data["max_duration_seconds"] - elapsed_time
-
-        if remaining_time > 0:
-            sessions_to_restart.append(user_id)
-            # await user.send()はBotが準備できてからでないと送れない可能性があるので、タスク内でメッセージ送信
-        else:
-            # 既に終了時間を過ぎているセッションは削除
-            del auto_rng_sessions[user_id]
-            save_auto_rng_sessions() # 削除を反映して保存
+    # 読み込みには await を挟まないので、途中で再接続の on_ready が割り込むことはない
+    try:
+        load_bot_settings()
+        load_auto_rng_sessions() # オートRNGセッションデータをロード
+        load_user_data() # ジャーナルの再生でオートRNGセッションの進捗も更新するため最後にロード
+
+        print("ユーザーデータをロードしました。")
+        print("ボット設定をロードしました。")
+
+        # ブーストの期限切れの予定表を保存済みのデータから作り直す
+        rebuild_expiry_heap()
 
-    for user_id in sessions_to_restart:
-        # ユーザーオブジェクトを取得してタスクを再開
+        # 固定の埋め込みを作っておく
+        warm_static_embeds()
+    except Exception as e:
+        # 読み込みに失敗した状態ではコマンドも保存も行わず、次の on_ready (再接続) で読み込み直す
+        print(f"ERROR: データの読み込みに失敗しました。コマンドの受け付けと保存を止めています: {e}")
+        import traceback
+        traceback.print_exc()
+        return
+    bot_initialized = True # 読み込みが済んでから立てる
+    ensure_background_tasks() # 保存・期限切れの処理は、セッションの再開 (ユーザーの取得) を待たずに始める
+
+    # ロードしたオートRNGセッションを、ユーザーをまとめて並行に取得してから再開する。
+    # 停止中に経過した分 (セッションの終了時刻まで) は再開後のまとめ抽選の1間隔のうちに1回のまとめ抽選として加算され、
+    # 停止中に時間切れになったセッションはそのまま終了して結果がDMで送られる。
+    resumed_sessions, failed_session_ids = await resume_loaded_auto_rng_sessions(list(auto_rng_sessions.keys()))
+    if failed_session_ids:
+        bot.loop.create_task(retry_auto_rng_session_resume(failed_session_ids))
+    await send_resume_notices(resumed_sessions)
+
+async def resume_loaded_auto_rng_sessions(session_ids):
+    """
+    ロード済みのオートRNGセッションのユーザーを並行に取得して再開する。見つからないユーザーのセッションは削除する。
+    (再開したセッション [(ユーザー, 残り時間 (秒))], 一時的なエラーで取得できなかったユーザーID) を返す。
+    """
+    resumed_sessions = []
+    failed_session_ids = []
+    removed_session_count = 0
+    for index, (user_id, user) in enumerate(zip(session_ids, await resolve_users(session_ids, report_failures=True))):
+        if user is USER_FETCH_FAILED:
+            print(f"警告: ユーザーID {user_id} の取得に失敗しました。オートRNGセッションは残し、後で再開を試みます。")
+            failed_session_ids.append(user_id)
+            continue
+        if user is None:
+            print(f"警告: ユーザーID {user_id} が見つからないため、オートRNGセッションを再開できませんでした。セッションを削除します。")
+            auto_rng_sessions.pop(user_id, None) # 見つからないユーザーのセッションは削除
+            removed_session_count += 1
+            continue
         try:
-            user = await bot.fetch_user(int(user_id))
-            auto_rng_sessions[user_id]["task"] = bot.loop.create_task(auto_roll_task(user, is_resumed=True))
+            # 停止中の分のまとめ抽選は1間隔の中に散らし、全セッションが同じティックに集まらないようにする
+            remaining_time = resume_auto_rng_session(user, auto_rng_materialize_interval() * index / len(session_ids))
             print(f"User {user.name} ({user_id}) のオートRNGセッションを再開しました。")
-        except discord.NotFound:
-            print(f"警告: ユーザーID {user_id} が見つからないため、オートRNGセッションを再開できませんでした。セッションを削除します。")
-            if user_id in auto_rng_sessions:
-                del auto_rng_sessions[user_id] # 見つからないユーザーのセッションは削除
-            save_auto_rng_sessions()
+            if remaining_time > 0:
+                resumed_sessions.append((user, remaining_time))
         except Exception as e:
             print(f"ERROR: オートRNGセッション再開中にエラーが発生しました (ユーザーID: {user_id}): {e}")
-
-
-    # Botのステータス更新タスクを開始
-    bot.loop.create_task(update_total_rolls_status())
+    if removed_session_count:
+        save_auto_rng_sessions() # 削除をまとめて1回で保存
+    return resumed_sessions, failed_session_ids
+
+async def retry_auto_rng_session_resume(session_ids):
+    """ユーザーの取得に一時的に失敗したセッションの再開を、一定間隔で取得できるまで試し直す"""
+    while session_ids and not bot.is_closed():
+        await asyncio.sleep(AUTO_RNG_RESUME_RETRY_SECONDS)
+        # 待っている間に停止・削除されたセッションは除く
+        session_ids = [user_id for user_id in session_ids if user_id in auto_rng_sessions and auto_rng_sessions[user_id]["awaiting_resume"]]
+        if not session_ids:
+            return
+        resumed_sessions, session_ids = await resume_loaded_auto_rng_sessions(session_ids)
+        await send_resume_notices(resumed_sessions)
+
+async def send_resume_notices(resumed_sessions):
+    """再開のお知らせは同時送信数を抑えて並行に送る"""
+    notice_semaphore = asyncio.Semaphore(RESUME_NOTICE_CONCURRENCY)
+    async def send_resume_notice(user, remaining_time):
+        async with notice_semaphore:
+            try:
+                await user.send(f"オートRNGセッションを再開します。残り約 {remaining_time / 3600:.1f}時間です。停止中の分もまとめてロールされます。")
+            except Exception as e:
+                print(f"WARNING: Could not send auto-RNG resume message to {user.name}: {e}")
+    await asyncio.gather(*(send_resume_notice(user, remaining_time) for user, remaining_time in resumed_sessions))
 
 # BotがDiscordから切断された際に実行されるイベント
 # 予期せぬ切断の場合もデータを保存するようにする
 @bot.event
 async def on_disconnect():
     print("Bot disconnected. Attempting to save user data and auto RNG sessions...")
-    # ロックを取得してデータを安全に保存
-    async with user_data_lock:
-        save_user_data()
-    save_auto_rng_sessions() # オートRNGセッションも保存
+    # 保存待ちのデータを強制的に保存
+    futures = flush_all_data() # オートRNGセッションも保存
+    for future in futures:
+        try:
+            await asyncio.wrap_future(future)
+        except Exception:
+            pass # エラーは submit_storage_write で表示済み
     print("User data and auto RNG sessions saved on disconnect.")
 
 
@@ -294,18 +1615,34 @@ async def send_auto_rng_results(user: discord.User, found_items_log: dict, total
         await user.send(result_text)
 
 # --- ロール実行ロジックの共通化 ---
-def perform_roll(luck):
+# 抽選対象アイテムの並び順 (エイリアステーブルのインデックスと対応)
+ROLL_ITEMS = tuple(rare_item_chances_denominator.keys())
+ROLL_ITEM_DENOMINATORS = tuple(rare_item_chances_denominator[item] for item in ROLL_ITEMS)
+ROLL_ITEM_INDICES = tuple(range(len(ROLL_ITEMS)))
+
+# perform_rolls で使う乱数生成器 (NumPyがある場合のみ)
+numpy_rng = np.random.default_rng() if np is not None else None
+
+# ラック値ごとのエイリアステーブルを保持する件数 (LRU)
+# 通常ラック・デイリーログイン倍率・ポーション倍率などの頻出値はキャッシュに残り続ける
+ROLL_TABLE_CACHE_SIZE = 256
+
+# probabilities: 各アイテムの実効確率 (0.0 ～ 1.0)
+# alias_prob / alias_index: Vose のエイリアス法による抽選テーブル
+# display_denominators: 表示用のラック適用後の分母
+# normalized_probabilities / cumulative_weights: perform_rolls でのまとめ抽選用
+RollTable = collections.namedtuple("RollTable", [
+    "probabilities", "alias_prob", "alias_index", "display_denominators",
+    "normalized_probabilities", "cumulative_weights"
+])
+
+def calculate_effective_probabilities(luck):
     """
-    アイテムを抽選し、結果を返す。
-    必ず何かしらのアイテムがドロップするように保証する。
+    ラックを適用した各アイテムの確率 (0.0 ～ 1.0) をROLL_ITEMSの順で返す。
     Luckが高いほど、分母が小さくなる（出やすくなる）が、コモンアイテムには限定的な効果。
     """
-    items = list(rare_item_chances_denominator.keys())
-
-    effective_probabilities = {} # 各アイテムの確率 (0.0 ～ 1.0)
-    for item in items:
-        original_denominator = rare_item_chances_denominator[item]
-
+    effective_probabilities = []
+    for original_denominator in ROLL_ITEM_DENOMINATORS:
         # ラック適用後の分母を計算
         # レア度に応じてラックの影響度を変える
 
@@ -327,35 +1664,139 @@ def perform_roll(luck):
             # 計算上の分母は0割りを避けるために非常に小さい値に制限
             effective_denominator = max(0.0000000001, effective_denominator)
 
-        # 実際の抽選には確率(0～1)を使用する
-        effective_probabilities[item] = 1.0 / effective_denominator
-
         # 確率が1.0を超える場合は1.0に丸める (確定ドロップ)
-        if effective_probabilities[item] > 1.0:
-            effective_probabilities[item] = 1.0
+        effective_probabilities.append(min(1.0, 1.0 / effective_denominator))
 
-    # 重みを計算 (確率をそのまま使用)
-    weights = list(effective_probabilities.values())
+    return effective_probabilities
 
+def build_alias_table(weights):
+    """重みのリストからVoseのエイリアステーブル (alias_prob, alias_index) を構築する"""
+    n = len(weights)
+    total_weight = sum(weights)
     # 合計重みが0の場合のフォールバック (通常発生しない)
-    if sum(weights) == 0:
-        weights = [1.0] * len(items)
+    if total_weight <= 0:
+        weights = [1.0] * n
+        total_weight = float(n)
+
+    scaled = [weight * n / total_weight for weight in weights]
+    alias_prob = [0.0] * n
+    alias_index = list(range(n))
+    small = [i for i, value in enumerate(scaled) if value < 1.0]
+    large = [i for i, value in enumerate(scaled) if value >= 1.0]
+
+    while small and large:
+        small_i = small.pop()
+        large_i = large.pop()
+        alias_prob[small_i] = scaled[small_i]
+        alias_index[small_i] = large_i
+        scaled[large_i] = (scaled[large_i] + scaled[small_i]) - 1.0
+        if scaled[large_i] < 1.0:
+            small.append(large_i)
+        else:
+            large.append(large_i)
+
+    # 残りは浮動小数点誤差を含めて確率1として扱う
+    for i in large + small:
+        alias_prob[i] = 1.0
+        alias_index[i] = i
 
-    chosen_item = random.choices(items, weights=weights, k=1)[0]
+    return alias_prob, alias_index
+
+@functools.lru_cache(maxsize=ROLL_TABLE_CACHE_SIZE)
+def get_roll_table(luck):
+    """ラック値に対応する抽選テーブルを返す (ラック値ごとにLRUキャッシュされる)"""
+    probabilities = calculate_effective_probabilities(luck)
+    alias_prob, alias_index = build_alias_table(probabilities)
 
     # ★★★ 確率の表示: 小数点以下を切り捨て (floor) ★★★
-    # 表示用には、実質的な分母を計算し、1未満の場合は1と表示するロジックにする
-    display_denominator = 1.0 / effective_probabilities[chosen_item]
-    
-    # 計算上の分母が1未満の場合、表示上は1 in 1 とする
-    if display_denominator < 1.0:
-        display_denominator = 1 # 1未満なら1とする
+    # 表示用には、実質的な分母を計算し、1未満の場合は1と表示する
+    display_denominators = []
+    for probability in probabilities:
+        display_denominator = 1.0 / probability
+        if display_denominator < 1.0:
+            display_denominators.append(1) # 1未満なら1とする
+        else:
+            display_denominators.append(math.floor(display_denominator)) # 小数点以下を切り捨て
+
+    total_probability = sum(probabilities)
+    normalized_probabilities = tuple(probability / total_probability for probability in probabilities)
+    cumulative_weights = tuple(itertools.accumulate(probabilities))
+
+    return RollTable(
+        tuple(probabilities), tuple(alias_prob), tuple(alias_index), tuple(display_denominators),
+        normalized_probabilities, cumulative_weights
+    )
+
+def perform_roll(luck):
+    """
+    アイテムを抽選し、結果を返す。
+    必ず何かしらのアイテムがドロップするように保証する。
+    抽選はラック値ごとにキャッシュされたエイリアステーブルを使うため O(1)。
+    """
+    table = get_roll_table(luck)
+
+    # エイリアス法: 列を一様に選び、その列の確率で本体かエイリアスかを決める
+    column = int(random.random() * len(ROLL_ITEMS))
+    if random.random() < table.alias_prob[column]:
+        chosen_index = column
     else:
-        # 小数点以下を切り捨て
-        display_denominator = math.floor(display_denominator)
+        chosen_index = table.alias_index[column]
 
     # return chosen_item, display_denominator (ラック適用後の表示分母), original_denominator (元のアイテムの基本分母)
-    return chosen_item, display_denominator, rare_item_chances_denominator[chosen_item]
+    return ROLL_ITEMS[chosen_index], table.display_denominators[chosen_index], ROLL_ITEM_DENOMINATORS[chosen_index]
+
+def perform_rolls(luck, n):
+    """
+    n回分のロールをまとめて抽選し、アイテムごとの個数をROLL_ITEMSの順に並べたリストで返す。
+    NumPyがあれば多項分布から一度に抽選し、無ければ random.choices でまとめて抽選する。
+    """
+    if n <= 0:
+        return [0] * len(ROLL_ITEMS)
+
+    table = get_roll_table(luck)
+    if numpy_rng is not None:
+        return numpy_rng.multinomial(n, table.normalized_probabilities).tolist()
+
+    counts = [0] * len(ROLL_ITEMS)
+    for index in random.choices(ROLL_ITEM_INDICES, cum_weights=table.cumulative_weights, k=n):
+        counts[index] += 1
+    return counts
+
+def roll_counts_to_items(counts):
+    """perform_rollsの個数リストを {アイテム名: 個数} (0個のアイテムは除く) に変換する"""
+    return {ROLL_ITEMS[index]: count for index, count in enumerate(counts) if count > 0}
+
+def take_potion_runs(active_uses, roll_count):
+    """
+    次の roll_count 回のロールを、使用待ちのポーションを倍率の高い順に1ロール1回ずつ使った場合の
+    [(回数, ポーションの内部名 (なければNone), ポーションの倍率), ...] に分け、使った分を active_uses から減らす。
+    1回ずつ使うのと同じ順序・同じ回数になる。
+    """
+    runs = []
+    for internal_name, multiplier_value in LUCK_POTION_PRIORITY:
+        if roll_count <= 0:
+            break
+        uses = active_uses.get(internal_name, 0)
+        if uses <= 0:
+            continue
+        run_rolls = min(uses, roll_count)
+        runs.append((run_rolls, internal_name, multiplier_value))
+        if uses > run_rolls:
+            active_uses[internal_name] = uses - run_rolls
+        else:
+            del active_uses[internal_name]
+        roll_count -= run_rolls
+    if roll_count > 0:
+        runs.append((roll_count, None, 1.0)) # 残りはポーションなし (効果の分からないポーションは使わない)
+    return runs
+
+def roll_potion_runs(boosted_luck, active_uses, roll_count, found_items, consumed_potion_uses):
+    """take_potion_runs で分けた区間ごとに1回ずつまとめて抽選し、結果と使ったポーションの回数 (負の数) を足し込む"""
+    for run_rolls, internal_name, multiplier_value in take_potion_runs(active_uses, roll_count):
+        if internal_name:
+            consumed_potion_uses[internal_name] = consumed_potion_uses.get(internal_name, 0) - run_rolls
+        for item, count in roll_counts_to_items(perform_rolls(boosted_luck * multiplier_value, run_rolls)).items():
+            found_items[item] = found_items.get(item, 0) + count
 
 # --- ページネーション用グローバル辞書 ---
 # {メッセージID: {
@@ -374,10 +1815,8 @@ async def generate_itemlist_embed(user_id, page_num, items_per_page, category_na
     """
     指定されたページ番号、カテゴリのアイテムリストEmbedを生成する。
     """
-    # on_messageから呼び出される際、既にuser_data_lockは取得済みのはず
-    # ここでさらにロックを取得しようとするとデッドロックまたはブロッキングの原因になるため、削除
-    # async with user_data_lock: # <<<< この行を削除
-    user_inventory = user_data[str(user_id)]["inventory"] # <<<< ロックなしでアクセス
+    # 読み取りのみで await を挟まないため、ロックは不要
+    user_inventory = user_data[str(user_id)]["inventory"]
 
     print(f"DEBUG: generate_itemlist_embed: user_inventory retrieved. User ID: {user_id}")
 
@@ -505,1575 +1944,1683 @@ async def on_reaction_add(reaction, user):
             await reaction.remove(user) # リアクションを削除 (ページが変わらない場合も)
 
 
-@bot.event
-async def on_message(message):
-    # デバッグ: on_messageが呼び出されたことを確認
-    print(f"DEBUG: on_message called! Author: {message.author.name}, Content: '{message.content}'")
-    # 生のメッセージ内容とその型、長さを表示
-    print(f"DEBUG: Raw message content (type/len): {type(message.content)}, {len(message.content)}")
-    # 各文字のUnicodeコードポイントを表示 (隠れた文字がないか確認用)
-    print(f"DEBUG: Raw message content (unicode codepoints): {[ord(c) for c in message.content]}")
-
+# --- コマンド ---
+# 各コマンドは async def command_xxx(message, context) として定義し、COMMANDS に登録する。
+# on_message はコマンド名で COMMANDS を引いてハンドラを呼ぶだけで、管理者の確認と
+# ユーザーデータの準備 (作成・ブーストの期限切れ確認) は登録内容に応じてルーターが行う。
+CommandContext = collections.namedtuple("CommandContext", ["user_id", "command_content", "args", "current_time"])
+CommandSpec = collections.namedtuple("CommandSpec", ["handler", "parse_args", "admin_only", "needs_user_state"])
+
+# コマンドごとの処理時間の集計 (コマンド名 -> {"calls": 実行回数, "total_ms": 合計, "max_ms": 最大})
+command_timing_stats = {}
+
+def parse_no_args(command_content):
+    """引数のないコマンド。引数が付いていればNone (コマンドとして扱わない)"""
+    return () if " " not in command_content else None
+
+def parse_space_separated_args(command_content):
+    """コマンド名を含めて空白で区切った一覧 (parts[0] がコマンド名)"""
+    return command_content.split(" ")
+
+def record_command_timing(command_name, elapsed_seconds):
+    """コマンドの処理時間を記録して表示する"""
+    elapsed_ms = elapsed_seconds * 1000
+    stats = command_timing_stats.setdefault(command_name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+    stats["calls"] += 1
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+    print(f"DEBUG: {command_name} handled in {elapsed_ms:.2f}ms (avg {stats['total_ms'] / stats['calls']:.2f}ms, max {stats['max_ms']:.2f}ms)")
+
+async def prepare_user_state(user_id):
+    """ユーザーデータを使うコマンドの前に、ユーザーを作成する (ブーストの期限切れは予定表が処理する)"""
+    async with user_lock(user_id): # user_dataの読み書きをロックで保護
+        # ユーザーデータがなければ初期化
+        if user_id not in user_data:
+            print(f"DEBUG: Initializing user data for {user_id}")
+            user_data[user_id] = new_user_record()
+            journal_user_created(user_id)
+
+
+# --- 固定の埋め込み (!help, !adminhelp, !recipe) ---
+# 内容がユーザーや時刻によらない埋め込みは、コマンドごとに1回だけ作って使い回す (送信するだけになる)。
+# レシピ・アイテムは起動時に決まり実行中は変わらないので、作り直しは起動時の1回だけ。
+static_embed_cache = {} # コマンド名 -> 作成済みの埋め込み
+
+def get_static_embed(command_name):
+    """作成済みの埋め込みを返す (まだなければここで作る)"""
+    embed = static_embed_cache.get(command_name)
+    if embed is None:
+        embed = static_embed_cache[command_name] = STATIC_EMBED_BUILDERS[command_name]()
+    return embed
 
-    global user_data
-    global auto_rng_sessions
-    if message.author.bot:
-        # UnbelievaBoatのような他のボットからの空のメッセージは無視
-        if message.author.name == "UnbelievaBoat" and message.content.strip() == "":
-            print(f"DEBUG: Ignoring empty message from bot: {message.author.name}")
-            return # UnbelievaBoatからの空のメッセージは無視
-        # それ以外のボットからのメッセージも基本的には無視
-        print(f"DEBUG: Ignoring message from another bot: {message.author.name} (Content: '{message.content}')")
-        return
+def warm_static_embeds():
+    """起動時に固定の埋め込みをすべて作っておく"""
+    static_embed_cache.clear()
+    for command_name in STATIC_EMBED_BUILDERS:
+        get_static_embed(command_name)
 
-    user_id = str(message.author.id)
-    # メッセージ内容の前後の空白を除去し、小文字に変換
-    command_content = message.content.lower().strip()
-    print(f"DEBUG: Processed command_content: '{command_content}' (Length: {len(command_content)})")
-    # 処理後のコマンド内容のUnicodeコードポイントも表示
-    print(f"DEBUG: Processed command_content (unicode codepoints): {[ord(c) for c in command_content]}")
 
+# --- ヘルプコマンド ---
+def build_help_embed():
+    """!help の埋め込みを作る"""
+    embed = discord.Embed(
+        title="コマンド一覧",
+        description="このボットで使えるコマンドはこちらです。",
+        color=discord.Color.green()
+    )
+    embed.add_field(name="**!rng [回数]**", value=f"ランダムアイテムをロールします。回数 (最大{RNG_BULK_MAX_ROLLS:,}回) を指定するとまとめてロールします。例: `!rng 100`", inline=False)
+    embed.add_field(name="**!status**", value="あなたの現在のロール数、ラック、インベントリを表示します。", inline=False)
+    embed.add_field(name="**!itemlist**", value="全アイテムの確率とあなたの所持数、そしてサーバー全体の総所持数を表示します。", inline=False)
+    embed.add_field(name="**!ranking [rolls/rarity/アイテム名]**", value="ロール数・レア度スコア・アイテムごとの所持数のトッププレイヤーとあなたの順位を表示します。例: `!ranking rarity` または `!ranking golden haka`", inline=False)
+    embed.add_field(name="**!autorng**", value="6時間、1秒に1回自動でロールします。結果は終了後にDMで送られます。", inline=False)
+    embed.add_field(name="**!autostop**", value="実行中のオートRNGを停止し、現在の結果をDMで送られます。", inline=False)
+    embed.add_field(name="**!autorngtime**", value="実行中のオートRNGの残り時間を表示します。", inline=False)
+    embed.add_field(name="**!ping**", value="ボットの応答速度を測定します。", inline=False)
+    embed.add_field(name="**!setup**", value="高確率アイテムの通知チャンネルを設定します。", inline=False)
+    embed.add_field(name="**!login**", value="デイリーログインボーナスを獲得します。連続ログインでラックブーストが向上します。", inline=False)
+    embed.add_field(name="**!craft [合成したいアイテム名] [個数/all]**", value="素材を消費してよりレアなアイテムを合成します。例: `!craft golden haka 5` または `!craft golden haka all`", inline=False)
+    embed.add_field(name="**!make [作成したいポーション名] [個数/all]**", value="素材を消費してLuck Potionを生成します。例: `!make rtx4070 1`", inline=False)
+    embed.add_field(name="**!use [使用したいポーション名] [個数/all]**", value="Luck Potionを使用キューに追加し、次のロールから効果を適用します。例: `!use rtx4070 1`", inline=False)
+    embed.add_field(name="**!recipe**", value="Luck Potionの作成レシピを表示します。", inline=False)
+    return embed
 
+async def command_help(message, context):
+    print("DEBUG: Entering !help command block.")
     try:
-        async with user_data_lock: # user_dataの読み書き全体をロックで保護
-            # ユーザーデータがなければ初期化
-            if user_id not in user_data:
-                print(f"DEBUG: Initializing user data for {user_id}")
-                user_data[user_id] = {
-                    "rolls": 0,
-                    "luck": 1.0,
-                    "inventory": {},
-                    "luck_potions": {},
-                    "active_luck_potion_uses": {},
-                    "daily_login": {
-                        "last_login_date": None,
-                        "consecutive_days": 0,
-                        "active_boost": {
-                            "multiplier": 1.0,
-                            "end_time": None
-                        }
-                    },
-                    "admin_boost": { # 新規ユーザーの初期化時にadmin_boostを追加
-                        "multiplier": 1.0,
-                        "end_time": None
-                    }
-                }
-                save_user_data()
-
-            # 既存のユーザーデータに不足があれば初期値を追加（互換性維持のため）
-            if "daily_login" not in user_data[user_id]:
-                print(f"DEBUG: Adding 'daily_login' to user data for {user_id}")
-                user_data[user_id]["daily_login"] = {
-                    "last_login_date": None,
-                    "consecutive_days": 0,
-                    "active_boost": {
-                        "multiplier": 1.0,
-                        "end_time": None
-                    }
-                }
-                save_user_data()
-
-            if "luck_potions" not in user_data[user_id]:
-                print(f"DEBUG: Adding 'luck_potions' to user data for {user_id}")
-                user_data[user_id]["luck_potions"] = {}
-                save_user_data()
-
-            # 新しいフィールド active_luck_potion_uses の追加 (既存ユーザー向け)
-            if "active_luck_potion_uses" not in user_data[user_id]:
-                print(f"DEBUG: Adding 'active_luck_potion_uses' to user data for {user_id}")
-                user_data[user_id]["active_luck_potion_uses"] = {}
-                save_user_data()
-
-            # admin_boost がない既存ユーザーのために追加
-            if "admin_boost" not in user_data[user_id]:
-                print(f"DEBUG: Adding 'admin_boost' to existing user data for {user_id}")
-                user_data[user_id]["admin_boost"] = {
-                    "multiplier": 1.0,
-                    "end_time": None
-                }
-                save_user_data()
-
-
-        # --- ラックブーストの適用と期限切れチェック ---
-        current_time = datetime.datetime.now(datetime.timezone.utc)
-        
-        async with user_data_lock: # user_dataの読み書きをロックで保護
-            user_boost = user_data[user_id]["daily_login"]["active_boost"]
+        print("DEBUG: Attempting to send !help embed.")
+        await send_reply(message.channel, embed=get_static_embed("!help"))
+        print("DEBUG: !help embed sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to send !help embed or during processing: {e}")
+        import traceback
+        traceback.print_exc()
 
-            # ブーストが設定されており、かつ終了時刻を過ぎている場合
-            if user_boost["end_time"] and current_time > datetime.datetime.fromtimestamp(user_boost["end_time"], tz=datetime.timezone.utc):
-                # Luckはここで元に戻さない。perform_rollで都度計算される
-                user_boost["multiplier"] = 1.0
-                user_boost["end_time"] = None
-                save_user_data()
-                try:
-                    await message.channel.send(f"{message.author.mention} の一時的なラックブーストが終了しました。")
-                except Exception as e:
-                    print(f"WARNING: Could not send daily boost expired message for {message.author.name}: {e}")
-            
-            # 管理者ブーストの期限切れチェックとリセット (もしあれば)
-            admin_boost_info = user_data[user_id].get("admin_boost", {"multiplier": 1.0, "end_time": None})
-            if admin_boost_info["end_time"] and current_time > datetime.datetime.fromtimestamp(admin_boost_info["end_time"], tz=datetime.timezone.utc):
-                user_data[user_id]["luck"] = 1.0 # 基本ラックを1.0に戻す
-                user_data[user_id]["admin_boost"]["multiplier"] = 1.0
-                user_data[user_id]["admin_boost"]["end_time"] = None
-                save_user_data()
-                try:
-                    await message.channel.send(f"{message.author.mention} の管理者ラックブーストが終了し、元のラックに戻りました。")
-                except Exception as e:
-                    print(f"WARNING: Could not send admin boost expired message for {message.author.name}: {e}")
 
+# --- 管理者用ヘルプコマンド ---
+def build_adminhelp_embed():
+    """!adminhelp の埋め込みを作る"""
+    embed = discord.Embed(
+        title="管理者コマンド一覧",
+        description="管理者のみが使用できるコマンドはこちらです。",
+        color=discord.Color.red()
+    )
+    embed.add_field(name="**!boostluck [倍率] [秒数] [開始までの秒数]**", value="全員のLuckを一時的に指定倍率にします。重ねがけ・予約ができ、`!boostluck clear` で取り消せます。例: `!boostluck 1.5 60` (1.5倍、60秒)", inline=False)
+    embed.add_field(name="**!resetall**", value="**警告: 全ユーザーのデータ（ロール数、ラック、インベントリ）をリセットします。**", inline=False)
+    embed.add_field(name="**!adminautorng**", value="現在実行中の全ユーザーのオートRNG状況を表示します。", inline=False)
+    embed.add_field(name="**!giveautorng [user mention or ID / all]**", value="指定したユーザーまたは全員のオートRNGを開始します。例: `!giveautorng @ユーザー名`, `!giveautorng 123456789012345678`, `!giveautorng all`", inline=False) # 説明を更新
+    embed.add_field(name="**!delete [user mention or ID / all]**", value="指定したユーザーまたは全員のデータを削除します。**回復不能な操作です！**", inline=False)
+    return embed
 
-            # 現在のラック値を取得 (ブーストが終了していても、まだ反映されていない場合があるので念のためここで取得)
-            user_luck = user_data[user_id]["luck"]
+async def command_adminhelp(message, context):
+    print("DEBUG: Entering !adminhelp command block.")
+    try:
+        print("DEBUG: Attempting to send !adminhelp embed.")
+        await send_reply(message.channel, embed=get_static_embed("!adminhelp"))
+        print("DEBUG: !adminhelp embed sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to send !adminhelp embed or during processing: {e}")
+        import traceback
+        traceback.print_exc()
 
 
-        # --- ヘルプコマンド ---
-        if command_content == "!help":
-            print("DEBUG: Entering !help command block.")
-            try:
-                embed = discord.Embed(
-                    title="コマンド一覧",
-                    description="このボットで使えるコマンドはこちらです。",
-                    color=discord.Color.green()
-                )
-                embed.add_field(name="**!rng**", value="ランダムアイテムをロールします。", inline=False)
-                embed.add_field(name="**!status**", value="あなたの現在のロール数、ラック、インベントリを表示します。", inline=False)
-                embed.add_field(name="**!itemlist**", value="全アイテムの確率とあなたの所持数、そしてサーバー全体の総所持数を表示します。", inline=False)
-                embed.add_field(name="**!ranking**", value="ロール数のトッププレイヤーを表示します。", inline=False)
-                embed.add_field(name="**!autorng**", value="6時間、1秒に1回自動でロールします。結果は終了後にDMで送られます。", inline=False)
-                embed.add_field(name="**!autostop**", value="実行中のオートRNGを停止し、現在の結果をDMで送られます。", inline=False)
-                embed.add_field(name="**!autorngtime**", value="実行中のオートRNGの残り時間を表示します。", inline=False)
-                embed.add_field(name="**!ping**", value="ボットの応答速度を測定します。", inline=False)
-                embed.add_field(name="**!setup**", value="高確率アイテムの通知チャンネルを設定します。", inline=False)
-                embed.add_field(name="**!login**", value="デイリーログインボーナスを獲得します。連続ログインでラックブーストが向上します。", inline=False)
-                embed.add_field(name="**!craft [合成したいアイテム名] [個数/all]**", value="素材を消費してよりレアなアイテムを合成します。例: `!craft golden haka 5` または `!craft golden haka all`", inline=False)
-                embed.add_field(name="**!make [作成したいポーション名] [個数/all]**", value="素材を消費してLuck Potionを生成します。例: `!make rtx4070 1`", inline=False)
-                embed.add_field(name="**!use [使用したいポーション名] [個数/all]**", value="Luck Potionを使用キューに追加し、次のロールから効果を適用します。例: `!use rtx4070 1`", inline=False)
-                embed.add_field(name="**!recipe**", value="Luck Potionの作成レシピを表示します。", inline=False)
-
-                print("DEBUG: Attempting to send !help embed.")
-                await message.channel.send(embed=embed)
-                print("DEBUG: !help embed sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to send !help embed or during processing: {e}")
-                import traceback
-                traceback.print_exc()
-            return
+# --- Ping測定コマンド ---
+async def command_ping(message, context):
+    print("DEBUG: Entering !ping command block.")
+    try:
+        start_time = time.time()
+        latency = bot.latency * 1000
+
+        msg = await send_reply(message.channel, "Pingを測定中...")
+        end_time = time.time()
+        api_latency = (end_time - start_time) * 1000
+
+        embed = discord.Embed(
+            title="Ping結果",
+            description=f"WebSocket Latency: `{latency:.2f}ms`\nAPI Latency: `{api_latency:.2f}ms`",
+            color=discord.Color.blue()
+        )
+        print("DEBUG: Attempting to edit Ping message with embed.")
+        await msg.edit(content="", embed=embed)
+        print("DEBUG: Ping message edited.")
+    except Exception as e:
+        print(f"ERROR: Failed to send/edit !ping message or during processing: {e}")
+        import traceback
+        traceback.print_exc()
 
-        # --- 管理者用ヘルプコマンド ---
-        elif command_content == "!adminhelp":
-            print("DEBUG: Entering !adminhelp command block.")
-            if message.author.id not in ADMIN_IDS:
-                await message.channel.send("このコマンドは管理者のみが使用できます。")
-                return
-            try:
-                embed = discord.Embed(
-                    title="管理者コマンド一覧",
-                    description="管理者のみが使用できるコマンドはこちらです。",
-                    color=discord.Color.red()
-                )
-                embed.add_field(name="**!boostluck [倍率] [秒数]**", value="全員のLuckを一時的に指定倍率にします。例: `!boostluck 1.5 60` (1.5倍、60秒)", inline=False)
-                embed.add_field(name="**!resetall**", value="**警告: 全ユーザーのデータ（ロール数、ラック、インベントリ）をリセットします。**", inline=False)
-                embed.add_field(name="**!adminautorng**", value="現在実行中の全ユーザーのオートRNG状況を表示します。", inline=False)
-                embed.add_field(name="**!giveautorng [user mention or ID / all]**", value="指定したユーザーまたは全員のオートRNGを開始します。例: `!giveautorng @ユーザー名`, `!giveautorng 123456789012345678`, `!giveautorng all`", inline=False) # 説明を更新
-                embed.add_field(name="**!delete [user mention or ID / all]**", value="指定したユーザーまたは全員のデータを削除します。**回復不能な操作です！**", inline=False)
-                print("DEBUG: Attempting to send !adminhelp embed.")
-                await message.channel.send(embed=embed)
-                print("DEBUG: !adminhelp embed sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to send !adminhelp embed or during processing: {e}")
-                import traceback
-                traceback.print_exc()
-            return
 
-        # --- Ping測定コマンド ---
-        elif command_content == "!ping":
-            print("DEBUG: Entering !ping command block.")
-            try:
-                start_time = time.time()
-                latency = bot.latency * 1000
-
-                msg = await message.channel.send("Pingを測定中...")
-                end_time = time.time()
-                api_latency = (end_time - start_time) * 1000
-
-                embed = discord.Embed(
-                    title="Ping結果",
-                    description=f"WebSocket Latency: `{latency:.2f}ms`\nAPI Latency: `{api_latency:.2f}ms`",
-                    color=discord.Color.blue()
-                )
-                print("DEBUG: Attempting to edit Ping message with embed.")
-                await msg.edit(content="", embed=embed)
-                print("DEBUG: Ping message edited.")
-            except Exception as e:
-                print(f"ERROR: Failed to send/edit !ping message or during processing: {e}")
-                import traceback
-                traceback.print_exc()
-            return
+# --- setupコマンド (通知チャンネル設定) ---
+async def command_setup(message, context):
+    print("DEBUG: Entering !setup command block.")
+    try:
+        bot_settings["notification_channel_id"] = message.channel.id
+        save_bot_settings()
+        print("DEBUG: Attempting to send !setup confirmation message.")
+        await send_reply(message.channel, f"このチャンネル（`#{message.channel.name}`）を高確率アイテムの通知チャンネルに設定しました。")
+        print("DEBUG: !setup confirmation message sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to send !setup confirmation message or during processing: {e}")
+        import traceback
+        traceback.print_exc()
 
-        # --- setupコマンド (通知チャンネル設定) ---
-        elif command_content == "!setup":
-            print("DEBUG: Entering !setup command block.")
-            if message.author.id not in ADMIN_IDS:
-                await message.channel.send("このコマンドは管理者のみが使用できます。")
-                return
-            try:
-                bot_settings["notification_channel_id"] = message.channel.id
-                save_bot_settings()
-                print("DEBUG: Attempting to send !setup confirmation message.")
-                await message.channel.send(f"このチャンネル（`#{message.channel.name}`）を高確率アイテムの通知チャンネルに設定しました。")
-                print("DEBUG: !setup confirmation message sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to send !setup confirmation message or during processing: {e}")
-                import traceback
-                traceback.print_exc()
-            return
 
-        # --- デイリーログインコマンド ---
-        elif command_content == "!login":
-            print("DEBUG: Entering !login command block.")
-            try:
-                today_utc = datetime.datetime.now(datetime.timezone.utc).date()
-                async with user_data_lock: # user_dataの読み書きをロックで保護
-                    user_daily_data = user_data[user_id]["daily_login"]
-                    last_login_date_str = user_daily_data["last_login_date"]
-
-                    last_login_date_obj = None
-                    if last_login_date_str:
-                        last_login_date_obj = datetime.datetime.strptime(last_login_date_str, "%Y-%m-%d").date()
-
-                    # 今日すでにログイン済みかチェック
-                    if last_login_date_obj == today_utc:
-                        await message.channel.send("すでに今日のデイリーログイン報酬は受け取り済みです。")
-                        return
-
-                    # 連続ログインの判定
-                    is_consecutive = False
-                    if last_login_date_obj:
-                        # 前回のログインが昨日だった場合、連続ログイン
-                        if last_login_date_obj == today_utc - datetime.timedelta(days=1):
-                            user_daily_data["consecutive_days"] += 1
-                            is_consecutive = True
-                        else:
-                            # 連続ログインが途切れた場合
-                            user_daily_data["consecutive_days"] = 1
+# --- デイリーログインコマンド ---
+async def command_login(message, context):
+    user_id = context.user_id
+    current_time = context.current_time
+    print("DEBUG: Entering !login command block.")
+    try:
+        today_utc = datetime.datetime.now(datetime.timezone.utc).date()
+        async with user_lock(user_id): # user_dataの読み書きをロックで保護
+            user_daily_data = user_data[user_id]["daily_login"]
+            last_login_date_str = user_daily_data["last_login_date"]
+
+            last_login_date_obj = None
+            if last_login_date_str:
+                last_login_date_obj = datetime.datetime.strptime(last_login_date_str, "%Y-%m-%d").date()
+
+            # 今日すでにログイン済みかチェック
+            already_logged_in = last_login_date_obj == today_utc
+            if not already_logged_in:
+                # 連続ログインの判定
+                is_consecutive = False
+                if last_login_date_obj:
+                    # 前回のログインが昨日だった場合、連続ログイン
+                    if last_login_date_obj == today_utc - datetime.timedelta(days=1):
+                        user_daily_data["consecutive_days"] += 1
+                        is_consecutive = True
                     else:
-                        # 初回ログイン
+                        # 連続ログインが途切れた場合
                         user_daily_data["consecutive_days"] = 1
+                else:
+                    # 初回ログイン
+                    user_daily_data["consecutive_days"] = 1
 
-                    user_daily_data["last_login_date"] = today_utc.strftime("%Y-%m-%d")
+                user_daily_data["last_login_date"] = today_utc.strftime("%Y-%m-%d")
 
-                    consecutive_days = user_daily_data["consecutive_days"]
+                consecutive_days = user_daily_data["consecutive_days"]
 
-                    # 連続ログイン日数に応じたラックブースト倍率と時間
-                    boost_multiplier = 1.0 + (consecutive_days * 0.1)
-                    boost_duration_minutes = 5 + (consecutive_days - 1) * 1
+                # 連続ログイン日数に応じたラックブースト倍率と時間
+                boost_multiplier = 1.0 + (consecutive_days * 0.1)
+                boost_duration_minutes = 5 + (consecutive_days - 1) * 1
 
-                    max_boost_multiplier = 2.0
-                    max_boost_duration_minutes = 15
+                max_boost_multiplier = 2.0
+                max_boost_duration_minutes = 15
 
-                    boost_multiplier = min(boost_multiplier, max_boost_multiplier)
-                    boost_duration_minutes = min(boost_duration_minutes, max_boost_duration_minutes)
+                boost_multiplier = min(boost_multiplier, max_boost_multiplier)
+                boost_duration_minutes = min(boost_duration_minutes, max_boost_duration_minutes)
 
-                    boost_duration_seconds = boost_duration_minutes * 60
-                    boost_end_time = current_time + datetime.timedelta(seconds=boost_duration_seconds)
+                boost_duration_seconds = boost_duration_minutes * 60
+                boost_end_time = current_time + datetime.timedelta(seconds=boost_duration_seconds)
 
-                    # デイリーログインのブースト情報を更新
-                    user_daily_data["active_boost"]["multiplier"] = boost_multiplier
-                    user_daily_data["active_boost"]["end_time"] = boost_end_time.timestamp()
+                # デイリーログインのブースト情報を更新 (オートRNGの未抽選のロールは更新前のブーストで抽選しておく)
+                materialize_auto_rng_rolls_before_luck_change(user_id)
+                user_daily_data["active_boost"]["multiplier"] = boost_multiplier
+                user_daily_data["active_boost"]["end_time"] = boost_end_time.timestamp()
+                schedule_expiry(user_daily_data["active_boost"]["end_time"], EXPIRY_DAILY_BOOST, user_id)
 
-                    # user_dataの'luck'は基本ラック値 (1.0) のままにしておく。
-                    # 実際の計算は `perform_roll` に渡す前に動的に行われる。
-                    # ただし、表示のために一度計算しておく
-                    display_luck = 1.0 * boost_multiplier # デイリーログインブーストのみを考慮したラック
+                # user_dataの'luck'は基本ラック値 (1.0) のままにしておく。
+                # 実際の計算は `perform_roll` に渡す前に動的に行われる。
+                # ただし、表示のために一度計算しておく
+                display_luck = 1.0 * boost_multiplier # デイリーログインブーストのみを考慮したラック
 
-                    save_user_data()
+                journal_user_fields(user_id, "daily_login")
 
-                status_message = ""
-                if is_consecutive:
-                    status_message = f"**連続ログイン{consecutive_days}日目！**"
-                else:
-                    status_message = f"**デイリーログイン成功！**"
-
-                print("DEBUG: Attempting to send !login confirmation message.")
-                await message.channel.send(
-                    f"{message.author.mention} {status_message}\n"
-                    f"ラックが一時的に **{boost_multiplier:.1f}倍** になりました！ ({boost_duration_minutes}分間有効)\n"
-                    f"現在のラック: **{display_luck:.1f}** (基本ラック x デイリーログインブースト)"
-                )
-                print("DEBUG: !login confirmation message sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to send !login message or during processing: {e}")
-                import traceback
-                traceback.print_exc()
+        if already_logged_in:
+            await send_reply(message.channel, "すでに今日のデイリーログイン報酬は受け取り済みです。")
             return
 
-        # --- RNGコマンド ---
-        elif command_content == "!rng":
-            print("DEBUG: Entering !rng command block.")
-            try:
-                async with user_data_lock: # user_dataの読み書きをロックで保護
-                    # ユーザーの基本ラック (通常は1.0)
-                    current_base_luck = user_data[user_id]["luck"]
-
-                    # デイリーログインブーストの適用
-                    user_boost = user_data[user_id]["daily_login"]["active_boost"]
-                    if user_boost["end_time"] and datetime.datetime.now(datetime.timezone.utc) < datetime.datetime.fromtimestamp(user_boost["end_time"], tz=datetime.timezone.utc):
-                        current_base_luck *= user_boost["multiplier"]
-
-                    # 管理者ブーストの適用
-                    admin_boost_info = user_data[user_id].get("admin_boost", {"multiplier": 1.0, "end_time": None})
-                    if admin_boost_info["end_time"] and current_time < datetime.datetime.fromtimestamp(admin_boost_info["end_time"], tz=datetime.timezone.utc):
-                        current_base_luck *= admin_boost_info["multiplier"]
-
-                    # Luck Potionの適用ロジック (active_luck_potion_usesから消費)
-                    applied_potion_multiplier = 1.0
-                    applied_potion_display_name = None
-
-                    active_uses = user_data[user_id]["active_luck_potion_uses"]
-
-                    # 最も高い倍率のポーションを検索し、1回分消費
-                    highest_multiplier = 1.0
-                    best_potion_internal_name = None
-
-                    # LUCK_POTION_EFFECTSを倍率の降順でソートして探索
-                    sorted_potions_by_multiplier = sorted(LUCK_POTION_EFFECTS.items(), key=lambda item: item[1], reverse=True)
-
-                    for internal_name, multiplier_value in sorted_potions_by_multiplier:
-                        if active_uses.get(internal_name, 0) > 0:
-                            highest_multiplier = multiplier_value
-                            best_potion_internal_name = internal_name
-                            break # 最も高い倍率のポーションを見つけたらループ終了
-
-                    if best_potion_internal_name:
-                        applied_potion_multiplier = highest_multiplier
-                        current_luck_for_roll = current_base_luck * applied_potion_multiplier # ポーション効果をここで適用
-
-                        # 使用回数を1減らす
-                        active_uses[best_potion_internal_name] -= 1
-                        if active_uses[best_potion_internal_name] <= 0:
-                            del active_uses[best_potion_internal_name] # 残り回数が0になったら削除
-
-                        # ポーションの表示名を取得
-                        for recipe_name, recipe_data in LUCK_POTION_RECIPES.items():
-                            if list(recipe_data["output"].keys())[0] == best_potion_internal_name:
-                                applied_potion_display_name = recipe_name
-                                break
-
-                        print(f"DEBUG: {message.author.mention} used {applied_potion_display_name}.")
-                        await message.channel.send(f"{message.author.mention} は **{applied_potion_display_name}** を使用しました！今回のロールのラックは **{current_luck_for_roll:.1f}倍** になります！")
-                    else:
-                        current_luck_for_roll = current_base_luck # ポーションがなければ基本ラック
-
-                    user_data[user_id]["rolls"] += 1
-                    user_rolls = user_data[user_id]["rolls"]
-                    today = datetime.datetime.now().strftime("%B %d, %Y")
-
-                    chosen_item, luck_applied_denominator, original_denominator = perform_roll(current_luck_for_roll) # 修正: perform_rollが3つの値を返す
-                    # ★★★ ラック適用時の表示上の確率は元のまま ★★★
-                    display_chance_for_user = f"1 in {original_denominator:,}" # 元の分母を表示
-
+        status_message = ""
+        if is_consecutive:
+            status_message = f"**連続ログイン{consecutive_days}日目！**"
+        else:
+            status_message = f"**デイリーログイン成功！**"
+
+        print("DEBUG: Attempting to send !login confirmation message.")
+        await send_reply(message.channel, 
+            f"{message.author.mention} {status_message}\n"
+            f"ラックが一時的に **{boost_multiplier:.1f}倍** になりました！ ({boost_duration_minutes}分間有効)\n"
+            f"現在のラック: **{display_luck:.1f}** (基本ラック x デイリーログインブースト)"
+        )
+        print("DEBUG: !login confirmation message sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to send !login message or during processing: {e}")
+        import traceback
+        traceback.print_exc()
 
-                    inventory = user_data[user_id]["inventory"]
-                    inventory[chosen_item] = inventory.get(chosen_item, 0) + 1
 
-                    embed = discord.Embed(
-                        title=f"{message.author.name} が {chosen_item} を見つけました!!!",
-                        color=discord.Color.purple()
-                    )
-                    embed.add_field(name="出現確率", value=display_chance_for_user, inline=False) # 表示は元の確率
-                    embed.add_field(name="獲得日", value=today, inline=False)
-                    embed.add_field(name="総ロール数", value=f"{user_rolls} 回", inline=False)
-                    embed.add_field(name="あなたの合計ラック (ポーション適用後)", value=f"{current_luck_for_roll:.1f} Luck", inline=False)
-                    
-                    print("DEBUG: Attempting to send !rng embed.")
-                    await message.channel.send(embed=embed)
-                    print("DEBUG: !rng embed sent.")
-
-                    save_user_data() # ポーション使用後の状態もここで保存
-
-                    # --- 高確率アイテム通知ロジック ---
-                    # 通知は元の分母で判断 (例: 10万分の1以上のアイテム)
-                    if original_denominator >= 100000: # ★★★ 通知判断は元の分母で ★★★
-                        notification_channel_id = bot_settings.get("notification_channel_id")
-                        if notification_channel_id:
-                            notification_channel = bot.get_channel(notification_channel_id)
-                            if notification_channel:
-                                total_item_counts = {item: 0 for item in rare_item_chances_denominator.keys()}
-                                for uid in user_data: # ロックされたuser_dataを安全に読み取る
-                                    for item, count in user_data[uid]["inventory"].items():
-                                        if item in total_item_counts:
-                                            total_item_counts[item] += count
-
-                                total_owned_count = total_item_counts.get(chosen_item, 0)
-
-                                notification_embed = discord.Embed(
-                                    title="レアアイテムドロップ通知！",
-                                    description=f"{message.author.mention} がレアアイテムを獲得しました！",
-                                    color=discord.Color.gold()
-                                )
-                                notification_embed.add_field(name="獲得者", value=message.author.mention, inline=False)
-                                notification_embed.add_field(name="アイテム", value=chosen_item, inline=False)
-                                notification_embed.add_field(name="確率", value=display_chance_for_user, inline=False) # 表示は元の確率
-                                notification_embed.add_field(name="獲得日時", value=datetime.datetime.now(datetime.timezone.utc).strftime("%Y年%m月%d日 %H:%M:%S UTC"), inline=False)
-                                notification_embed.add_field(name="サーバー総所持数", value=f"{total_owned_count}個", inline=False)
-                                notification_embed.set_footer(text="おめでとうございます！")
-                                print("DEBUG: Attempting to send notification embed.")
-                                await notification_channel.send(embed=notification_embed)
-                                print("DEBUG: Notification embed sent.")
-                            else:
-                                print(f"WARNING: Configured notification channel ID {notification_channel_id} not found.")
-                    # else: 通知チャンネルが設定されていない場合は何もしない
-            except Exception as e:
-                print(f"ERROR: Failed to process !rng command or send embed: {e}")
-                import traceback
-                traceback.print_exc()
-        elif command_content == "!status":
-            print(f"DEBUG: Entering !status command block for user: {user_id}")
-            try:
-                async with user_data_lock: # user_dataの読み取りをロックで保護
-                    # デバッグプリントを追加して、user_data[user_id] の中身を確認
-                    print(f"DEBUG: user_data content for {user_id}: {user_data.get(user_id)}")
-                    data = user_data[user_id]
-                    
-                    # ★★★ インベントリをレアリティ順にソートして表示 ★★★
-                    inventory_items_with_chances = []
-                    for item_name, count in data["inventory"].items():
-                        # rare_item_chances_denominator にアイテムが存在するか確認
-                        if item_name in rare_item_chances_denominator:
-                            chance = rare_item_chances_denominator[item_name]
-                            inventory_items_with_chances.append((item_name, count, chance))
-                        else:
-                            # もし確率リストにないアイテムがあれば、デフォルトの確率（非常に高いなど）を設定するか、無視
-                            print(f"WARNING: Item '{item_name}' not found in rare_item_chances_denominator. Skipping for status display.")
-                            inventory_items_with_chances.append((item_name, count, 0)) # 確率0で最後尾にするなど
-
-                    # 確率（分母）が大きい順（出にくい順）にソート
-                    inventory_items_with_chances.sort(key=lambda x: x[2], reverse=True)
-
-                    inventory_str_lines = []
-                    for item_name, count, chance in inventory_items_with_chances:
-                        if chance > 0:
-                            inventory_str_lines.append(f"{item_name}: {count}個 (1 in {chance:,})")
-                        else:
-                            # 確率が0のアイテムは「不明な確率」として表示
-                            inventory_str_lines.append(f"{item_name}: {count}個 (確率不明)")
-
-                    inventory_str = "\n".join(inventory_str_lines) or "なし"
-                    # ★★★ インベントリ表示修正ここまで ★★★
-
-
-                    # Luck Potionの表示 (インベントリ)
-                    luck_potions_str = ""
-                    if data["luck_potions"]:
-                        for potion_internal_name, count in data["luck_potions"].items():
-                            display_name = ""
-                            for recipe_name, recipe_data in LUCK_POTION_RECIPES.items():
-                                if list(recipe_data["output"].keys())[0] == potion_internal_name:
-                                    display_name = recipe_name
-                                    break
-                            if display_name:
-                                luck_potions_str += f"- {display_name}: {count}個\n"
-                        if not luck_potions_str:
-                            luck_potions_str = "なし"
-                    else:
-                        luck_potions_str = "なし"
-
-                    # 使用待ちLuck Potionの表示
-                    active_potions_str = ""
-                    if data["active_luck_potion_uses"]:
-                        for internal_name, count in data["active_luck_potion_uses"].items():
-                            display_name = ""
-                            for recipe_name, recipe_data in LUCK_POTION_RECIPES.items():
-                                if list(recipe_data["output"].keys())[0] == internal_name:
-                                    display_name = recipe_name
-                                    break
-                            if display_name:
-                                active_potions_str += f"- {display_name}: 残り{count}回\n"
-                        if not active_potions_str:
-                            active_potions_str = "なし"
-                    else:
-                        active_potions_str = "なし"
-
-                    # デイリーログインブースト情報を取得
-                    boost_info = data["daily_login"]["active_boost"]
-                    boost_status = "なし"
-                    current_luck_for_display = data["luck"] # 基本ラック (通常1.0)
-                    if boost_info["end_time"]:
-                        end_dt = datetime.datetime.fromtimestamp(boost_info["end_time"], tz=datetime.timezone.utc)
-                        remaining_time = end_dt - datetime.datetime.now(datetime.timezone.utc)
-                        if remaining_time.total_seconds() > 0:
-                            hours, remainder = divmod(int(remaining_time.total_seconds()), 3600)
-                            minutes, seconds = divmod(remainder, 60)
-                            boost_status = f"**{boost_info['multiplier']:.1f}倍** (残り {hours}h {minutes}m {seconds}s)"
-                            current_luck_for_display *= boost_info["multiplier"] # 表示ラックにデイリーログインブーストを乗算
-                        else:
-                            boost_status = "期限切れ"
-                    
-                    # 管理者ブーストの表示
-                    admin_boost_info = data["admin_boost"]
-                    admin_boost_status = "なし"
-                    if admin_boost_info["end_time"]:
-                        admin_end_dt = datetime.datetime.fromtimestamp(admin_boost_info["end_time"], tz=datetime.timezone.utc)
-                        admin_remaining_time = admin_end_dt - datetime.datetime.now(datetime.timezone.utc)
-                        if admin_remaining_time.total_seconds() > 0:
-                            admin_hours, admin_remainder = divmod(int(admin_remaining_time.total_seconds()), 3600)
-                            admin_minutes, admin_seconds = divmod(admin_remainder, 60)
-                            admin_boost_status = f"**{admin_boost_info['multiplier']:.1f}倍** (残り {admin_hours}h {admin_minutes}m {admin_seconds}s)"
-                            current_luck_for_display *= admin_boost_info["multiplier"] # 表示ラックに管理者ブーストを乗算
-                        else:
-                            admin_boost_status = "期限切れ"
-
-                    embed = discord.Embed(
-                        title=f"{message.author.name} のステータス",
-                        color=discord.Color.blue()
-                    )
-                    embed.add_field(name="**総ロール数**", value=f"{data['rolls']}", inline=False)
-                    embed.add_field(name="**ラック**", value=f"{current_luck_for_display:.1f}", inline=False)
-                    embed.add_field(name="**連続ログイン日数**", value=f"{data['daily_login']['consecutive_days']}日", inline=False)
-                    embed.add_field(name="**現在のログインブースト**", value=boost_status, inline=False)
-                    embed.add_field(name="**現在の管理者ブースト**", value=admin_boost_status, inline=False) # 管理者ブーストの表示を追加
-                    embed.add_field(name="**アイテムインベントリ**", value=inventory_str, inline=False)
-                    embed.add_field(name="**Luck Potionインベントリ**", value=luck_potions_str, inline=False)
-                    embed.add_field(name="**使用待ちLuck Potion**", value=active_potions_str, inline=False)
-                    
-                    print("DEBUG: Attempting to send !status embed.")
-                    await message.channel.send(embed=embed)
-                    print("DEBUG: !status embed sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to process !status command or send embed: {e}")
-                import traceback
-                traceback.print_exc()
+# --- RNGコマンド ---
+RNG_BULK_MAX_ROLLS = 1000 # !rng [回数] で1度にロールできる上限
+RNG_BULK_DISPLAY_ITEMS = 15 # まとめロールの結果に表示するアイテムの種類数 (レアな順)
+
+def parse_rng_args(command_content):
+    """!rng または !rng [回数]。回数が数字でなければNone (コマンドとして扱わない)"""
+    parts = command_content.split(" ")
+    if len(parts) == 1:
+        return (1,)
+    if len(parts) == 2 and parts[1].isdigit():
+        return (int(parts[1]),)
+    return None
+
+async def command_rng_bulk(message, context, roll_count):
+    """!rng [回数]: ポーションの種類ごとに区間を分け、区間ごとにまとめて抽選する"""
+    user_id = context.user_id
+    async with user_lock(user_id): # user_dataの読み書きをロックで保護
+        boosted_luck = resolve_effective_luck(user_id, context.current_time.timestamp())[0]
+        active_uses = dict(user_data[user_id]["active_luck_potion_uses"]) # 消費はコピー上で数え、最後に差分として反映する
+        found_items = {}
+        consumed_potion_uses = {}
+        roll_potion_runs(boosted_luck, active_uses, roll_count, found_items, consumed_potion_uses)
+        apply_user_delta(user_id, rolls=roll_count, inventory=found_items, active_luck_potion_uses=consumed_potion_uses)
+        user_rolls = user_data[user_id]["rolls"]
+
+    # Discordへの送信はロックを解放してから行う
+    found_lines = [
+        f"{item} x {count}個 (1 in {rare_item_chances_denominator[item]:,})"
+        for item, count in sorted(found_items.items(), key=lambda entry: rare_item_chances_denominator[entry[0]], reverse=True)
+    ]
+    if len(found_lines) > RNG_BULK_DISPLAY_ITEMS:
+        found_lines = found_lines[:RNG_BULK_DISPLAY_ITEMS] + [f"...他 {len(found_lines) - RNG_BULK_DISPLAY_ITEMS}種類"]
+    potion_lines = [f"{LUCK_POTION_DISPLAY_NAMES.get(internal_name, internal_name)} x {-count}回" for internal_name, count in consumed_potion_uses.items()]
 
-        elif command_content == "!itemlist":
-            print(f"DEBUG: Entering !itemlist command block for user: {user_id}")
-            try:
-                # user_dataへのアクセスはon_messageのasync with user_data_lockで保護されているため、
-                # generate_itemlist_embed内でのロックは不要（削除済み）
-                # デバッグプリントを追加して、user_data[user_id] の中身を確認
-                print(f"DEBUG: user_data content for {user_id}: {user_data.get(user_id)}")
-                # user_data[user_id] が期待される辞書構造を持っているか確認
-                if not isinstance(user_data.get(user_id), dict) or "inventory" not in user_data[user_id]:
-                    print(f"ERROR: User data for {user_id} is malformed or missing 'inventory' key. Data: {user_data.get(user_id)}")
-                    await message.channel.send("ユーザーデータに問題があるため、アイテムリストを表示できませんでした。")
-                    return # これ以上処理を進めない
-
-                user_inventory = user_data[user_id]["inventory"]
-
-                # 全ユーザーのアイテム総保持数を計算
-                total_item_counts = {item: 0 for item in rare_item_chances_denominator.keys()}
-                # ここで再度 user_data_lock を取得して for uid in user_data: ループを囲む
-                async with user_data_lock: # <<<< ここでロックを追加
-                    for uid in user_data:
-                        if isinstance(user_data[uid], dict) and "inventory" in user_data[uid]:
-                            for item, count in user_data[uid]["inventory"].items():
-                                if item in total_item_counts:
-                                    total_item_counts[item] += count
-
-                # アイテムをカテゴリ別に分類
-                normal_items = []
-                golden_items = []
-                rainbow_items = []
-
-                for item_name, chance_denominator in rare_item_chances_denominator.items():
-                    if item_name.startswith("golden "):
-                        golden_items.append((item_name, chance_denominator))
-                    elif item_name.startswith("rainbow "):
-                        rainbow_items.append((item_name, chance_denominator))
-                    else:
-                        normal_items.append((item_name, chance_denominator))
-
-                # 各カテゴリのアイテムをレアリティが高い（分母が大きい）順にソート
-                normal_items.sort(key=lambda item: item[1], reverse=True)
-                golden_items.sort(key=lambda item: item[1], reverse=True)
-                rainbow_items.sort(key=lambda item: item[1], reverse=True)
-
-                items_per_page = 10 # 1ページあたりのアイテム数
-
-                # 最初のページ（ノーマルアイテムリスト）を生成
-                print("DEBUG: Calling generate_itemlist_embed.")
-                initial_embed = await generate_itemlist_embed(user_id, 0, items_per_page, "normal", normal_items, total_item_counts)
-                
-                print("DEBUG: Attempting to send !itemlist embed.")
-                # メッセージ送信の成功/失敗をデバッグするために変数に格納
-                message_sent_obj = None
-                try:
-                    message_sent_obj = await message.channel.send(embed=initial_embed)
-                    print(f"DEBUG: !itemlist embed sent successfully. Message ID: {message_sent_obj.id}")
-                except discord.Forbidden:
-                    print(f"ERROR: Bot lacks permissions to send messages in channel {message.channel.id} for !itemlist.")
-                    await message.author.send(f"申し訳ありません、このチャンネルでアイテムリストを送信する権限がありません。\n"
-                                              f"チャンネル名: `{message.channel.name}`, サーバー名: `{message.guild.name if message.guild else 'DM'}`")
-                    return
-                except discord.HTTPException as http_e:
-                    print(f"ERROR: HTTPException during !itemlist embed send: {http_e.status} {http_e.text}")
-                    await message.channel.send("アイテムリストの送信中にDiscord APIエラーが発生しました。時間を置いて再度お試しください。")
-                    return
-                except Exception as embed_e:
-                    print(f"ERROR: Unexpected error while sending !itemlist embed: {embed_e}")
-                    import traceback
-                    traceback.print_exc()
-                    await message.channel.send("アイテムリストの送信中に予期せぬエラーが発生しました。")
-                    return
-
-                # message_sent_obj が None の場合は処理を中断
-                if message_sent_obj is None:
-                    print("DEBUG: Message_sent_obj is None, stopping !itemlist processing.")
-                    return
-
-
-                # ページネーションセッションを保存
-                pagination_sessions[message_sent_obj.id] = {
-                    "user_id": user_id,
-                    "current_page": 0,
-                    "items_per_page": items_per_page,
-                    "current_category": "normal",
-                    "normal_items": normal_items,
-                    "golden_items": golden_items,
-                    "rainbow_items": rainbow_items,
-                    "total_item_counts": total_item_counts
-                }
-                print("DEBUG: Pagination session saved.")
-
-                # リアクションを追加
-                print("DEBUG: Attempting to add reactions.")
-                try:
-                    await message_sent_obj.add_reaction('◀️')
-                    await message_sent_obj.add_reaction('▶️')
-                    await message_sent_obj.add_reaction('🐾') # ノーマルアイテム
-                    await message_sent_obj.add_reaction('⭐') # ゴールデンアイテム
-                    await message_sent_obj.add_reaction('🌈') # レインボーアイテム
-                    print("DEBUG: Reactions added successfully.")
-                except discord.Forbidden:
-                    print(f"ERROR: Bot lacks permissions to add reactions in channel {message.channel.id} for !itemlist.")
-                    # リアクション追加権限がない場合はユーザーに通知しない（よくあるため）
-                except discord.HTTPException as http_e:
-                    print(f"ERROR: HTTPException during !itemlist reaction add: {http_e.status} {http_e.text}")
-                except Exception as react_e:
-                    print(f"ERROR: Unexpected error while adding reactions for !itemlist: {react_e}")
-                    import traceback
-                    traceback.print_exc()
+    embed = discord.Embed(
+        title=f"{message.author.name} が {roll_count:,}回ロールしました!!!",
+        color=discord.Color.purple()
+    )
+    embed.add_field(name="獲得アイテム (レアな順)", value="\n".join(found_lines), inline=False)
+    embed.add_field(name="使用したLuck Potion", value="\n".join(potion_lines) if potion_lines else "なし", inline=False)
+    embed.add_field(name="総ロール数", value=f"{user_rolls} 回", inline=False)
+    embed.add_field(name="あなたの合計ラック (ポーション適用前)", value=f"{boosted_luck:.1f} Luck", inline=False)
+    print("DEBUG: Attempting to send bulk !rng embed.")
+    await send_reply(message.channel, embed=embed)
+    print("DEBUG: Bulk !rng embed sent.")
+
+    queue_rare_drop_notifications(message.author.mention, found_items, source=f"!rng {roll_count}")
+
+async def command_rng(message, context):
+    user_id = context.user_id
+    current_time = context.current_time
+    print("DEBUG: Entering !rng command block.")
+    try:
+        (roll_count,) = context.args
+        if not 1 <= roll_count <= RNG_BULK_MAX_ROLLS:
+            await send_reply(message.channel, f"ロール回数は1から{RNG_BULK_MAX_ROLLS:,}の間で指定してください。")
+            return
+        if roll_count > 1:
+            await command_rng_bulk(message, context, roll_count)
+            return
 
-            except Exception as e:
-                print(f"ERROR: Failed to process !itemlist command or send embed/reactions (outer try): {e}")
-                import traceback
-                traceback.print_exc()
+        async with user_lock(user_id): # user_dataの読み書きをロックで保護
+            # ブースト込みのラックと、使用待ちのうち最も倍率の高いポーション (キャッシュから)
+            current_base_luck, best_potion_internal_name, applied_potion_multiplier = resolve_effective_luck(user_id, current_time.timestamp())
+            current_luck_for_roll = current_base_luck * applied_potion_multiplier # ポーション効果をここで適用
+            applied_potion_display_name = LUCK_POTION_DISPLAY_NAMES.get(best_potion_internal_name) # ポーションの表示名
+            if best_potion_internal_name:
+                print(f"DEBUG: {message.author.mention} used {applied_potion_display_name}.")
+
+            today = datetime.datetime.now().strftime("%B %d, %Y")
+
+            chosen_item, luck_applied_denominator, original_denominator = perform_roll(current_luck_for_roll) # 修正: perform_rollが3つの値を返す
+            # ★★★ ラック適用時の表示上の確率は元のまま ★★★
+            display_chance_for_user = f"1 in {original_denominator:,}" # 元の分母を表示
+
+            # ロール数・獲得アイテム・ポーションの使用回数 (1減らす) をまとめて反映する
+            apply_user_delta(
+                user_id,
+                rolls=1,
+                inventory={chosen_item: 1},
+                active_luck_potion_uses={best_potion_internal_name: -1} if best_potion_internal_name else None,
+            )
+            user_rolls = user_data[user_id]["rolls"]
+
+        # Discordへの送信はロックを解放してから行う
+        if applied_potion_display_name:
+            await send_reply(message.channel, f"{message.author.mention} は **{applied_potion_display_name}** を使用しました！今回のロールのラックは **{current_luck_for_roll:.1f}倍** になります！")
+
+        embed = discord.Embed(
+            title=f"{message.author.name} が {chosen_item} を見つけました!!!",
+            color=discord.Color.purple()
+        )
+        embed.add_field(name="出現確率", value=display_chance_for_user, inline=False) # 表示は元の確率
+        embed.add_field(name="獲得日", value=today, inline=False)
+        embed.add_field(name="総ロール数", value=f"{user_rolls} 回", inline=False)
+        embed.add_field(name="あなたの合計ラック (ポーション適用後)", value=f"{current_luck_for_roll:.1f} Luck", inline=False)
+        
+        print("DEBUG: Attempting to send !rng embed.")
+        await send_reply(message.channel, embed=embed)
+        print("DEBUG: !rng embed sent.")
 
+        # --- 高確率アイテム通知ロジック ---
+        # 通知は元の分母で判断 (例: 10万分の1以上のアイテム)。送信はまとめ待ちを経て送信キューから行う
+        queue_rare_drop_notifications(message.author.mention, {chosen_item: 1})
+    except Exception as e:
+        print(f"ERROR: Failed to process !rng command or send embed: {e}")
+        import traceback
+        traceback.print_exc()
 
-        elif command_content == "!ranking":
-            print("DEBUG: Entering !ranking command block.")
-            try:
-                # ロール数でソート
-                async with user_data_lock: # user_dataの読み取りをロックで保護
-                    sorted_users = sorted(user_data.items(), key=lambda item: item[1].get("rolls", 0), reverse=True)
-
-                embed = discord.Embed(
-                    title="ロール数ランキング",
-                    description="最も多くロールしたユーザーのトップ10です。",
-                    color=discord.Color.gold()
-                )
-
-                rank = 1
-                for user_id_str, data in sorted_users[:10]:
-                    try:
-                        user = await bot.fetch_user(int(user_id_str))
-                        embed.add_field(name=f"**#{rank} {user.name}**", value=f"ロール数: {data.get('rolls', 0)}", inline=False)
-                        rank += 1
-                    except discord.NotFound:
-                        print(f"WARNING: User not found for ranking display: {user_id_str}") # デバッグ用にIDを出力
-                        embed.add_field(name=f"**#{rank} 不明なユーザー ({user_id_str})**", value=f"ロール数: {data.get('rolls', 0)}", inline=False)
-                        rank += 1
-                    except Exception as e:
-                        print(f"ERROR: Error during ranking display for user ID: {user_id_str}: {e}")
-                        embed.add_field(name=f"**#{rank} エラーユーザー ({user_id_str})**", value=f"ロール数: {data.get('rolls', 0)} (エラー: {e})", inline=False)
-                        rank += 1
-                if not sorted_users:
-                    embed.add_field(name="データなし", value="まだ誰もロールしていません。", inline=False)
-                
-                print("DEBUG: Attempting to send !ranking embed.")
-                await message.channel.send(embed=embed)
-                print("DEBUG: !ranking embed sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to process !ranking command or send embed: {e}")
-                import traceback
-                traceback.print_exc()
 
-        # --- Luck Potion レシピ表示コマンド ---
-        elif command_content == "!recipe":
-            print("DEBUG: Entering !recipe command block.")
-            try:
-                embed = discord.Embed(
-                    title="Luck Potion 作成レシピ",
-                    description="より強力なラックブーストを得るために、Luck Potionを合成しましょう！",
-                    color=discord.Color.green()
-                )
-
-                for potion_name, recipe_data in LUCK_POTION_RECIPES.items():
-                    materials_str = []
-                    for material, quantity in recipe_data["materials"].items():
-                        materials_str.append(f"{material} x {quantity}個")
-                    
-                    output_item = list(recipe_data["output"].keys())[0] # ポーションの内部名
-                    output_quantity = list(recipe_data["output"].values())[0] # ポーションの個数
-                    luck_multiplier = recipe_data["luck_multiplier"]
-
-                    embed.add_field(
-                        name=f"**{potion_name}**",
-                        value=f"**効果:** ラック {luck_multiplier:,}倍 (1回のロール)\n"
-                              f"**素材:** {', '.join(materials_str)}\n"
-                              f"**作成数:** {output_quantity}個",
-                        inline=False
-                    )
-                print("DEBUG: Attempting to send !recipe embed.")
-                await message.channel.send(embed=embed)
-                print("DEBUG: !recipe embed sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to process !recipe command or send embed: {e}")
-                import traceback
-                traceback.print_exc()
+# --- ステータス表示コマンド ---
+async def command_status(message, context):
+    user_id = context.user_id
+    print(f"DEBUG: Entering !status command block for user: {user_id}")
+    try:
+        async with user_lock(user_id): # user_dataの読み取りをロックで保護
+            # オートRNG実行中なら未抽選の経過時間分を反映してから表示する
+            auto_rng_found_items = materialize_auto_rng_rolls(user_id)
 
+            # デバッグプリントを追加して、user_data[user_id] の中身を確認
+            print(f"DEBUG: user_data content for {user_id}: {user_data.get(user_id)}")
+            data = user_data[user_id]
+            
+            # ★★★ インベントリをレアリティ順にソートして表示 ★★★
+            inventory_items_with_chances = []
+            for item_name, count in data["inventory"].items():
+                # rare_item_chances_denominator にアイテムが存在するか確認
+                if item_name in rare_item_chances_denominator:
+                    chance = rare_item_chances_denominator[item_name]
+                    inventory_items_with_chances.append((item_name, count, chance))
+                else:
+                    # もし確率リストにないアイテムがあれば、デフォルトの確率（非常に高いなど）を設定するか、無視
+                    print(f"WARNING: Item '{item_name}' not found in rare_item_chances_denominator. Skipping for status display.")
+                    inventory_items_with_chances.append((item_name, count, 0)) # 確率0で最後尾にするなど
 
-        # --- Potion Make コマンド ---
-        elif command_content.startswith("!make "):
-            print("DEBUG: Entering !make command block.")
-            try:
-                parts = command_content.split(" ")
-                if len(parts) < 3:
-                    await message.channel.send("使い方が間違っています。例: `!make rtx4070 1` または `!make rtx4070 all`")
-                    return
-
-                target_potion_name_input = parts[1]
-                quantity_str = parts[2]
-
-                # 入力されたポーション名からレシピを検索
-                target_recipe = None
-                for potion_name_in_recipe, recipe_data in LUCK_POTION_RECIPES.items():
-                    if potion_name_in_recipe.lower() == target_potion_name_input.lower():
-                        target_recipe = recipe_data
-                        break
+            # 確率（分母）が大きい順（出にくい順）にソート
+            inventory_items_with_chances.sort(key=lambda x: x[2], reverse=True)
 
-                if not target_recipe:
-                    await message.channel.send(f"指定されたポーション `{target_potion_name_input}` のレシピが見つかりません。`!recipe`で確認してください。")
-                    return
-
-                materials_needed = target_recipe["materials"]
-                output_potion_internal_name = list(target_recipe["output"].keys())[0]
-                output_potion_quantity_per_craft = list(target_recipe["output"].values())[0]
-
-                async with user_data_lock: # user_dataの読み書きをロックで保護
-                    user_inventory = user_data[user_id]["inventory"]
-                    user_luck_potions = user_data[user_id]["luck_potions"]
-
-                    max_craftable_count = float('inf')
-                    for material, needed_quantity in materials_needed.items():
-                        if needed_quantity > 0: # 0個必要な素材は無視
-                            if material not in user_inventory or user_inventory[material] < needed_quantity:
-                                max_craftable_count = 0 # 素材が足りなければ0
-                                break
-                            max_craftable_count = min(max_craftable_count, user_inventory[material] // needed_quantity)
-
-                    if max_craftable_count == 0:
-                        missing_materials = []
-                        for material, needed_quantity in materials_needed.items():
-                            owned = user_inventory.get(material, 0)
-                            if owned < needed_quantity:
-                                missing_materials.append(f"{material} ({needed_quantity - owned}個不足)")
-                        await message.channel.send(f"素材が足りません！足りない素材: {', '.join(missing_materials)}")
-                        return
-
-                    craft_count = 0
-                    if quantity_str.lower() == "all":
-                        craft_count = max_craftable_count
-                    else:
-                        try:
-                            craft_count = int(quantity_str)
-                            if craft_count <= 0:
-                                await message.channel.send("作成する個数は1以上である必要があります。")
-                                return
-                            if craft_count > max_craftable_count:
-                                await message.channel.send(f"素材が足りません。最大で{max_craftable_count}個作成できます。")
-                                return
-                        except ValueError:
-                            await message.channel.send("作成する個数は数字か 'all' で指定してください。")
-                            return
-
-                    # 素材を消費
-                    for material, needed_quantity in materials_needed.items():
-                        user_inventory[material] -= needed_quantity * craft_count
-                        if user_inventory[material] <= 0:
-                            del user_inventory[material]
-
-                    # ポーションを付与
-                    total_potions_made = output_potion_quantity_per_craft * craft_count
-                    user_luck_potions[output_potion_internal_name] = user_luck_potions.get(output_potion_internal_name, 0) + total_potions_made
-
-                    save_user_data()
-                print("DEBUG: Attempting to send !make confirmation message.")
-                await message.channel.send(f"{message.author.mention} は **{target_potion_name_input}** を {total_potions_made}個作成しました！")
-                print("DEBUG: !make confirmation message sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to process !make command or send message: {e}")
-                import traceback
-                traceback.print_exc()
+            inventory_str_lines = []
+            for item_name, count, chance in inventory_items_with_chances:
+                if chance > 0:
+                    inventory_str_lines.append(f"{item_name}: {count}個 (1 in {chance:,})")
+                else:
+                    # 確率が0のアイテムは「不明な確率」として表示
+                    inventory_str_lines.append(f"{item_name}: {count}個 (確率不明)")
+
+            inventory_str = "\n".join(inventory_str_lines) or "なし"
+            # ★★★ インベントリ表示修正ここまで ★★★
+
+
+            # Luck Potionの表示 (インベントリ)
+            luck_potions_str = ""
+            if data["luck_potions"]:
+                for potion_internal_name, count in data["luck_potions"].items():
+                    display_name = LUCK_POTION_DISPLAY_NAMES.get(potion_internal_name)
+                    if display_name:
+                        luck_potions_str += f"- {display_name}: {count}個\n"
+                if not luck_potions_str:
+                    luck_potions_str = "なし"
+            else:
+                luck_potions_str = "なし"
+
+            # 使用待ちLuck Potionの表示
+            active_potions_str = ""
+            if data["active_luck_potion_uses"]:
+                for internal_name, count in data["active_luck_potion_uses"].items():
+                    display_name = LUCK_POTION_DISPLAY_NAMES.get(internal_name)
+                    if display_name:
+                        active_potions_str += f"- {display_name}: 残り{count}回\n"
+                if not active_potions_str:
+                    active_potions_str = "なし"
+            else:
+                active_potions_str = "なし"
+
+            # デイリーログインブースト情報を取得
+            boost_info = data["daily_login"]["active_boost"]
+            boost_status = "なし"
+            current_luck_for_display = data["luck"] # 基本ラック (通常1.0)
+            if boost_info["end_time"]:
+                end_dt = datetime.datetime.fromtimestamp(boost_info["end_time"], tz=datetime.timezone.utc)
+                remaining_time = end_dt - datetime.datetime.now(datetime.timezone.utc)
+                if remaining_time.total_seconds() > 0:
+                    hours, remainder = divmod(int(remaining_time.total_seconds()), 3600)
+                    minutes, seconds = divmod(remainder, 60)
+                    boost_status = f"**{boost_info['multiplier']:.1f}倍** (残り {hours}h {minutes}m {seconds}s)"
+                    current_luck_for_display *= boost_info["multiplier"] # 表示ラックにデイリーログインブーストを乗算
+                else:
+                    boost_status = "期限切れ"
+            
+            # 管理者ブーストの表示
+            admin_boost_info = data["admin_boost"]
+            admin_boost_status = "なし"
+            if admin_boost_info["end_time"]:
+                admin_end_dt = datetime.datetime.fromtimestamp(admin_boost_info["end_time"], tz=datetime.timezone.utc)
+                admin_remaining_time = admin_end_dt - datetime.datetime.now(datetime.timezone.utc)
+                if admin_remaining_time.total_seconds() > 0:
+                    admin_hours, admin_remainder = divmod(int(admin_remaining_time.total_seconds()), 3600)
+                    admin_minutes, admin_seconds = divmod(admin_remainder, 60)
+                    admin_boost_status = f"**{admin_boost_info['multiplier']:.1f}倍** (残り {admin_hours}h {admin_minutes}m {admin_seconds}s)"
+                    current_luck_for_display *= admin_boost_info["multiplier"] # 表示ラックに管理者ブーストを乗算
+                else:
+                    admin_boost_status = "期限切れ"
+
+            # 全体ラックブースト (!boostluck) の表示
+            now_timestamp = time.time()
+            global_boost_lines = []
+            for boost in active_global_luck_boosts(now_timestamp):
+                global_hours, global_remainder = divmod(int(boost["end_time"] - now_timestamp), 3600)
+                global_minutes, global_seconds = divmod(global_remainder, 60)
+                global_boost_lines.append(f"**{boost['multiplier']:.1f}倍** (残り {global_hours}h {global_minutes}m {global_seconds}s)")
+            if global_boost_lines:
+                admin_boost_status = "\n".join(global_boost_lines if admin_boost_status in ("なし", "期限切れ") else [admin_boost_status, *global_boost_lines])
+                current_luck_for_display *= global_luck_multiplier(now_timestamp) # 表示ラックに全体ラックブーストを乗算
+
+            embed = discord.Embed(
+                title=f"{message.author.name} のステータス",
+                color=discord.Color.blue()
+            )
+            embed.add_field(name="**総ロール数**", value=f"{data['rolls']}", inline=False)
+            embed.add_field(name="**ラック**", value=f"{current_luck_for_display:.1f}", inline=False)
+            embed.add_field(name="**連続ログイン日数**", value=f"{data['daily_login']['consecutive_days']}日", inline=False)
+            embed.add_field(name="**現在のログインブースト**", value=boost_status, inline=False)
+            embed.add_field(name="**現在の管理者ブースト**", value=admin_boost_status, inline=False) # 管理者ブーストの表示を追加
+            embed.add_field(name="**アイテムインベントリ**", value=inventory_str, inline=False)
+            embed.add_field(name="**Luck Potionインベントリ**", value=luck_potions_str, inline=False)
+            embed.add_field(name="**使用待ちLuck Potion**", value=active_potions_str, inline=False)
+
+        print("DEBUG: Attempting to send !status embed.")
+        await send_reply(message.channel, embed=embed)
+        print("DEBUG: !status embed sent.")
+
+        queue_rare_drop_notifications(message.author.mention, auto_rng_found_items, source="オートRNG")
+    except Exception as e:
+        print(f"ERROR: Failed to process !status command or send embed: {e}")
+        import traceback
+        traceback.print_exc()
 
-        # --- Potion Use コマンド ---
-        elif command_content.startswith("!use "):
-            print("DEBUG: Entering !use command block.")
-            try:
-                parts = command_content.split(" ")
-                if len(parts) < 3:
-                    await message.channel.send("使い方が間違っています。例: `!use rtx4070 1` または `!use rtx4070 all`")
-                    return
-
-                target_potion_name_input = parts[1]
-                quantity_str = parts[2]
-
-                # 入力されたポーション名からレシピを検索し、内部名を取得
-                target_potion_internal_name = None
-                for potion_name_in_recipe, recipe_data in LUCK_POTION_RECIPES.items():
-                    if potion_name_in_recipe.lower() == target_potion_name_input.lower():
-                        target_potion_internal_name = list(recipe_data["output"].keys())[0]
+
+# --- アイテムリスト表示コマンド ---
+async def command_itemlist(message, context):
+    user_id = context.user_id
+    print(f"DEBUG: Entering !itemlist command block for user: {user_id}")
+    try:
+        # デバッグプリントを追加して、user_data[user_id] の中身を確認
+        print(f"DEBUG: user_data content for {user_id}: {user_data.get(user_id)}")
+        # user_data[user_id] が期待される辞書構造を持っているか確認
+        if not isinstance(user_data.get(user_id), dict) or "inventory" not in user_data[user_id]:
+            print(f"ERROR: User data for {user_id} is malformed or missing 'inventory' key. Data: {user_data.get(user_id)}")
+            await send_reply(message.channel, "ユーザーデータに問題があるため、アイテムリストを表示できませんでした。")
+            return # これ以上処理を進めない
+
+        user_inventory = user_data[user_id]["inventory"]
+
+        # 全ユーザーのアイテム総保持数 (差分で更新されている索引をそのまま参照する)
+        total_item_counts = server_item_totals
+
+        # アイテムをカテゴリ別に分類
+        normal_items = []
+        golden_items = []
+        rainbow_items = []
+
+        for item_name, chance_denominator in rare_item_chances_denominator.items():
+            if item_name.startswith("golden "):
+                golden_items.append((item_name, chance_denominator))
+            elif item_name.startswith("rainbow "):
+                rainbow_items.append((item_name, chance_denominator))
+            else:
+                normal_items.append((item_name, chance_denominator))
+
+        # 各カテゴリのアイテムをレアリティが高い（分母が大きい）順にソート
+        normal_items.sort(key=lambda item: item[1], reverse=True)
+        golden_items.sort(key=lambda item: item[1], reverse=True)
+        rainbow_items.sort(key=lambda item: item[1], reverse=True)
+
+        items_per_page = 10 # 1ページあたりのアイテム数
+
+        # 最初のページ（ノーマルアイテムリスト）を生成
+        print("DEBUG: Calling generate_itemlist_embed.")
+        initial_embed = await generate_itemlist_embed(user_id, 0, items_per_page, "normal", normal_items, total_item_counts)
+        
+        print("DEBUG: Attempting to send !itemlist embed.")
+        # メッセージ送信の成功/失敗をデバッグするために変数に格納
+        message_sent_obj = None
+        try:
+            message_sent_obj = await send_reply(message.channel, embed=initial_embed)
+            print(f"DEBUG: !itemlist embed sent successfully. Message ID: {message_sent_obj.id}")
+        except discord.Forbidden:
+            print(f"ERROR: Bot lacks permissions to send messages in channel {message.channel.id} for !itemlist.")
+            await message.author.send(f"申し訳ありません、このチャンネルでアイテムリストを送信する権限がありません。\n"
+                                      f"チャンネル名: `{message.channel.name}`, サーバー名: `{message.guild.name if message.guild else 'DM'}`")
+            return
+        except discord.HTTPException as http_e:
+            print(f"ERROR: HTTPException during !itemlist embed send: {http_e.status} {http_e.text}")
+            await send_reply(message.channel, "アイテムリストの送信中にDiscord APIエラーが発生しました。時間を置いて再度お試しください。")
+            return
+        except Exception as embed_e:
+            print(f"ERROR: Unexpected error while sending !itemlist embed: {embed_e}")
+            import traceback
+            traceback.print_exc()
+            await send_reply(message.channel, "アイテムリストの送信中に予期せぬエラーが発生しました。")
+            return
+
+        # message_sent_obj が None の場合は処理を中断
+        if message_sent_obj is None:
+            print("DEBUG: Message_sent_obj is None, stopping !itemlist processing.")
+            return
+
+
+        # ページネーションセッションを保存
+        pagination_sessions[message_sent_obj.id] = {
+            "user_id": user_id,
+            "current_page": 0,
+            "items_per_page": items_per_page,
+            "current_category": "normal",
+            "normal_items": normal_items,
+            "golden_items": golden_items,
+            "rainbow_items": rainbow_items,
+            "total_item_counts": total_item_counts
+        }
+        print("DEBUG: Pagination session saved.")
+
+        # リアクションを追加
+        print("DEBUG: Attempting to add reactions.")
+        try:
+            await message_sent_obj.add_reaction('◀️')
+            await message_sent_obj.add_reaction('▶️')
+            await message_sent_obj.add_reaction('🐾') # ノーマルアイテム
+            await message_sent_obj.add_reaction('⭐') # ゴールデンアイテム
+            await message_sent_obj.add_reaction('🌈') # レインボーアイテム
+            print("DEBUG: Reactions added successfully.")
+        except discord.Forbidden:
+            print(f"ERROR: Bot lacks permissions to add reactions in channel {message.channel.id} for !itemlist.")
+            # リアクション追加権限がない場合はユーザーに通知しない（よくあるため）
+        except discord.HTTPException as http_e:
+            print(f"ERROR: HTTPException during !itemlist reaction add: {http_e.status} {http_e.text}")
+        except Exception as react_e:
+            print(f"ERROR: Unexpected error while adding reactions for !itemlist: {react_e}")
+            import traceback
+            traceback.print_exc()
+
+    except Exception as e:
+        print(f"ERROR: Failed to process !itemlist command or send embed/reactions (outer try): {e}")
+        import traceback
+        traceback.print_exc()
+
+
+# --- ランキング表示コマンド ---
+RANKING_SIZE = 10 # ランキングに表示する人数
+RANKING_METRIC_ALIASES = {
+    "": LEADERBOARD_ROLLS, "rolls": LEADERBOARD_ROLLS, "ロール": LEADERBOARD_ROLLS,
+    "rarity": LEADERBOARD_RARITY, "レア度": LEADERBOARD_RARITY,
+}
+
+def parse_ranking_args(command_content):
+    """!ranking [rolls/rarity/アイテム名] (アイテム名は空白を含んでもよい)"""
+    parts = command_content.split(" ", 1)
+    return (parts[1].strip() if len(parts) > 1 else "",)
+
+async def command_ranking(message, context):
+    print("DEBUG: Entering !ranking command block.")
+    try:
+        (metric_arg,) = context.args
+        metric = RANKING_METRIC_ALIASES.get(metric_arg.lower())
+        if metric == LEADERBOARD_ROLLS:
+            title, unit_label, empty_text = "ロール数ランキング", "ロール数", "まだ誰もロールしていません。"
+        elif metric == LEADERBOARD_RARITY:
+            title, unit_label, empty_text = "レア度ランキング", "レア度スコア", "まだ誰もレアアイテムを持っていません。"
+        elif metric_arg in rare_item_chances_denominator or metric_arg in server_item_totals:
+            metric = item_leaderboard(metric_arg)
+            title, unit_label, empty_text = f"{metric_arg} 所持数ランキング", "所持数", f"まだ誰も {metric_arg} を持っていません。"
+        else:
+            await send_reply(message.channel, "ランキングの種類が見つかりません。`!ranking`、`!ranking rarity`、または `!ranking [アイテム名]` を指定してください。")
+            return
+
+        # 索引から上位を読むだけなので、ユーザー数によらず一定の手間で済む
+        top_entries = leaderboard_top(metric, RANKING_SIZE)
+        own_rank, own_score = leaderboard_rank(metric, context.user_id)
+        ranked_user_count = leaderboard_size(metric)
+
+        embed = discord.Embed(
+            title=title,
+            description=f"{unit_label}のトップ{RANKING_SIZE}です。",
+            color=discord.Color.gold()
+        )
+
+        # 上位ユーザーの取得はキャッシュを通してまとめて並行に行う
+        users = await resolve_users([user_id_str for user_id_str, _ in top_entries])
+        for rank, ((user_id_str, score), user) in enumerate(zip(top_entries, users), start=1):
+            if user is None:
+                print(f"WARNING: User not found for ranking display: {user_id_str}") # デバッグ用にIDを出力
+                embed.add_field(name=f"**#{rank} 不明なユーザー ({user_id_str})**", value=f"{unit_label}: {score:,}", inline=False)
+            else:
+                embed.add_field(name=f"**#{rank} {user.name}**", value=f"{unit_label}: {score:,}", inline=False)
+        if not top_entries:
+            embed.add_field(name="データなし", value=empty_text, inline=False)
+
+        if own_rank is not None:
+            embed.set_footer(text=f"あなたの順位: {own_rank:,}位 / {ranked_user_count:,}人 ({unit_label}: {own_score:,})")
+        else:
+            embed.set_footer(text=f"あなたはまだランキングに載っていません。({ranked_user_count:,}人が参加中)")
+
+        print("DEBUG: Attempting to send !ranking embed.")
+        await send_reply(message.channel, embed=embed)
+        print("DEBUG: !ranking embed sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to process !ranking command or send embed: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+# --- Luck Potion レシピ表示コマンド ---
+def build_recipe_embed():
+    """!recipe の埋め込みを作る"""
+    embed = discord.Embed(
+        title="Luck Potion 作成レシピ",
+        description="より強力なラックブーストを得るために、Luck Potionを合成しましょう！",
+        color=discord.Color.green()
+    )
+
+    for potion_name, recipe_data in LUCK_POTION_RECIPES.items():
+        materials_str = []
+        for material, quantity in recipe_data["materials"].items():
+            materials_str.append(f"{material} x {quantity}個")
+
+        output_quantity = list(recipe_data["output"].values())[0] # ポーションの個数
+        luck_multiplier = recipe_data["luck_multiplier"]
+
+        embed.add_field(
+            name=f"**{potion_name}**",
+            value=f"**効果:** ラック {luck_multiplier:,}倍 (1回のロール)\n"
+                  f"**素材:** {', '.join(materials_str)}\n"
+                  f"**作成数:** {output_quantity}個",
+            inline=False
+        )
+    return embed
+
+async def command_recipe(message, context):
+    print("DEBUG: Entering !recipe command block.")
+    try:
+        print("DEBUG: Attempting to send !recipe embed.")
+        await send_reply(message.channel, embed=get_static_embed("!recipe"))
+        print("DEBUG: !recipe embed sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to process !recipe command or send embed: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+STATIC_EMBED_BUILDERS = {
+    "!help": build_help_embed,
+    "!adminhelp": build_adminhelp_embed,
+    "!recipe": build_recipe_embed,
+}
+
+
+# --- Potion Make コマンド ---
+async def command_make(message, context):
+    user_id = context.user_id
+    print("DEBUG: Entering !make command block.")
+    try:
+        parts = context.args
+        if len(parts) < 3:
+            await send_reply(message.channel, "使い方が間違っています。例: `!make rtx4070 1` または `!make rtx4070 all`")
+            return
+
+        target_potion_name_input = parts[1]
+        quantity_str = parts[2]
+
+        # 入力されたポーション名からレシピを検索
+        recipe_name = LUCK_POTION_RECIPE_NAMES_BY_LOWER.get(target_potion_name_input.lower())
+        target_recipe = LUCK_POTION_RECIPES[recipe_name] if recipe_name else None
+
+        if not target_recipe:
+            await send_reply(message.channel, f"指定されたポーション `{target_potion_name_input}` のレシピが見つかりません。`!recipe`で確認してください。")
+            return
+
+        materials_needed = target_recipe["materials"]
+        output_potion_internal_name = list(target_recipe["output"].keys())[0]
+        output_potion_quantity_per_craft = list(target_recipe["output"].values())[0]
+
+        def make_potions():
+            """素材を消費してポーションを作成し、返信するメッセージを返す (ロック内で実行)"""
+            user_inventory = user_data[user_id]["inventory"]
+
+            max_craftable_count = float('inf')
+            for material, needed_quantity in materials_needed.items():
+                if needed_quantity > 0: # 0個必要な素材は無視
+                    if material not in user_inventory or user_inventory[material] < needed_quantity:
+                        max_craftable_count = 0 # 素材が足りなければ0
                         break
+                    max_craftable_count = min(max_craftable_count, user_inventory[material] // needed_quantity)
+
+            if max_craftable_count == 0:
+                missing_materials = []
+                for material, needed_quantity in materials_needed.items():
+                    owned = user_inventory.get(material, 0)
+                    if owned < needed_quantity:
+                        missing_materials.append(f"{material} ({needed_quantity - owned}個不足)")
+                return f"素材が足りません！足りない素材: {', '.join(missing_materials)}"
+
+            craft_count = 0
+            if quantity_str.lower() == "all":
+                craft_count = max_craftable_count
+            else:
+                try:
+                    craft_count = int(quantity_str)
+                    if craft_count <= 0:
+                        return "作成する個数は1以上である必要があります。"
+                    if craft_count > max_craftable_count:
+                        return f"素材が足りません。最大で{max_craftable_count}個作成できます。"
+                except ValueError:
+                    return "作成する個数は数字か 'all' で指定してください。"
+
+            # 素材を消費して、ポーションを付与
+            total_potions_made = output_potion_quantity_per_craft * craft_count
+            apply_user_delta(
+                user_id,
+                inventory={material: -needed_quantity * craft_count for material, needed_quantity in materials_needed.items() if needed_quantity > 0},
+                luck_potions={output_potion_internal_name: total_potions_made},
+            )
+            return f"{message.author.mention} は **{target_potion_name_input}** を {total_potions_made}個作成しました！"
+
+        async with user_lock(user_id): # user_dataの読み書きをロックで保護
+            reply = make_potions()
+        # 返信はロックを解放してから送信する
+        print("DEBUG: Attempting to send !make reply.")
+        await send_reply(message.channel, reply)
+        print("DEBUG: !make reply sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to process !make command or send message: {e}")
+        import traceback
+        traceback.print_exc()
 
-                if not target_potion_internal_name:
-                    await message.channel.send(f"指定されたポーション `{target_potion_name_input}` は存在しません。`!recipe`で確認してください。")
-                    return
 
-                async with user_data_lock: # user_dataの読み書きをロックで保護
-                    user_luck_potions = user_data[user_id]["luck_potions"]
-                    user_active_uses = user_data[user_id]["active_luck_potion_uses"]
+# --- Potion Use コマンド ---
+async def command_use(message, context):
+    user_id = context.user_id
+    print("DEBUG: Entering !use command block.")
+    try:
+        parts = context.args
+        if len(parts) < 3:
+            await send_reply(message.channel, "使い方が間違っています。例: `!use rtx4070 1` または `!use rtx4070 all`")
+            return
 
-                    owned_count = user_luck_potions.get(target_potion_internal_name, 0)
+        target_potion_name_input = parts[1]
+        quantity_str = parts[2]
 
-                    if owned_count == 0:
-                        await message.channel.send(f"**{target_potion_name_input}** を所持していません。")
-                        return
+        # 入力されたポーション名からレシピを検索し、内部名を取得
+        recipe_name = LUCK_POTION_RECIPE_NAMES_BY_LOWER.get(target_potion_name_input.lower())
+        target_potion_internal_name = next(iter(LUCK_POTION_RECIPES[recipe_name]["output"])) if recipe_name else None
 
-                    use_count = 0
-                    if quantity_str.lower() == "all":
-                        use_count = owned_count
-                    else:
-                        try:
-                            use_count = int(quantity_str)
-                            if use_count <= 0:
-                                await message.channel.send("使用する個数は1以上である必要があります。")
-                                return
-                            if use_count > owned_count:
-                                await message.channel.send(f"所持数が足りません。最大で{owned_count}個使用できます。")
-                                return
-                        except ValueError:
-                            await message.channel.send("使用する個数は数字か 'all' で指定してください。")
-                            return
-
-                    # ポーションを消費して、active_luck_potion_usesに追加
-                    user_luck_potions[target_potion_internal_name] -= use_count
-                    if user_luck_potions[target_potion_internal_name] <= 0:
-                        del user_luck_potions[target_potion_internal_name]
-
-                    user_active_uses[target_potion_internal_name] = user_active_uses.get(target_potion_internal_name, 0) + (use_count * 1) # 1個のポーションで1回使用
-
-                    save_user_data()
-                print("DEBUG: Attempting to send !use confirmation message.")
-                await message.channel.send(f"{message.author.mention} は **{target_potion_name_input}** を {use_count}個使用キューに追加しました。次のロールから効果が適用されます。")
-                print("DEBUG: !use confirmation message sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to process !use command or send message: {e}")
-                import traceback
-                traceback.print_exc()
+        if not target_potion_internal_name:
+            await send_reply(message.channel, f"指定されたポーション `{target_potion_name_input}` は存在しません。`!recipe`で確認してください。")
+            return
 
+        def queue_potions():
+            """ポーションを使用キューに追加し、返信するメッセージを返す (ロック内で実行)"""
+            user_luck_potions = user_data[user_id]["luck_potions"]
 
-        # --- Crafting コマンド ---
-        elif command_content.startswith("!craft "):
-            print("DEBUG: Entering !craft command block.")
-            try:
-                parts = command_content.split(" ")
-                if len(parts) < 3:
-                    await message.channel.send("使い方が間違っています。例: `!craft golden haka 5` または `!craft golden haka all`")
-                    return
-
-                target_item_name = " ".join(parts[1:-1])
-                quantity_str = parts[-1]
-
-                target_recipe = CRAFTING_RECIPES.get(target_item_name)
-
-                if not target_recipe:
-                    await message.channel.send(f"アイテム `{target_item_name}` の合成レシピが見つかりません。")
-                    return
-
-                materials_needed = target_recipe["materials"]
-                output_item = list(target_recipe["output"].keys())[0]
-                output_quantity_per_craft = list(target_recipe["output"].values())[0]
-
-                async with user_data_lock: # user_dataの読み書きをロックで保護
-                    user_inventory = user_data[user_id]["inventory"]
-
-                    # 最大合成可能数を計算
-                    max_craftable_count = float('inf')
-                    for material, needed_quantity in materials_needed.items():
-                        if needed_quantity > 0: # 0個必要な素材は無視
-                            if material not in user_inventory or user_inventory[material] < needed_quantity:
-                                max_craftable_count = 0 # 素材が足りなければ0
-                                break
-                            max_craftable_count = min(max_craftable_count, user_inventory[material] // needed_quantity)
-
-                    if max_craftable_count == 0:
-                        missing_materials = []
-                        for material, needed_quantity in materials_needed.items():
-                            owned = user_inventory.get(material, 0)
-                            if owned < needed_quantity:
-                                missing_materials.append(f"{material} ({needed_quantity - owned}個不足)")
-                        await message.channel.send(f"素材が足りません！足りない素材: {', '.join(missing_materials)}")
-                        return
-
-                    craft_count = 0
-                    if quantity_str.lower() == "all":
-                        craft_count = max_craftable_count
-                    else:
-                        try:
-                            craft_count = int(quantity_str)
-                            if craft_count <= 0:
-                                await message.channel.send("作成する個数は1以上である必要があります。")
-                                return
-                            if craft_count > max_craftable_count:
-                                await message.channel.send(f"素材が足りません。最大で{max_craftable_count}個作成できます。")
-                                return
-                        except ValueError:
-                            await message.channel.send("作成する個数は数字か 'all' で指定してください。")
-                            return
-
-                    # 素材を消費
-                    for material, needed_quantity in materials_needed.items():
-                        user_inventory[material] -= needed_quantity * craft_count
-                        if user_inventory[material] <= 0:
-                            del user_inventory[material]
-
-                    # 完成品を付与
-                    user_inventory[output_item] = user_inventory.get(output_item, 0) + (output_quantity_per_craft * craft_count)
-
-                    save_user_data()
-                print("DEBUG: Attempting to send !craft confirmation message.")
-                await message.channel.send(f"{message.author.mention} は **{output_item}** を {output_quantity_per_craft * craft_count}個合成しました！")
-                print("DEBUG: !craft confirmation message sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to process !craft command or send message: {e}")
-                import traceback
-                traceback.print_exc()
+            owned_count = user_luck_potions.get(target_potion_internal_name, 0)
 
+            if owned_count == 0:
+                return f"**{target_potion_name_input}** を所持していません。"
 
-        # --- 通常ユーザー用オートRNGコマンド ---
-        elif command_content == "!autorng":
-            print("DEBUG: Entering !autorng command block (regular user).")
-            try:
-                target_user = message.author
-                target_user_id_str = str(target_user.id)
-
-                # 既存のオートRNGが実行中か確認
-                if target_user_id_str in auto_rng_sessions and auto_rng_sessions[target_user_id_str]["task"] and not auto_rng_sessions[target_user_id_str]["task"].done():
-                    await message.channel.send(f"**{target_user.name}** のオートRNGはすでに実行中です。")
-                    return
-
-                session_duration_seconds = 6 * 3600 # 6時間
-
-                auto_rng_sessions[target_user_id_str] = {
-                    "task": bot.loop.create_task(auto_roll_task(target_user)),
-                    "found_items_log": {},
-                    "start_time": datetime.datetime.now(datetime.timezone.utc),
-                    "max_duration_seconds": session_duration_seconds
-                }
-                save_auto_rng_sessions()
-                print("DEBUG: Attempting to send !autorng start message.")
-                await message.channel.send(f"**{target_user.name}** のオートRNGを開始しました。結果はDMで送信されます。")
-                print("DEBUG: !autorng start message sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to process !autorng command or send message: {e}")
-                import traceback
-                traceback.print_exc()
+            use_count = 0
+            if quantity_str.lower() == "all":
+                use_count = owned_count
+            else:
+                try:
+                    use_count = int(quantity_str)
+                    if use_count <= 0:
+                        return "使用する個数は1以上である必要があります。"
+                    if use_count > owned_count:
+                        return f"所持数が足りません。最大で{owned_count}個使用できます。"
+                except ValueError:
+                    return "使用する個数は数字か 'all' で指定してください。"
 
+            # ポーションを消費して、active_luck_potion_usesに追加 (1個のポーションで1回使用)
+            apply_user_delta(
+                user_id,
+                luck_potions={target_potion_internal_name: -use_count},
+                active_luck_potion_uses={target_potion_internal_name: use_count * 1},
+            )
+            return f"{message.author.mention} は **{target_potion_name_input}** を {use_count}個使用キューに追加しました。次のロールから効果が適用されます。"
+
+        async with user_lock(user_id): # user_dataの読み書きをロックで保護
+            reply = queue_potions()
+        # 返信はロックを解放してから送信する
+        print("DEBUG: Attempting to send !use reply.")
+        await send_reply(message.channel, reply)
+        print("DEBUG: !use reply sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to process !use command or send message: {e}")
+        import traceback
+        traceback.print_exc()
 
-        # --- 管理者用オートRNG付与コマンド ---
-        elif command_content.startswith("!giveautorng"):
-            print("DEBUG: Entering !giveautorng command block (admin).")
-            try:
-                if message.author.id not in ADMIN_IDS:
-                    await message.channel.send("このコマンドは管理者のみが使用できます。")
-                    return
-
-                parts = command_content.split(" ")
-                if len(parts) < 2:
-                    await message.channel.send("管理者用`!giveautorng`の使い方が間違っています。`!giveautorng @ユーザー名`、`!giveautorng [ユーザーID]`、または`!giveautorng all`")
-                    return
-                
-                target_user = None
-                target_user_id_str = None
-
-                if len(message.mentions) > 0:
-                    target_user = message.mentions[0]
-                    target_user_id_str = str(target_user.id)
-                elif parts[1] == "all":
-                    target_user = "all" # 全ユーザー対象
-                    target_user_id_str = "all" # この値は特殊なケースとして扱う
-                else:
-                    try:
-                        target_user_id_str = parts[1]
-                        target_user = await bot.fetch_user(int(target_user_id_str))
-                    except (ValueError, discord.NotFound):
-                        await message.channel.send("無効なユーザー指定です。メンション、ユーザーID、または 'all' を使用してください。")
-                        return
-
-                if target_user == "all":
-                    await message.channel.send("全ユーザーのオートRNGを開始します。")
-                    users_to_start = []
-                    async with user_data_lock: # ロード時にuser_dataへのアクセスをロック
-                        for uid_str in user_data.keys():
-                            try:
-                                user_obj = await bot.fetch_user(int(uid_str))
-                                users_to_start.append(user_obj)
-                            except discord.NotFound:
-                                print(f"WARNING: User not found for admin !giveautorng: {uid_str}")
-                    for user_obj in users_to_start:
-                        if str(user_obj.id) in auto_rng_sessions and auto_rng_sessions[str(user_obj.id)]["task"] and not auto_rng_sessions[str(user_obj.id)]["task"].done():
-                            await message.channel.send(f"**{user_obj.name}** のオートRNGはすでに実行中です。")
-                        else:
-                            session_duration_seconds = 6 * 3600 # 6時間
-                            auto_rng_sessions[str(user_obj.id)] = {
-                                "task": bot.loop.create_task(auto_roll_task(user_obj)),
-                                "found_items_log": {},
-                                "start_time": datetime.datetime.now(datetime.timezone.utc),
-                                "max_duration_seconds": session_duration_seconds
-                            }
-                            save_auto_rng_sessions()
-                            await message.channel.send(f"**{user_obj.name}** のオートRNGを開始しました。結果はDMで送信されます。")
-                    return
-
-                # 特定のユーザーの場合
-                if target_user_id_str in auto_rng_sessions and auto_rng_sessions[target_user_id_str]["task"] and not auto_rng_sessions[target_user_id_str]["task"].done():
-                    await message.channel.send(f"**{target_user.name}** のオートRNGはすでに実行中です。")
-                    return
-
-                session_duration_seconds = 6 * 3600 # 6時間
-
-                auto_rng_sessions[target_user_id_str] = {
-                    "task": bot.loop.create_task(auto_roll_task(target_user)),
-                    "found_items_log": {}, # ここを辞書で初期化
-                    "start_time": datetime.datetime.now(datetime.timezone.utc),
-                    "max_duration_seconds": session_duration_seconds
-                }
+
+# --- Crafting コマンド ---
+async def command_craft(message, context):
+    user_id = context.user_id
+    print("DEBUG: Entering !craft command block.")
+    try:
+        parts = context.args
+        if len(parts) < 3:
+            await send_reply(message.channel, "使い方が間違っています。例: `!craft golden haka 5` または `!craft golden haka all`")
+            return
+
+        target_item_name = " ".join(parts[1:-1])
+        quantity_str = parts[-1]
+
+        target_recipe = CRAFTING_RECIPES.get(target_item_name)
+
+        if not target_recipe:
+            await send_reply(message.channel, f"アイテム `{target_item_name}` の合成レシピが見つかりません。")
+            return
+
+        materials_needed = target_recipe["materials"]
+        output_item = list(target_recipe["output"].keys())[0]
+        output_quantity_per_craft = list(target_recipe["output"].values())[0]
+
+        def craft_items():
+            """素材を消費してアイテムを合成し、返信するメッセージを返す (ロック内で実行)"""
+            user_inventory = user_data[user_id]["inventory"]
+
+            # 最大合成可能数を計算
+            max_craftable_count = float('inf')
+            for material, needed_quantity in materials_needed.items():
+                if needed_quantity > 0: # 0個必要な素材は無視
+                    if material not in user_inventory or user_inventory[material] < needed_quantity:
+                        max_craftable_count = 0 # 素材が足りなければ0
+                        break
+                    max_craftable_count = min(max_craftable_count, user_inventory[material] // needed_quantity)
+
+            if max_craftable_count == 0:
+                missing_materials = []
+                for material, needed_quantity in materials_needed.items():
+                    owned = user_inventory.get(material, 0)
+                    if owned < needed_quantity:
+                        missing_materials.append(f"{material} ({needed_quantity - owned}個不足)")
+                return f"素材が足りません！足りない素材: {', '.join(missing_materials)}"
+
+            craft_count = 0
+            if quantity_str.lower() == "all":
+                craft_count = max_craftable_count
+            else:
+                try:
+                    craft_count = int(quantity_str)
+                    if craft_count <= 0:
+                        return "作成する個数は1以上である必要があります。"
+                    if craft_count > max_craftable_count:
+                        return f"素材が足りません。最大で{max_craftable_count}個作成できます。"
+                except ValueError:
+                    return "作成する個数は数字か 'all' で指定してください。"
+
+            # 素材を消費して、完成品を付与
+            inventory_changes = {material: -needed_quantity * craft_count for material, needed_quantity in materials_needed.items() if needed_quantity > 0}
+            inventory_changes[output_item] = inventory_changes.get(output_item, 0) + (output_quantity_per_craft * craft_count)
+            apply_user_delta(user_id, inventory=inventory_changes)
+            return f"{message.author.mention} は **{output_item}** を {output_quantity_per_craft * craft_count}個合成しました！"
+
+        async with user_lock(user_id): # user_dataの読み書きをロックで保護
+            reply = craft_items()
+        # 返信はロックを解放してから送信する
+        print("DEBUG: Attempting to send !craft reply.")
+        await send_reply(message.channel, reply)
+        print("DEBUG: !craft reply sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to process !craft command or send message: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+# --- 通常ユーザー用オートRNGコマンド ---
+async def command_autorng(message, context):
+    print("DEBUG: Entering !autorng command block (regular user).")
+    try:
+        target_user = message.author
+        target_user_id_str = str(target_user.id)
+
+        # 既存のオートRNGが実行中か確認
+        if target_user_id_str in auto_rng_sessions:
+            await send_reply(message.channel, f"**{target_user.name}** のオートRNGはすでに実行中です。")
+            return
+
+        create_auto_rng_session(target_user)
+        save_auto_rng_sessions()
+        print("DEBUG: Attempting to send !autorng start message.")
+        await send_reply(message.channel, f"**{target_user.name}** のオートRNGを開始しました。結果はDMで送信されます。")
+        print("DEBUG: !autorng start message sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to process !autorng command or send message: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+# --- 管理者用オートRNG付与コマンド ---
+async def command_giveautorng(message, context):
+    print("DEBUG: Entering !giveautorng command block (admin).")
+    try:
+        parts = context.args
+        if len(parts) < 2:
+            await send_reply(message.channel, "管理者用`!giveautorng`の使い方が間違っています。`!giveautorng @ユーザー名`、`!giveautorng [ユーザーID]`、または`!giveautorng all`")
+            return
+        
+        target_user = None
+        target_user_id_str = None
+
+        if len(message.mentions) > 0:
+            target_user = message.mentions[0]
+            target_user_id_str = str(target_user.id)
+        elif parts[1] == "all":
+            target_user = "all" # 全ユーザー対象
+            target_user_id_str = "all" # この値は特殊なケースとして扱う
+        else:
+            target_user_id_str = parts[1]
+            target_user = await resolve_user(target_user_id_str) if target_user_id_str.isdigit() else None
+            if target_user is None:
+                await send_reply(message.channel, "無効なユーザー指定です。メンション、ユーザーID、または 'all' を使用してください。")
+                return
+
+        if target_user == "all":
+            await send_reply(message.channel, "全ユーザーのオートRNGを開始します。")
+            bootstrap_start = time.perf_counter()
+            # すでに実行中のユーザーを除き、残りはユーザーを取得せずにIDだけで1回で登録して1回だけ保存する
+            # (ユーザーは結果のDMを送るときに取得する)
+            uid_strs_to_start = [uid_str for uid_str in user_data if uid_str not in auto_rng_sessions]
+            already_running_count = len(user_data) - len(uid_strs_to_start)
+            if uid_strs_to_start:
+                create_auto_rng_sessions(uid_strs_to_start)
                 save_auto_rng_sessions()
-                print("DEBUG: Attempting to send !giveautorng start message.")
-                await message.channel.send(f"**{target_user.name}** のオートRNGを開始しました。結果はDMで送信されます。")
-                print("DEBUG: !giveautorng start message sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to process !giveautorng command or send message: {e}")
-                import traceback
-                traceback.print_exc()
 
+            embed = discord.Embed(
+                title="全ユーザーのオートRNGを開始しました",
+                description="結果は各ユーザーにDMで送信されます。",
+                color=discord.Color.green()
+            )
+            embed.add_field(name="開始", value=f"{len(uid_strs_to_start):,}人", inline=True)
+            embed.add_field(name="すでに実行中", value=f"{already_running_count:,}人", inline=True)
+            embed.set_footer(text=f"処理時間: {time.perf_counter() - bootstrap_start:.1f}秒")
+            await send_reply(message.channel, embed=embed)
+            return
 
-        # --- オートRNG停止コマンド ---
-        elif command_content == "!autostop":
-            print("DEBUG: Entering !autostop command block.")
-            try:
-                if user_id in auto_rng_sessions and auto_rng_sessions[user_id]["task"] and not auto_rng_sessions[user_id]["task"].done():
-                    auto_rng_sessions[user_id]["task"].cancel()
-                    print("DEBUG: Attempting to send !autostop confirmation message.")
-                    await message.channel.send(f"{message.author.mention} のオートRNGを停止しました。結果はDMで送信されます。")
-                    print("DEBUG: !autostop confirmation message sent.")
-                else:
-                    await message.channel.send(f"{message.author.mention} のオートRNGは現在実行されていません。")
-            except Exception as e:
-                print(f"ERROR: Failed to process !autostop command or send message: {e}")
-                import traceback
-                traceback.print_exc()
+        # 特定のユーザーの場合
+        if target_user_id_str in auto_rng_sessions:
+            await send_reply(message.channel, f"**{target_user.name}** のオートRNGはすでに実行中です。")
+            return
 
-        # --- オートRNG残り時間確認コマンド ---
-        elif command_content == "!autorngtime":
-            print("DEBUG: Entering !autorngtime command block.")
-            try:
-                if user_id in auto_rng_sessions and auto_rng_sessions[user_id]["task"] and not auto_rng_sessions[user_id]["task"].done():
-                    session_data = auto_rng_sessions[user_id]
+        create_auto_rng_session(target_user)
+        save_auto_rng_sessions()
+        print("DEBUG: Attempting to send !giveautorng start message.")
+        await send_reply(message.channel, f"**{target_user.name}** のオートRNGを開始しました。結果はDMで送信されます。")
+        print("DEBUG: !giveautorng start message sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to process !giveautorng command or send message: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+# --- オートRNG停止コマンド ---
+async def command_autostop(message, context):
+    user_id = context.user_id
+    print("DEBUG: Entering !autostop command block.")
+    try:
+        if user_id in auto_rng_sessions:
+            print("DEBUG: Attempting to send !autostop confirmation message.")
+            await send_reply(message.channel, f"{message.author.mention} のオートRNGを停止しました。結果はDMで送信されます。")
+            print("DEBUG: !autostop confirmation message sent.")
+            await stop_auto_rng_session(user_id, "手動停止")
+        else:
+            await send_reply(message.channel, f"{message.author.mention} のオートRNGは現在実行されていません。")
+    except Exception as e:
+        print(f"ERROR: Failed to process !autostop command or send message: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+# --- オートRNG残り時間確認コマンド ---
+async def command_autorngtime(message, context):
+    user_id = context.user_id
+    print("DEBUG: Entering !autorngtime command block.")
+    try:
+        if user_id in auto_rng_sessions:
+            session_data = auto_rng_sessions[user_id]
+            start_time = session_data["start_time"]
+            max_duration_seconds = session_data["max_duration_seconds"]
+
+            # 早送りモードで未抽選の経過時間分をここで抽選する
+            async with user_lock(user_id):
+                found_items = materialize_auto_rng_rolls(user_id)
+            queue_rare_drop_notifications(message.author.mention, found_items, source="オートRNG")
+
+            # 修正: current_time_utcもタイムゾーン情報を持つようにする
+            current_time_utc = datetime.datetime.now(datetime.timezone.utc)
+            elapsed_time = (current_time_utc - start_time).total_seconds()
+            remaining_time_seconds = max_duration_seconds - elapsed_time
+
+            if remaining_time_seconds <= 0:
+                await send_reply(message.channel, f"{message.author.mention} のオートRNGはすでに終了しています。")
+            else:
+                hours, remainder = divmod(int(remaining_time_seconds), 3600)
+                minutes, seconds = divmod(remainder, 60)
+                print("DEBUG: Attempting to send !autorngtime message.")
+                await send_reply(message.channel, f"{message.author.mention} のオートRNG残り時間: **{hours}時間 {minutes}分 {seconds}秒** (これまでのロール数: {session_data['rolls_credited']:,}回)")
+                print("DEBUG: !autorngtime message sent.")
+        else:
+            await send_reply(message.channel, f"{message.author.mention} のオートRNGは現在実行されていません。")
+    except Exception as e:
+        print(f"ERROR: Failed to process !autorngtime command or send message: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+# --- 管理者向けオートRNG状況確認コマンド ---
+async def command_adminautorng(message, context):
+    print("DEBUG: Entering !adminautorng command block.")
+    try:
+        active_sessions = []
+        for uid, session_data in list(auto_rng_sessions.items()):
+            if not session_data["awaiting_resume"]: # 再開待ちのセッションは除く
+                try:
+                    # セッションが持っているユーザーを使い、取得し直さない (!giveautorng all のセッションはIDで表示)
+                    user_name = session_data["user"].name if session_data["user"] is not None else f"<@{uid}>"
                     start_time = session_data["start_time"]
                     max_duration_seconds = session_data["max_duration_seconds"]
-
+                    
                     # 修正: current_time_utcもタイムゾーン情報を持つようにする
                     current_time_utc = datetime.datetime.now(datetime.timezone.utc)
                     elapsed_time = (current_time_utc - start_time).total_seconds()
                     remaining_time_seconds = max_duration_seconds - elapsed_time
 
-                    if remaining_time_seconds <= 0:
-                        await message.channel.send(f"{message.author.mention} のオートRNGはすでに終了しています。")
-                    else:
+                    if remaining_time_seconds > 0:
                         hours, remainder = divmod(int(remaining_time_seconds), 3600)
                         minutes, seconds = divmod(remainder, 60)
-                        print("DEBUG: Attempting to send !autorngtime message.")
-                        await message.channel.send(f"{message.author.mention} のオートRNG残り時間: **{hours}時間 {minutes}分 {seconds}秒**")
-                        print("DEBUG: !autorngtime message sent.")
-                else:
-                    await message.channel.send(f"{message.author.mention} のオートRNGは現在実行されていません。")
-            except Exception as e:
-                print(f"ERROR: Failed to process !autorngtime command or send message: {e}")
-                import traceback
-                traceback.print_exc()
+                        active_sessions.append(f"・{user_name} (ID: {uid}): 残り {hours}h {minutes}m {seconds}s")
+                    else:
+                        active_sessions.append(f"・{user_name} (ID: {uid}): 期限切れ (データ更新待ち)") # 時間切れだがまだセッションに残っている場合
+                except Exception as e:
+                    print(f"ERROR: Error during adminautorng display for user ID: {uid}: {e}")
+                    active_sessions.append(f"・{uid}: データの読み込みエラー ({e})")
+
+        if active_sessions:
+            embed = discord.Embed(
+                title="現在実行中のオートRNGセッション",
+                description="\n".join(active_sessions),
+                color=discord.Color.red()
+            )
+            print("DEBUG: Attempting to send !adminautorng embed.")
+            await send_reply(message.channel, embed=embed)
+            print("DEBUG: !adminautorng embed sent.")
+        else:
+            await send_reply(message.channel, "現在、実行中のオートRNGセッションはありません。")
+    except Exception as e:
+        print(f"ERROR: Failed to process !adminautorng command or send embed: {e}")
+        import traceback
+        traceback.print_exc()
 
-        # --- 管理者向けオートRNG状況確認コマンド ---
-        elif command_content == "!adminautorng":
-            print("DEBUG: Entering !adminautorng command block.")
-            try:
-                if message.author.id not in ADMIN_IDS:
-                    await message.channel.send("このコマンドは管理者のみが使用できます。")
-                    return
-
-                active_sessions = []
-                for uid, session_data in auto_rng_sessions.items():
-                    if session_data["task"] and not session_data["task"].done():
-                        try:
-                            user_obj = await bot.fetch_user(int(uid))
-                            start_time = session_data["start_time"]
-                            max_duration_seconds = session_data["max_duration_seconds"]
-                            
-                            # 修正: current_time_utcもタイムゾーン情報を持つようにする
-                            current_time_utc = datetime.datetime.now(datetime.timezone.utc)
-                            elapsed_time = (current_time_utc - start_time).total_seconds()
-                            remaining_time_seconds = max_duration_seconds - elapsed_time
-
-                            if remaining_time_seconds > 0:
-                                hours, remainder = divmod(int(remaining_time_seconds), 3600)
-                                minutes, seconds = divmod(remainder, 60)
-                                active_sessions.append(f"・{user_obj.name} (ID: {uid}): 残り {hours}h {minutes}m {seconds}s")
-                            else:
-                                active_sessions.append(f"・{user_obj.name} (ID: {uid}): 期限切れ (データ更新待ち)") # 時間切れだがまだセッションに残っている場合
-                        except discord.NotFound:
-                            print(f"WARNING: User not found for adminautorng display: {uid}") # デバッグ用にIDを出力
-                            active_sessions.append(f"・不明なユーザー (ID: {uid}): (ユーザーが見つかりません)")
-                        except Exception as e:
-                            print(f"ERROR: Error during adminautorng display for user ID: {uid}: {e}")
-                            active_sessions.append(f"・{uid}: データの読み込みエラー ({e})")
-
-                if active_sessions:
-                    embed = discord.Embed(
-                        title="現在実行中のオートRNGセッション",
-                        description="\n".join(active_sessions),
-                        color=discord.Color.red()
-                    )
-                    print("DEBUG: Attempting to send !adminautorng embed.")
-                    await message.channel.send(embed=embed)
-                    print("DEBUG: !adminautorng embed sent.")
-                else:
-                    await message.channel.send("現在、実行中のオートRNGセッションはありません。")
-            except Exception as e:
-                print(f"ERROR: Failed to process !adminautorng command or send embed: {e}")
-                import traceback
-                traceback.print_exc()
 
-        # --- 管理者向けラックブーストコマンド ---
-        elif command_content.startswith("!boostluck"):
-            print("DEBUG: Entering !boostluck command block.")
-            try:
-                if message.author.id not in ADMIN_IDS:
-                    await message.channel.send("このコマンドは管理者のみが使用できます。")
-                    return
+# --- 管理者向けラックブーストコマンド ---
+async def command_boostluck(message, context):
+    print("DEBUG: Entering !boostluck command block.")
+    try:
+        parts = context.args
+        if len(parts) == 2 and parts[1] == "clear":
+            cancelled_count = clear_global_luck_boosts()
+            await send_reply(message.channel, f"全体ラックブーストを{cancelled_count}件取り消しました。")
+            return
+        if len(parts) not in (3, 4):
+            await send_reply(message.channel, "使い方が間違っています。例: `!boostluck 1.5 60` (1.5倍、60秒)、`!boostluck 2 600 3600` (1時間後から2倍、600秒)、`!boostluck clear`")
+            return
 
-                parts = command_content.split(" ")
-                if len(parts) != 3:
-                    await message.channel.send("使い方が間違っています。例: `!boostluck 1.5 60` (1.5倍、60秒)")
-                    return
+        try:
+            multiplier = float(parts[1])
+            duration_seconds = int(parts[2])
+            delay_seconds = int(parts[3]) if len(parts) == 4 else 0
+            if multiplier <= 0 or duration_seconds <= 0 or delay_seconds < 0:
+                await send_reply(message.channel, "倍率と秒数は正の数、開始までの秒数は0以上である必要があります。")
+                return
+        except ValueError:
+            await send_reply(message.channel, "倍率と秒数は数値で指定してください。")
+            return
 
-                try:
-                    multiplier = float(parts[1])
-                    duration_seconds = int(parts[2])
-                    if multiplier <= 0 or duration_seconds <= 0:
-                        await message.channel.send("倍率と秒数は正の数である必要があります。")
-                        return
-                except ValueError:
-                    await message.channel.send("倍率と秒数は数値で指定してください。")
-                    return
-
-                end_time_timestamp = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=duration_seconds)).timestamp()
-
-                async with user_data_lock: # 全ユーザーのuser_dataを変更するためロック
-                    for uid in user_data:
-                        # user_data[uid]["luck"] は、デイリーログインブーストとは別に、
-                        # 管理者による一時的な基本ラック変更として使用される想定です。
-                        # ここでは直接変更し、デイリーログインブーストは `perform_roll` や表示時に乗算されます。
-                        user_data[uid]["luck"] = multiplier 
-                        # 管理者ブースト情報も更新
-                        user_data[uid]["admin_boost"] = {
-                            "multiplier": multiplier,
-                            "end_time": end_time_timestamp
-                        }
-                    save_user_data()
-
-                print("DEBUG: Attempting to send !boostluck start message.")
-                await message.channel.send(f"全員のラックを一時的に **{multiplier:.1f}倍** にしました！ ({duration_seconds}秒間有効)")
-                print("DEBUG: !boostluck start message sent.")
-
-                # 指定時間後に元のラックに戻すタスクをスケジュール
-                await asyncio.sleep(duration_seconds)
-
-                async with user_data_lock: # 全ユーザーのuser_dataを変更するためロック
-                    for uid in user_data:
-                        # デイリーログインブーストが残っている場合を考慮し、
-                        # ここではluckを1.0に戻すだけで、デイリーログインブーストはそのまま維持される
-                        user_data[uid]["luck"] = 1.0
-                        user_data[uid]["admin_boost"] = { # 管理者ブーストをリセット
-                            "multiplier": 1.0,
-                            "end_time": None
-                        }
-                    save_user_data()
-                await message.channel.send("全員のラックブーストが終了し、元のラックに戻りました。")
-            except Exception as e:
-                print(f"ERROR: Failed to process !boostluck command or send message: {e}")
-                import traceback
-                traceback.print_exc()
+        # ユーザーごとのデータは書き換えず、全体ブーストを1件追加するだけ (ユーザー数によらず O(1))
+        start_timestamp = time.time() + delay_seconds
+        add_global_luck_boost(multiplier, start_timestamp, start_timestamp + duration_seconds, message.channel.id)
 
-        # --- 管理者向け全データリセットコマンド ---
-        elif command_content == "!resetall":
-            print("DEBUG: Entering !resetall command block.")
-            try:
-                if message.author.id not in ADMIN_IDS:
-                    await message.channel.send("このコマンドは管理者のみが使用できます。")
-                    return
+        print("DEBUG: Attempting to send !boostluck start message.")
+        if delay_seconds > 0:
+            await send_reply(message.channel, f"{delay_seconds}秒後から全員のラックを **{multiplier:.1f}倍** にするブーストを予約しました！ ({duration_seconds}秒間有効)")
+        else:
+            await send_reply(message.channel, f"全員のラックを一時的に **{multiplier:.1f}倍** にしました！ ({duration_seconds}秒間有効)")
+        print("DEBUG: !boostluck start message sent.")
 
-                # 念のため確認メッセージ
-                await message.channel.send("**警告: 全ユーザーのデータがリセットされます。本当に実行しますか？ `yes` と入力して10秒以内に送信してください。**")
+        # 開始・終了のお知らせは期限切れの予定表から送られる
+    except Exception as e:
+        print(f"ERROR: Failed to process !boostluck command or send message: {e}")
+        import traceback
+        traceback.print_exc()
 
-                def check(m):
-                    return m.author == message.author and m.channel == message.channel and m.content.lower() == 'yes'
 
-                try:
-                    confirm_message = await bot.wait_for('message', check=check, timeout=10.0)
-                    if confirm_message:
-                        async with user_data_lock: # データをリセットする前にロック
-                            user_data = {} # 全データをクリア
-                            save_user_data()
-
-                            for session_id, session_data in auto_rng_sessions.items():
-                                if session_data["task"] and not session_data["task"].done():
-                                    session_data["task"].cancel() # 実行中のオートRNGタスクを停止
-                            auto_rng_sessions = {} # オートRNGセッションもクリア
-                            save_auto_rng_sessions()
-
-                        await message.channel.send("全ユーザーのデータとオートRNGセッションがリセットされました。")
-                except asyncio.TimeoutError:
-                    await message.channel.send("確認がタイムアウトしました。データのリセットはキャンセルされました。")
-                except Exception as e:
-                    print(f"ERROR: Error during !resetall confirmation or processing: {e}")
-                    import traceback
-                    traceback.print_exc()
-            except Exception as e:
-                print(f"ERROR: Failed to process !resetall command or send message: {e}")
-                import traceback
-                traceback.print_exc()
+# --- 管理者向け全データリセットコマンド ---
+async def command_resetall(message, context):
+    global user_data
+    global auto_rng_sessions
+    print("DEBUG: Entering !resetall command block.")
+    try:
+        # 念のため確認メッセージ
+        await send_reply(message.channel, "**警告: 全ユーザーのデータがリセットされます。本当に実行しますか？ `yes` と入力して10秒以内に送信してください。**")
 
-        # --- 新しい管理者向けユーザーデータ削除コマンド ---
-        elif command_content.startswith("!delete"):
-            print("DEBUG: Entering !delete command block (admin).")
-            try:
-                if message.author.id not in ADMIN_IDS:
-                    await message.channel.send("このコマンドは管理者のみが使用できます。")
-                    return
-                
-                parts = command_content.split(" ")
-                if len(parts) < 2:
-                    await message.channel.send("使い方が間違っています。例: `!delete @ユーザー名`, `!delete [ユーザーID]`, または `!delete all`")
-                    return
-
-                target = parts[1]
-                target_user_ids_to_delete = []
-                target_names_to_report = []
-
-                if target == "all":
-                    target_user_ids_to_delete = list(user_data.keys())
-                    target_names_to_report = ["全ユーザー"]
-                else:
-                    user_obj = None
-                    try:
-                        # メンションからIDを抽出 (メンション形式は <@!ID> または <@ID>)
-                        if message.mentions and str(message.mentions[0].id) == target.replace("<@", "").replace(">", "").replace("!", ""): 
-                            user_obj = message.mentions[0]
-                        else: # IDが直接指定された場合
-                            user_obj = await bot.fetch_user(int(target))
-                        target_user_ids_to_delete.append(str(user_obj.id))
-                        target_names_to_report.append(user_obj.name)
-                    except (ValueError, discord.NotFound):
-                        await message.channel.send("指定されたユーザーが見つかりません。メンションまたは有効なユーザーIDを使用してください。")
-                        return
-                
-                if not target_user_ids_to_delete:
-                    await message.channel.send("削除対象のユーザーが指定されていません。")
-                    return
-
-                confirmation_message_text = f"**警告: {', '.join(target_names_to_report)} の全てのデータが削除されます。** オートRNGセッションも停止されます。本当に実行しますか？ `yes` と入力して10秒以内に送信してください。"
-                await message.channel.send(confirmation_message_text)
-
-                def check(m):
-                    return m.author == message.author and m.channel == message.channel and m.content.lower() == 'yes'
+        def check(m):
+            return m.author == message.author and m.channel == message.channel and m.content.lower() == 'yes'
 
-                try:
-                    confirm_message = await bot.wait_for('message', check=check, timeout=10.0)
-                    if confirm_message:
-                        async with user_data_lock:
-                            for uid_to_delete in target_user_ids_to_delete:
-                                if uid_to_delete in user_data:
-                                    del user_data[uid_to_delete]
-                                    print(f"DEBUG: Deleted user data for {uid_to_delete}.")
-                                
-                                # オートRNGセッションも停止・削除
-                                if uid_to_delete in auto_rng_sessions:
-                                    if auto_rng_sessions[uid_to_delete]["task"] and not auto_rng_sessions[uid_to_delete]["task"].done():
-                                        auto_rng_sessions[uid_to_delete]["task"].cancel()
-                                        print(f"DEBUG: Cancelled auto-RNG task for {uid_to_delete}.")
-                                    del auto_rng_sessions[uid_to_delete]
-                                    print(f"DEBUG: Deleted auto-RNG session for {uid_to_delete}.")
-                                
-                                # オートRNG保存カウンターも削除
-                                if uid_to_delete in last_auto_rng_save_rolls:
-                                    del last_auto_rng_save_rolls[uid_to_delete]
-                                if uid_to_delete in last_auto_rng_save_time:
-                                    del last_auto_rng_save_time[uid_to_delete]
-
-                            save_user_data()
-                            save_auto_rng_sessions()
-                            await message.channel.send(f"{', '.join(target_names_to_report)} のデータとオートRNGセッションが削除されました。")
-                    else:
-                        await message.channel.send("確認が一致しませんでした。データ削除はキャンセルされました。")
-                except asyncio.TimeoutError:
-                    await message.channel.send("確認がタイムアウトしました。データ削除はキャンセルされました。")
-                except Exception as e:
-                    print(f"ERROR: Error during !delete command processing: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    await message.channel.send(f"データ削除中にエラーが発生しました: {e}")
+        try:
+            confirm_message = await bot.wait_for('message', check=check, timeout=10.0)
+            if confirm_message:
+                async with all_user_locks(): # データをリセットする前に全ストライプをロック
+                    user_data = {} # 全データをクリア
+                    journal_all_users_deleted()
 
-            except Exception as e:
-                print(f"ERROR: Failed to process !delete command or send message: {e}")
-                import traceback
-                traceback.print_exc()
+                    auto_rng_sessions = {} # オートRNGセッションもクリア (スケジューラの処理対象から外れる)
+                    save_auto_rng_sessions()
 
-        # --- 新しいデバッグ用コマンド ---
-        elif command_content == "!test":
-            print("DEBUG: Entering !test command block.")
-            try:
-                await message.channel.send("ボットは正常に動作しています！")
-                print("DEBUG: !test response sent.")
-            except Exception as e:
-                print(f"ERROR: Failed to send !test response: {e}")
-                import traceback
-                traceback.print_exc()
+                await send_reply(message.channel, "全ユーザーのデータとオートRNGセッションがリセットされました。")
+        except asyncio.TimeoutError:
+            await send_reply(message.channel, "確認がタイムアウトしました。データのリセットはキャンセルされました。")
+        except Exception as e:
+            print(f"ERROR: Error during !resetall confirmation or processing: {e}")
+            import traceback
+            traceback.print_exc()
+    except Exception as e:
+        print(f"ERROR: Failed to process !resetall command or send message: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+# --- 新しい管理者向けユーザーデータ削除コマンド ---
+async def command_delete(message, context):
+    print("DEBUG: Entering !delete command block (admin).")
+    try:
+        parts = context.args
+        if len(parts) < 2:
+            await send_reply(message.channel, "使い方が間違っています。例: `!delete @ユーザー名`, `!delete [ユーザーID]`, または `!delete all`")
+            return
+
+        target = parts[1]
+        target_user_ids_to_delete = []
+        target_names_to_report = []
+
+        if target == "all":
+            target_user_ids_to_delete = list(user_data.keys())
+            target_names_to_report = ["全ユーザー"]
+        else:
+            user_obj = None
+            # メンションからIDを抽出 (メンション形式は <@!ID> または <@ID>)
+            if message.mentions and str(message.mentions[0].id) == target.replace("<@", "").replace(">", "").replace("!", ""): 
+                user_obj = message.mentions[0]
+            elif target.isdigit(): # IDが直接指定された場合
+                user_obj = await resolve_user(target)
+            if user_obj is None:
+                await send_reply(message.channel, "指定されたユーザーが見つかりません。メンションまたは有効なユーザーIDを使用してください。")
+                return
+            target_user_ids_to_delete.append(str(user_obj.id))
+            target_names_to_report.append(user_obj.name)
         
+        if not target_user_ids_to_delete:
+            await send_reply(message.channel, "削除対象のユーザーが指定されていません。")
+            return
+
+        confirmation_message_text = f"**警告: {', '.join(target_names_to_report)} の全てのデータが削除されます。** オートRNGセッションも停止されます。本当に実行しますか？ `yes` と入力して10秒以内に送信してください。"
+        await send_reply(message.channel, confirmation_message_text)
+
+        def check(m):
+            return m.author == message.author and m.channel == message.channel and m.content.lower() == 'yes'
+
+        try:
+            confirm_message = await bot.wait_for('message', check=check, timeout=10.0)
+            if confirm_message:
+                async with all_user_locks():
+                    for uid_to_delete in target_user_ids_to_delete:
+                        if uid_to_delete in user_data:
+                            remove_user_from_server_totals(uid_to_delete)
+                            del user_data[uid_to_delete]
+                            journal_user_deleted(uid_to_delete)
+                            print(f"DEBUG: Deleted user data for {uid_to_delete}.")
+                        
+                        # オートRNGセッションも停止・削除 (スケジューラの処理対象から外れる)
+                        if uid_to_delete in auto_rng_sessions:
+                            del auto_rng_sessions[uid_to_delete]
+                            print(f"DEBUG: Deleted auto-RNG session for {uid_to_delete}.")
+
+                    save_auto_rng_sessions()
+                await send_reply(message.channel, f"{', '.join(target_names_to_report)} のデータとオートRNGセッションが削除されました。")
+            else:
+                await send_reply(message.channel, "確認が一致しませんでした。データ削除はキャンセルされました。")
+        except asyncio.TimeoutError:
+            await send_reply(message.channel, "確認がタイムアウトしました。データ削除はキャンセルされました。")
+        except Exception as e:
+            print(f"ERROR: Error during !delete command processing: {e}")
+            import traceback
+            traceback.print_exc()
+            await send_reply(message.channel, f"データ削除中にエラーが発生しました: {e}")
+
+    except Exception as e:
+        print(f"ERROR: Failed to process !delete command or send message: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+# --- 新しいデバッグ用コマンド ---
+async def command_test(message, context):
+    print("DEBUG: Entering !test command block.")
+    try:
+        await send_reply(message.channel, "ボットは正常に動作しています！")
+        print("DEBUG: !test response sent.")
+    except Exception as e:
+        print(f"ERROR: Failed to send !test response: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+# コマンド名 -> CommandSpec(ハンドラ, 引数の解析, 管理者専用か, ユーザーデータを使うか)
+COMMANDS = {
+    "!help": CommandSpec(command_help, parse_no_args, False, False),
+    "!adminhelp": CommandSpec(command_adminhelp, parse_no_args, True, False),
+    "!ping": CommandSpec(command_ping, parse_no_args, False, False),
+    "!setup": CommandSpec(command_setup, parse_no_args, True, False),
+    "!login": CommandSpec(command_login, parse_no_args, False, True),
+    "!rng": CommandSpec(command_rng, parse_rng_args, False, True),
+    "!status": CommandSpec(command_status, parse_no_args, False, True),
+    "!itemlist": CommandSpec(command_itemlist, parse_no_args, False, True),
+    "!ranking": CommandSpec(command_ranking, parse_ranking_args, False, False),
+    "!recipe": CommandSpec(command_recipe, parse_no_args, False, False),
+    "!make": CommandSpec(command_make, parse_space_separated_args, False, True),
+    "!use": CommandSpec(command_use, parse_space_separated_args, False, True),
+    "!craft": CommandSpec(command_craft, parse_space_separated_args, False, True),
+    "!autorng": CommandSpec(command_autorng, parse_no_args, False, True),
+    "!giveautorng": CommandSpec(command_giveautorng, parse_space_separated_args, True, False),
+    "!autostop": CommandSpec(command_autostop, parse_no_args, False, False),
+    "!autorngtime": CommandSpec(command_autorngtime, parse_no_args, False, False),
+    "!adminautorng": CommandSpec(command_adminautorng, parse_no_args, True, False),
+    "!boostluck": CommandSpec(command_boostluck, parse_space_separated_args, True, False),
+    "!resetall": CommandSpec(command_resetall, parse_no_args, True, False),
+    "!delete": CommandSpec(command_delete, parse_space_separated_args, True, False),
+    "!test": CommandSpec(command_test, parse_no_args, False, False),
+}
+
+@bot.event
+async def on_message(message):
+    # コマンドでないメッセージ (通常の会話) はロックを取らずにすぐ無視する
+    if not message.content.lstrip().startswith("!"):
+        return
+
+    if message.author.bot:
+        # UnbelievaBoatのような他のボットからの空のメッセージは無視
+        if message.author.name == "UnbelievaBoat" and message.content.strip() == "":
+            print(f"DEBUG: Ignoring empty message from bot: {message.author.name}")
+            return # UnbelievaBoatからの空のメッセージは無視
+        # それ以外のボットからのメッセージも基本的には無視
+        print(f"DEBUG: Ignoring message from another bot: {message.author.name} (Content: '{message.content}')")
+        return
+
+    if not bot_initialized:
+        # データの読み込みが済むまでコマンドは受け付けない
+        print(f"DEBUG: Ignoring command before initialization: '{message.content}'")
+        return
+
+    # メッセージ内容の前後の空白を除去し、小文字に変換
+    command_content = message.content.lower().strip()
+    command_name = command_content.split(" ", 1)[0]
+    command = COMMANDS.get(command_name)
+    args = command.parse_args(command_content) if command else None
+    if args is None:
         # --- コマンドが認識されなかった場合のログ ---
-        else:
-            print(f"DEBUG: Command '{command_content}' not recognized or handled.")
+        print(f"DEBUG: Command '{command_content}' not recognized or handled.")
+        return
 
+    try:
+        if command.admin_only and message.author.id not in ADMIN_IDS:
+            await send_reply(message.channel, "このコマンドは管理者のみが使用できます。")
+            return
 
+        handler_start = time.perf_counter()
+        context = CommandContext(str(message.author.id), command_content, args, datetime.datetime.now(datetime.timezone.utc))
+        if command.needs_user_state:
+            await prepare_user_state(context.user_id)
+        await command.handler(message, context)
+        record_command_timing(command_name, time.perf_counter() - handler_start)
     except Exception as e:
         print(f"CRITICAL ERROR in on_message function! Please review the traceback below:")
         import traceback
         traceback.print_exc() # 詳細なエラー情報も出力
         # ユーザーにエラーが発生したことを通知する場合（開発中のみ推奨）
-        # await message.channel.send(f"ボットの処理中に予期せぬエラーが発生しました: `{e}`")
+        # await send_reply(message.channel, f"ボットの処理中に予期せぬエラーが発生しました: `{e}`")
+
+
+# オートRNGセッションの進捗 (抽選済みの時刻・ロール数) は、ユーザーデータの保存 (コンパクション) と同じトランザクションで保存される。
+# それまでの進捗はジャーナルのまとめ抽選の記録 (auto_rng_until) から再生できるので、
+# スケジューラはセッションが終了したティックにだけセッションを保存する。
+
+# 早送りモード: 1秒ごとにロールせず、経過秒数分のロールをまとめて抽選する
+# まとめ抽選は AUTO_RNG_CHUNK_SECONDS ごと、!status / !autorngtime の実行時、セッション終了時に行う
+AUTO_RNG_FAST_FORWARD = True
+AUTO_RNG_CHUNK_SECONDS = 60 # 早送りモードでのまとめ抽選の間隔 (秒)
+
+# 全セッションを処理するスケジューラのティック間隔 (秒)
+AUTO_RNG_TICK_SECONDS = 1.0
+auto_rng_scheduler_task = None # 実行中のスケジューラタスク (1つだけ)
+AUTO_RNG_RESULT_DM_CONCURRENCY = 5 # 時間切れの結果DMの同時送信数
+auto_rng_result_dm_semaphore = asyncio.Semaphore(AUTO_RNG_RESULT_DM_CONCURRENCY)
+auto_rng_result_dm_tasks = set() # 送信中の結果DMのタスク (完了まで参照を保つ)
+
 
+def auto_rng_materialize_interval():
+    """セッションごとのまとめ抽選の間隔 (秒) を返す"""
+    return AUTO_RNG_CHUNK_SECONDS if AUTO_RNG_FAST_FORWARD else 1
 
-# オートRNGセッションの保存頻度を調整するためのグローバル変数
-# これを導入することで、ロールごとの保存ではなく、一定ロール数ごとや時間ごとなどに変更可能になる
-AUTO_RNG_SAVE_INTERVAL_ROLLS = 100 # 例: 100ロールごとに保存
-AUTO_RNG_SAVE_INTERVAL_SECONDS = 60 # 例: 60秒ごとに保存 (どちらか早い方)
-last_auto_rng_save_time = {} # user_id -> last_save_timestamp
-last_auto_rng_save_rolls = {} # user_id -> last_save_rolls_count
 
+def ensure_auto_rng_scheduler():
+    """オートRNGスケジューラが動いていなければ開始する"""
+    global auto_rng_scheduler_task
+    if auto_rng_scheduler_task is None or auto_rng_scheduler_task.done():
+        auto_rng_scheduler_task = bot.loop.create_task(auto_rng_scheduler())
 
-async def auto_roll_task(user: discord.User, is_resumed: bool = False):
+
+def create_auto_rng_session(user: discord.User):
+    """新しいオートRNGセッションを登録する (ロールはスケジューラが行う)"""
+    create_auto_rng_sessions([str(user.id)])
+    auto_rng_sessions[str(user.id)]["user"] = user # 取得済みのユーザーは結果のDMに使う
+
+
+def create_auto_rng_sessions(user_ids):
     """
-    指定されたユーザーの自動ロールを実行する非同期タスク。
+    複数のオートRNGセッションをユーザーIDだけで同じ開始時刻にまとめて登録する (保存は呼び出し側で1回だけ行う)。
+    ユーザーは結果のDMを送るときに取得する。
+    まとめ抽選の時刻は1間隔の中に散らし、全セッションが同じティックに集まらないようにする。
     """
-    user_id = str(user.id)
-    session_data = auto_rng_sessions[user_id]
-    found_items_log = session_data["found_items_log"]
-    start_time = session_data["start_time"]
-    max_duration_seconds = session_data["max_duration_seconds"]
+    start_time = datetime.datetime.now(datetime.timezone.utc)
+    start_timestamp = start_time.timestamp()
+    interval = auto_rng_materialize_interval()
+    for index, user_id in enumerate(user_ids):
+        auto_rng_sessions[user_id] = {
+            "user": None, # 結果のDM送信先 (未取得ならDMの送信時に取得する)
+            "found_items_log": {},
+            "start_time": start_time,
+            "max_duration_seconds": 6 * 3600, # 6時間
+            "materialized_until": start_timestamp, # この時刻までのロールは抽選済み
+            "rolls_credited": 0, # このセッションで抽選済みのロール数
+            "next_materialize": start_timestamp + interval * (1 + index / len(user_ids)), # 次にまとめ抽選する時刻
+            "awaiting_resume": False
+        }
+    ensure_auto_rng_scheduler()
 
-    # user_dataへのアクセスはロックで保護
-    async with user_data_lock:
-        initial_rolls = user_data[user_id].get("rolls", 0) # 開始時のロール数を記録
-        # オートRNG開始時の保存カウンターを初期化
-        last_auto_rng_save_rolls[user_id] = initial_rolls
-        last_auto_rng_save_time[user_id] = time.time()
 
+def resume_auto_rng_session(user: discord.User, catch_up_delay=0.0):
+    """
+    ロード済みのオートRNGセッションを再開する。ボット停止中の時間分 (セッションの終了時刻まで) は、
+    catch_up_delay 秒後のティックで1回のまとめ抽選として加算される。残り時間 (秒、時間切れなら0以下) を返す。
+    """
+    session_data = auto_rng_sessions[str(user.id)]
+    now_timestamp = time.time()
+    end_timestamp = session_data["start_time"].timestamp() + session_data["max_duration_seconds"]
+    session_data["user"] = user
+    session_data["next_materialize"] = now_timestamp + catch_up_delay # 停止中の分をまとめ抽選する時刻
+    session_data["awaiting_resume"] = False
+    ensure_auto_rng_scheduler()
+    return end_timestamp - now_timestamp # 残り時間 (秒)
 
-    try:
-        # 途中再開の場合、残り時間を計算してsleep
-        if is_resumed:
-            current_time_utc = datetime.datetime.now(datetime.timezone.utc)
-            elapsed_time = (current_time_utc - start_time).total_seconds()
-            remaining_time = max_duration_seconds - elapsed_time
-            if remaining_time <= 0:
-                # user_dataへのアクセスはロックで保護
-                async with user_data_lock:
-                    rolls_performed = user_data[user_id].get("rolls", 0) - initial_rolls
-                try:
-                    await send_auto_rng_results(user, found_items_log, rolls_performed, "再開前に時間切れ")
-                except Exception as e:
-                    print(f"WARNING: Could not send auto-RNG results (time out on resume) to {user.name}: {e}")
-                
-                # 終了時のクリーンアップ
-                if user_id in auto_rng_sessions:
-                    del auto_rng_sessions[user_id]
-                    save_auto_rng_sessions()
-                if user_id in last_auto_rng_save_rolls:
-                    del last_auto_rng_save_rolls[user_id]
-                if user_id in last_auto_rng_save_time:
-                    del last_auto_rng_save_time[user_id]
-                return
 
-            try:
-                await user.send(f"オートRNGセッションを再開します。残り約 {remaining_time / 3600:.1f}時間です。")
-            except Exception as e:
-                print(f"WARNING: Could not send auto-RNG resume message to {user.name}: {e}")
-            # 最初のロールまで待機
-            await asyncio.sleep(1) # 1秒待ってからロール開始 (誤差を考慮)
+def auto_rng_luck_segments(data, first_roll_timestamp, roll_count):
+    """
+    first_roll_timestamp から1秒ごとに行われる roll_count 回のロールを、
+    ラック (基本ラック x ブースト) が一定の区間ごとに [(回数, ラック), ...] に分割する。
+    """
+    boosts = [] # (開始時刻, 終了時刻, 倍率)
+    daily_boost = data["daily_login"]["active_boost"]
+    if daily_boost["end_time"]:
+        boosts.append((-math.inf, daily_boost["end_time"], daily_boost["multiplier"]))
+    admin_boost_info = data["admin_boost"]
+    if admin_boost_info["end_time"]:
+        boosts.append((-math.inf, admin_boost_info["end_time"], admin_boost_info["multiplier"]))
+    for boost in bot_settings["global_luck_boosts"]:
+        boosts.append((boost["start_time"], boost["end_time"], boost["multiplier"]))
+
+    # 各ブーストが有効なロールの範囲 [開始, 終了) (k回目のロールは first_roll_timestamp + k の時刻に行われる)
+    active_roll_ranges = []
+    for start_time, end_time, multiplier in boosts:
+        first_active = min(roll_count, max(0, math.ceil(start_time - first_roll_timestamp))) if start_time > -math.inf else 0
+        last_active = min(roll_count, max(0, math.ceil(end_time - first_roll_timestamp)))
+        if first_active < last_active:
+            active_roll_ranges.append((first_active, last_active, multiplier))
+
+    breakpoints = sorted({0, roll_count, *(edge for first_active, last_active, _ in active_roll_ranges for edge in (first_active, last_active))})
+    segments = []
+    for segment_start, segment_end in zip(breakpoints, breakpoints[1:]):
+        luck = data["luck"]
+        for first_active, last_active, multiplier in active_roll_ranges:
+            if first_active <= segment_start < last_active:
+                luck *= multiplier
+        segments.append((segment_end - segment_start, luck))
+    return segments
+
+
+def materialize_auto_rng_rolls(user_id, now_timestamp=None):
+    """
+    オートRNGセッションの未抽選の経過秒数分のロールをまとめて抽選し、ユーザーデータに反映する。
+    今回見つかったアイテムを {アイテム名: 個数} で返す。呼び出し側で user_lock(user_id) を取得しておくこと。
+    """
+    session_data = auto_rng_sessions.get(user_id)
+    if session_data is None or user_id not in user_data:
+        return {}
+
+    if now_timestamp is None:
+        now_timestamp = time.time()
+    end_timestamp = session_data["start_time"].timestamp() + session_data["max_duration_seconds"]
+    due_rolls = int(min(now_timestamp, end_timestamp) - session_data["materialized_until"])
+    if due_rolls <= 0:
+        return {}
+
+    first_roll_timestamp = session_data["materialized_until"] + 1
+    session_data["materialized_until"] += due_rolls
+
+    data = user_data[user_id]
+    active_uses = dict(data["active_luck_potion_uses"]) # 消費はコピー上で数え、最後に差分として反映する
+    consumed_potion_uses = {}
+    found_items = {}
+
+    for segment_rolls, segment_luck in auto_rng_luck_segments(data, first_roll_timestamp, due_rolls):
+        # Luck Potionは最も高い倍率のものから1ロール1回ずつ使う。ポーションの種類ごと・ポーションなしの区間ごとにまとめて抽選
+        roll_potion_runs(segment_luck, active_uses, segment_rolls, found_items, consumed_potion_uses)
+
+    apply_user_delta(
+        user_id,
+        rolls=due_rolls,
+        inventory=found_items,
+        active_luck_potion_uses=consumed_potion_uses,
+        auto_rng_until=session_data["materialized_until"],
+    )
+    session_data["rolls_credited"] += due_rolls
+    found_items_log = session_data["found_items_log"]
+    for item, count in found_items.items():
+        found_items_log[item] = found_items_log.get(item, 0) + count
 
+    return found_items
 
-        while True:
-            # 時間制限チェック
-            current_time_utc = datetime.datetime.now(datetime.timezone.utc)
-            elapsed_time = (current_time_utc - start_time).total_seconds()
-            if elapsed_time >= max_duration_seconds:
-                # user_dataへのアクセスはロックで保護
-                async with user_data_lock:
-                    rolls_performed = user_data[user_id].get("rolls", 0) - initial_rolls
-                try:
-                    await send_auto_rng_results(user, found_items_log, rolls_performed, "時間切れ")
-                except Exception as e:
-                    print(f"WARNING: Could not send auto-RNG results (time out) to {user.name}: {e}")
-                break # ループを抜ける
-
-            # ロール実行
-            async with user_data_lock: # user_data変更時にロック
-                # ユーザーの基本ラック (通常は1.0)
-                current_base_luck = user_data[user_id]["luck"]
-
-                # デイリーログインブーストの適用
-                user_boost = user_data[user_id]["daily_login"]["active_boost"]
-                if user_boost["end_time"] and datetime.datetime.now(datetime.timezone.utc) < datetime.datetime.fromtimestamp(user_boost["end_time"], tz=datetime.timezone.utc):
-                    current_base_luck *= user_boost["multiplier"]
-                
-                # 管理者ブーストの適用
-                admin_boost_info = user_data[user_id].get("admin_boost", {"multiplier": 1.0, "end_time": None})
-                if admin_boost_info["end_time"] and current_time < datetime.datetime.fromtimestamp(admin_boost_info["end_time"], tz=datetime.timezone.utc):
-                    current_base_luck *= admin_boost_info["multiplier"]
-
-                # Luck Potionの適用ロジック (active_luck_potion_usesから消費)
-                applied_potion_multiplier = 1.0
-                applied_potion_display_name = None
-
-                active_uses = user_data[user_id]["active_luck_potion_uses"]
-
-                highest_multiplier = 1.0
-                best_potion_internal_name = None
-                sorted_potions_by_multiplier = sorted(LUCK_POTION_EFFECTS.items(), key=lambda item: item[1], reverse=True)
-
-                for internal_name, multiplier_value in sorted_potions_by_multiplier:
-                    if active_uses.get(internal_name, 0) > 0:
-                        highest_multiplier = multiplier_value
-                        best_potion_internal_name = internal_name
-                        break
 
-                if best_potion_internal_name:
-                    applied_potion_multiplier = highest_multiplier
-                    current_luck_for_roll = current_base_luck * applied_potion_multiplier
+def materialize_auto_rng_rolls_before_luck_change(user_id):
+    """
+    ブーストを変更する前に、オートRNGの未抽選のロールを変更前のブーストで抽選しておく
+    (まとめ抽選は抽選時点のブーストから区間を計算するため)。呼び出し側で user_lock(user_id) を取得しておくこと。
+    """
+    found_items = materialize_auto_rng_rolls(user_id)
+    session_data = auto_rng_sessions.get(user_id)
+    if found_items and session_data is not None:
+        queue_rare_drop_notifications(f"<@{user_id}>", found_items, source="オートRNG")
 
-                    active_uses[best_potion_internal_name] -= 1
-                    if active_uses[best_potion_internal_name] <= 0:
-                        del active_uses[best_potion_internal_name]
-                else:
-                    current_luck_for_roll = current_base_luck
 
-                user_data[user_id]["rolls"] = user_data[user_id].get("rolls", 0) + 1
-                chosen_item, luck_applied_denominator, original_denominator = perform_roll(current_luck_for_roll) # perform_rollが3つの値を返す
 
-                inventory = user_data[user_id]["inventory"]
-                inventory[chosen_item] = inventory.get(chosen_item, 0) + 1
+RARE_DROP_DIGEST_WINDOW_SECONDS = 5.0 # この時間内のレアドロップ通知は1つのまとめ通知にする
+RARE_DROP_DIGEST_MAX_LINES = 20 # まとめ通知に載せる件数
+rare_drop_digests = {} # チャンネルID -> [(ユーザーのメンション, アイテム名, 個数, 獲得元), ...] (まとめ待ち)
 
-                # ★★★ データ保存頻度の調整 ★★★
-                # ロールごとではなく、一定のロール数ごと、または時間ごとに保存
-                current_rolls_count = user_data[user_id]["rolls"]
-                current_time_for_save = time.time()
+def queue_rare_drop_notifications(mention, found_items: dict, source=None):
+    """
+    見つかったレアアイテムの通知をまとめ待ちに入れる (!rng、まとめロール、オートRNG)。
+    まとめ待ちの時間が過ぎたら、1件なら個別の通知、複数なら1つのまとめ通知として送る。
+    """
+    rare_items = [(item, count) for item, count in found_items.items() if rare_item_chances_denominator[item] >= 100000] # ★★★ 通知判断は元の分母で ★★★
+    if not rare_items:
+        return
 
-                should_save = False
-                if current_rolls_count - last_auto_rng_save_rolls.get(user_id, 0) >= AUTO_RNG_SAVE_INTERVAL_ROLLS:
-                    should_save = True
-                    print(f"DEBUG: Auto-RNG save triggered by rolls for {user.name}")
-                if current_time_for_save - last_auto_rng_save_time.get(user_id, current_time_for_save) >= AUTO_RNG_SAVE_INTERVAL_SECONDS:
-                    should_save = True
-                    print(f"DEBUG: Auto-RNG save triggered by time for {user.name}")
+    notification_channel_id = bot_settings.get("notification_channel_id")
+    if not notification_channel_id:
+        return
+    notification_channel = bot.get_channel(notification_channel_id)
+    if not notification_channel:
+        print(f"WARNING: Configured notification channel ID {notification_channel_id} not found.")
+        return
 
-                if should_save:
-                    save_user_data()
-                    save_auto_rng_sessions()
-                    last_auto_rng_save_rolls[user_id] = current_rolls_count
-                    last_auto_rng_save_time[user_id] = current_time_for_save
-                    print(f"DEBUG: Auto-RNG data saved for {user.name}.")
-
-
-            # レアアイテム通知 (オートRNG中も通知)
-            if original_denominator >= 100000: # ★★★ 通知判断は元の分母で ★★★
-                notification_channel_id = bot_settings.get("notification_channel_id")
-                if notification_channel_id:
-                    notification_channel = bot.get_channel(notification_channel_id)
-                    if notification_channel:
-                        total_item_counts = {item: 0 for item in rare_item_chances_denominator.keys()}
-                        async with user_data_lock: # 全ユーザーデータへのアクセスをロック
-                            for uid_all in user_data:
-                                for item, count in user_data[uid_all]["inventory"].items():
-                                    if item in total_item_counts:
-                                        total_item_counts[item] += count
-
-                        notification_embed = discord.Embed(
-                            title="レアアイテムドロップ通知！ (オートRNG)",
-                            description=f"{user.mention} がオートRNGでレアアイテムを獲得しました！",
-                            color=discord.Color.gold()
-                        )
-                        notification_embed.add_field(name="獲得者", value=user.mention, inline=False)
-                        notification_embed.add_field(name="アイテム", value=chosen_item, inline=False)
-                        notification_embed.add_field(name="確率", value=f"1 in {original_denominator:,}", inline=False) # 表示は元の確率
-                        notification_embed.add_field(name="獲得日時", value=datetime.datetime.now(datetime.timezone.utc).strftime("%Y年%m月%d日 %H:%M:%S UTC"), inline=False)
-                        notification_embed.add_field(name="サーバー総所持数", value=f"{total_owned_count}個", inline=False)
-                        notification_embed.set_footer(text="おめでとうございます！")
-                        try:
-                            await notification_channel.send(embed=notification_embed)
-                        except Exception as e:
-                            print(f"WARNING: Could not send rare item notification to channel {notification_channel.id}: {e}")
-                    else:
-                        print(f"WARNING: Configured notification channel ID {notification_channel_id} not found.")
+    pending_drops = rare_drop_digests.get(notification_channel.id)
+    if pending_drops is None:
+        pending_drops = rare_drop_digests[notification_channel.id] = []
+        bot.loop.call_later(RARE_DROP_DIGEST_WINDOW_SECONDS, flush_rare_drop_digest, notification_channel)
+    for chosen_item, count in rare_items:
+        pending_drops.append((mention, chosen_item, count, source))
+
+def flush_rare_drop_digest(notification_channel):
+    """まとめ待ちのレアドロップ通知を送信キューに入れる"""
+    pending_drops = rare_drop_digests.pop(notification_channel.id, [])
+    if len(pending_drops) == 1:
+        mention, chosen_item, count, source = pending_drops[0]
+        notification_embed = discord.Embed(
+            title=f"レアアイテムドロップ通知！ ({source})" if source else "レアアイテムドロップ通知！",
+            description=f"{mention} が{source}でレアアイテムを獲得しました！" if source else f"{mention} がレアアイテムを獲得しました！",
+            color=discord.Color.gold()
+        )
+        notification_embed.add_field(name="獲得者", value=mention, inline=False)
+        notification_embed.add_field(name="アイテム", value=chosen_item if count == 1 else f"{chosen_item} x {count}個", inline=False)
+        notification_embed.add_field(name="確率", value=f"1 in {rare_item_chances_denominator[chosen_item]:,}", inline=False) # 表示は元の確率
+        notification_embed.add_field(name="獲得日時", value=datetime.datetime.now(datetime.timezone.utc).strftime("%Y年%m月%d日 %H:%M:%S UTC"), inline=False)
+        notification_embed.add_field(name="サーバー総所持数", value=f"{server_item_totals.get(chosen_item, 0)}個", inline=False)
+        notification_embed.set_footer(text="おめでとうございます！")
+    elif pending_drops:
+        pending_drops.sort(key=lambda drop: rare_item_chances_denominator[drop[1]], reverse=True) # レアな順
+        lines = [
+            f"{mention} が **{chosen_item}**{'' if count == 1 else f' x {count}個'} (1 in {rare_item_chances_denominator[chosen_item]:,}, サーバー総所持数 {server_item_totals.get(chosen_item, 0)}個)"
+            + (f" [{source}]" if source else "")
+            for mention, chosen_item, count, source in pending_drops[:RARE_DROP_DIGEST_MAX_LINES]
+        ]
+        if len(pending_drops) > RARE_DROP_DIGEST_MAX_LINES:
+            lines.append(f"...他 {len(pending_drops) - RARE_DROP_DIGEST_MAX_LINES}件")
+        notification_embed = discord.Embed(
+            title=f"レアアイテムドロップ通知！ ({len(pending_drops)}件)",
+            description="\n".join(lines),
+            color=discord.Color.gold()
+        )
+        notification_embed.set_footer(text=f"{datetime.datetime.now(datetime.timezone.utc).strftime('%Y年%m月%d日 %H:%M:%S UTC')} までの{RARE_DROP_DIGEST_WINDOW_SECONDS:.0f}秒間 - おめでとうございます！")
+    else:
+        return
+    send_in_background(notification_channel, embed=notification_embed)
 
-            await asyncio.sleep(1) # 1秒待機
 
-    except asyncio.CancelledError:
-        # タスクがキャンセルされた場合 (例: !autostop コマンド)
-        async with user_data_lock: # user_dataへのアクセスはロックで保護
-            rolls_performed = user_data[user_id].get("rolls", 0) - initial_rolls
+async def send_auto_rng_session_results(user_id, session_data, stop_reason):
+    """終了したオートRNGセッションの結果をユーザーにDMで送信する (ユーザーが未取得ならここで取得する)"""
+    async with auto_rng_result_dm_semaphore:
+        user = session_data["user"] or await resolve_user(user_id)
+        if user is None:
+            print(f"WARNING: Could not send auto-RNG results ({stop_reason}) to user ID {user_id}: user not found")
+            return
         try:
-            await send_auto_rng_results(user, found_items_log, rolls_performed, "手動停止")
+            await send_auto_rng_results(user, session_data["found_items_log"], session_data["rolls_credited"], stop_reason)
         except Exception as e:
-            print(f"WARNING: Could not send auto-RNG results (manual stop) to {user.name}: {e}")
-    except Exception as e:
-        print(f"ERROR: Auto-RNG error (user ID: {user_id}): {e}")
-        import traceback
-        traceback.print_exc()
+            print(f"WARNING: Could not send auto-RNG results ({stop_reason}) to {user.name}: {e}")
+    print(f"DEBUG: Auto-RNG session for {user.name} finished/cleaned up.")
+
+
+async def stop_auto_rng_session(user_id, stop_reason):
+    """
+    オートRNGセッションを停止時点までの経過時間分を抽選してから終了し、結果をDMで送る。
+    セッションが無ければ False を返す。
+    """
+    async with user_lock(user_id):
+        if user_id not in auto_rng_sessions:
+            return False
+        found_items = materialize_auto_rng_rolls(user_id)
+        session_data = auto_rng_sessions.pop(user_id)
+        save_auto_rng_sessions() # セッション終了を反映して保存
+
+    queue_rare_drop_notifications(f"<@{user_id}>", found_items, source="オートRNG")
+    await send_auto_rng_session_results(user_id, session_data, stop_reason)
+    return True
+
+
+async def auto_rng_scheduler():
+    """
+    全ユーザーのオートRNGセッションを1つのループで処理するスケジューラ。
+    ティックごとに、まとめ抽選の時刻を過ぎたセッションをそのユーザーのロックだけを取得して処理する。
+    ティックの時刻は単調増加時計で計算するため、処理時間によるずれが蓄積しない。
+    """
+    await bot.wait_until_ready()
+
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    while not bot.is_closed():
+        next_tick += AUTO_RNG_TICK_SECONDS
         try:
-            await user.send(f"オートRNG中にエラーが発生しました: {e}")
-        except Exception as dm_e:
-            print(f"WARNING: Could not send error message to user {user.name}: {dm_e}")
-    finally:
-        # セッション終了時のクリーンアップ
-        if user_id in auto_rng_sessions:
-            del auto_rng_sessions[user_id]
-            save_auto_rng_sessions() # セッション終了を反映して保存
-        if user_id in last_auto_rng_save_rolls: # 終了時にはカウンターも削除
-            del last_auto_rng_save_rolls[user_id]
-        if user_id in last_auto_rng_save_time:
-            del last_auto_rng_save_time[user_id]
-        print(f"DEBUG: Auto-RNG session for {user.name} finished/cleaned up.")
+            current_timestamp = time.time()
+            rare_drops = [] # [(メンション, found_items), ...]
+            finished_sessions = []
+
+            for user_id, session_data in list(auto_rng_sessions.items()):
+                if session_data["awaiting_resume"]:
+                    continue # on_readyでの再開待ち
+
+                end_timestamp = session_data["start_time"].timestamp() + session_data["max_duration_seconds"]
+                if current_timestamp < session_data["next_materialize"] and current_timestamp < end_timestamp:
+                    continue
+
+                async with user_lock(user_id): # セッションのユーザーだけをロック
+                    if auto_rng_sessions.get(user_id) is not session_data:
+                        continue # ロック待ちの間に停止・削除された
+                    found_items = materialize_auto_rng_rolls(user_id, current_timestamp)
+                    session_data["next_materialize"] = current_timestamp + auto_rng_materialize_interval()
+                    if found_items:
+                        rare_drops.append((f"<@{user_id}>", found_items))
+
+                    # 時間制限チェック
+                    if current_timestamp >= end_timestamp:
+                        finished_sessions.append((user_id, auto_rng_sessions.pop(user_id)))
+
+            # ★★★ データ保存頻度の調整 ★★★
+            # 進捗はユーザーデータの保存時にまとめて保存されるので、ここではセッションの終了だけを1ティック1回で保存する
+            if finished_sessions:
+                save_auto_rng_sessions()
+                print("DEBUG: Auto-RNG data saved by scheduler.")
+
+            # レアアイテム通知と結果のDMはロックの外で送信する
+            # 結果のDMは待たずにバックグラウンドで送る (同じティックに多数のセッションが終了しても次のティックを遅らせない)
+            for mention, found_items in rare_drops:
+                queue_rare_drop_notifications(mention, found_items, source="オートRNG")
+            for user_id, session_data in finished_sessions:
+                result_task = bot.loop.create_task(send_auto_rng_session_results(user_id, session_data, "時間切れ"))
+                auto_rng_result_dm_tasks.add(result_task)
+                result_task.add_done_callback(auto_rng_result_dm_tasks.discard)
+        except Exception as e:
+            print(f"ERROR: Auto-RNG scheduler error: {e}")
+            import traceback
+            traceback.print_exc()
+
+        # 次のティックまで待機 (処理が遅れてティックを過ぎた場合は溜め込まずに次から再開)
+        delay = next_tick - loop.time()
+        if delay < 0:
+            next_tick = loop.time()
+            delay = 0
+        await asyncio.sleep(delay)
+
+# データの書き出し・取り込み・形式の比較はボットを起動せずに実行する
+#   --export-json PATH / --import-json PATH / --bench-snapshot
+if len(sys.argv) > 1:
+    if sys.argv[1] == "--export-json" and len(sys.argv) > 2:
+        export_user_data_json(sys.argv[2])
+    elif sys.argv[1] == "--import-json" and len(sys.argv) > 2:
+        import_user_data_json(sys.argv[2])
+    elif sys.argv[1] == "--bench-snapshot":
+        benchmark_snapshot_formats()
+    else:
+        print("使い方: --export-json PATH | --import-json PATH | --bench-snapshot")
+    storage_executor.shutdown(wait=True)
+    sys.exit(0)
 
 # ここにDiscord Botのトークンを記述
 # 環境変数からトークンを取得するのが推奨される
 bot.run(os.environ['DISCORD_BOT_TOKEN'])
+
+# 終了時 (Ctrl+C など) にも保存待ちのデータを強制的に保存する
+concurrent.futures.wait(flush_all_data())
+storage_executor.shutdown(wait=True)
+print("終了前にユーザーデータとオートRNGセッションを保存しました。")